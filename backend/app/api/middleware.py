@@ -0,0 +1,209 @@
+"""HTTP middlewares for the metrics API: conditional GET (ETag / 304) and response compression."""
+from __future__ import annotations
+
+import hashlib
+import zlib
+from pathlib import Path
+from typing import Any, Callable, Optional
+from urllib.parse import parse_qsl
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:  # brotli 为可选依赖，未安装时只提供 gzip
+    import brotli
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # 动态响应在压缩率与 CPU 之间折中（11 过慢）
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+# 流式响应在发出响应头之后才知道各部分是否出错（如 /dashboard?stream=true 的组件超时），不能带 ETag
+UNTAGGED_TYPES = ("application/x-ndjson",)
+CONDITIONAL_EXCLUDED = ("/_metrics", "/admin", "/docs", "/redoc", "/openapi.json")
+
+
+def _code_version() -> str:
+    """app 包源码的摘要：部署新代码（响应格式可能变化）后 ETag 随之变化，各实例间一致"""
+    root = Path(__file__).resolve().parents[1]
+    digest = hashlib.sha1()
+    for path in sorted(root.rglob("*.py")):
+        digest.update(path.relative_to(root).as_posix().encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()[:12]
+
+
+class ConditionalGetMiddleware:
+    """为 API 的 GET 响应添加弱 ETag，If-None-Match 命中时直接返回 304
+
+    响应只取决于数据版本（快照 ID / 派生表指纹）与请求本身（路径 + 排序后的查询参数，即缓存键），
+    因此 ETag 在调用路由之前就能算出：命中时不执行查询、不读取缓存，也不传输响应体。
+    Cache-Control: no-cache 让浏览器每次使用前都带 If-None-Match 重新验证，数据更新后立即拿到新结果。
+    NDJSON 流式响应不带 ETag：其中的组件错误不应在数据版本变化前一直以 304 被复用。
+    """
+
+    def __init__(self, app: Any, data_version: Callable[[], Optional[str]], prefix: str) -> None:
+        self.app = app
+        self.data_version = data_version
+        self.prefix = prefix
+        self.code_version = _code_version()
+
+    async def __call__(self, scope: dict[str, Any], receive: Any, send: Any) -> None:
+        etag = self._etag(scope) if scope["type"] == "http" and scope["method"] in ("GET", "HEAD") else None
+        if etag is None:
+            await self.app(scope, receive, send)
+            return
+
+        if _etag_matches(Headers(scope=scope).get("if-none-match"), etag):
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 304,
+                    "headers": [
+                        (b"etag", etag.encode()),
+                        (b"cache-control", b"private, no-cache"),
+                        (b"vary", b"Accept-Encoding"),
+                    ],
+                }
+            )
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_wrapper(message: dict[str, Any]) -> None:
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                headers = MutableHeaders(scope=message)
+                if not headers.get("content-type", "").startswith(UNTAGGED_TYPES):
+                    headers["ETag"] = etag
+                    headers.setdefault("Cache-Control", "private, no-cache")
+                    _vary_accept_encoding(headers)
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    def _etag(self, scope: dict[str, Any]) -> Optional[str]:
+        path = scope["path"]
+        if not path.startswith(self.prefix) or path[len(self.prefix):].startswith(CONDITIONAL_EXCLUDED):
+            return None
+        version = self.data_version()
+        if version is None:
+            return None
+        query = sorted(parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True))
+        key = "|".join([self.code_version, version, path] + [f"{k}={v}" for k, v in query])
+        # 弱 ETag：同一内容的 gzip / br / 未压缩表示共用一个 ETag
+        return f'W/"{hashlib.sha1(key.encode()).hexdigest()}"'
+
+
+def _vary_accept_encoding(headers: MutableHeaders) -> None:
+    """添加 Vary: Accept-Encoding（已存在时不重复添加）"""
+    vary = [token.strip().lower() for token in headers.get("vary", "").split(",")]
+    if "accept-encoding" not in vary:
+        headers.add_vary_header("Accept-Encoding")
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """按弱比较判断 If-None-Match 是否包含 etag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in if_none_match.split(","))
+
+
+def _choose_encoding(accept_encoding: str) -> Optional[str]:
+    """按 Accept-Encoding 选择编码：优先 br（已安装 brotli 时），其次 gzip；q=0 表示不接受"""
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        name, *params = [token.strip() for token in part.split(";")]
+        if any(param.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000") for param in params):
+            continue
+        accepted.add(name)
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+class _Encoder:
+    """增量压缩器；流式响应每个分块都完整刷新，客户端可以立即解压并解析已收到的行"""
+
+    def __init__(self, encoding: str) -> None:
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._brotli = None
+            self._gzip = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def chunk(self, data: bytes) -> bytes:
+        if self._brotli is not None:
+            return self._brotli.process(data) + self._brotli.flush()
+        return self._gzip.compress(data) + self._gzip.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes) -> bytes:
+        if self._brotli is not None:
+            return self._brotli.process(data) + self._brotli.finish()
+        return self._gzip.compress(data) + self._gzip.flush(zlib.Z_FINISH)
+
+
+class CompressionMiddleware:
+    """按 Accept-Encoding 以 brotli 或 gzip 压缩 JSON / NDJSON / 文本响应
+
+    小于 minimum_size 的完整响应不压缩；流式响应（/dashboard?stream=true）总是压缩并逐块刷新。
+    已带 Content-Encoding 的响应与 304 等无响应体的状态原样透传。
+    """
+
+    def __init__(self, app: Any, minimum_size: int = 500) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: dict[str, Any], receive: Any, send: Any) -> None:
+        encoding = _choose_encoding(Headers(scope=scope).get("accept-encoding", "")) if scope["type"] == "http" else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Optional[dict[str, Any]] = None
+        encoder: Optional[_Encoder] = None
+
+        async def send_wrapper(message: dict[str, Any]) -> None:
+            nonlocal start_message, encoder
+            if message["type"] == "http.response.start":
+                # 等到第一个响应体分块才能判断大小与是否流式
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start_message is not None:
+                start, start_message = start_message, None
+                headers = MutableHeaders(scope=start)
+                if not self._compressible(start["status"], headers, body, more_body):
+                    await send(start)
+                    await send(message)
+                    return
+                encoder = _Encoder(encoding)
+                headers["Content-Encoding"] = encoding
+                _vary_accept_encoding(headers)
+                if "content-length" in headers:
+                    del headers["Content-Length"]
+                if more_body:
+                    body = encoder.chunk(body)
+                else:
+                    body = encoder.finish(body)
+                    headers["Content-Length"] = str(len(body))
+                await send(start)
+            elif encoder is not None:
+                body = encoder.chunk(body) if more_body else encoder.finish(body)
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
+
+    def _compressible(self, status: int, headers: MutableHeaders, body: bytes, more_body: bool) -> bool:
+        if status < 200 or status in (204, 304) or "content-encoding" in headers:
+            return False
+        if not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES):
+            return False
+        return more_body or len(body) >= self.minimum_size
@@ -0,0 +1,40 @@
+"""Administrative endpoints (data ingestion)."""
+from __future__ import annotations
+
+import secrets
+from pathlib import Path
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+
+from app.core.config import get_settings
+from app.models.schemas import IngestRequest, IngestResponse
+from app.services.data_service import get_data_service
+from app.services.executor import get_query_executor
+from app.services.ingest import ingest_files, invalidate_ingested
+
+settings = get_settings()
+executor = get_query_executor("heavy")
+
+
+def require_admin_token(x_admin_token: str | None = Header(None)) -> None:
+    if not settings.admin_token or not x_admin_token or not secrets.compare_digest(x_admin_token, settings.admin_token):
+        raise HTTPException(status_code=403, detail="admin token required")
+
+
+router = APIRouter(prefix="/admin", tags=["admin"], dependencies=[Depends(require_admin_token)])
+
+
+@router.post("/ingest", response_model=IngestResponse)
+async def ingest(request: IngestRequest):
+    """增量导入事件批次，并只失效受影响的缓存"""
+    if get_data_service().read_only:
+        raise HTTPException(
+            status_code=409, detail="database is read-only; publish new batches with `python -m app.cli publish`"
+        )
+    paths = [Path(path) for path in request.paths]
+    missing = [str(path) for path in paths if not path.exists()]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"files not found: {', '.join(missing)}")
+    results = await executor.run(ingest_files, paths)
+    invalidated = await invalidate_ingested(results)
+    return {"batches": results, "invalidated_keys": invalidated}
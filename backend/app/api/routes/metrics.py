@@ -1,27 +1,75 @@
 """Metrics and analytics endpoints."""
 from __future__ import annotations
 
+import asyncio
+import logging
+from functools import partial
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+import orjson
 from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 
 from app.core.config import get_settings
 from app.models.schemas import ActiveHourDetailResponse, CohortDetailResponse, DrilldownResponse, EventMetric, FunnelStageDetailResponse, MonthlyRetentionPoint, SegmentName, TopEntity, WeekdayDetailResponse, WeekdayUsersResponse
-from app.services.cache import cache_get, cache_key, cache_set
+from app.services import telemetry
+from app.services.cache import cache_get, cache_key, cache_set, cached
 from app.services.data_service import get_data_service
+from app.services.executor import QueryQueueFullError, QueryTimeoutError, get_query_executor, query_class_of
 
+logger = logging.getLogger(__name__)
 router = APIRouter(tags=["metrics"])
 settings = get_settings()
 service = get_data_service()
 
 
+def dump_json(value: Any) -> bytes:
+    return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+def _call_json(func, *args) -> bytes:
+    with telemetry.track_service_call(func.__name__):
+        value = func(*args)
+    with telemetry.track_serialization(func.__name__):
+        return dump_json(value)
+
+
+def _call_json_parts(func, *args) -> dict[str, bytes]:
+    with telemetry.track_service_call(func.__name__):
+        values = func(*args)
+    with telemetry.track_serialization(func.__name__):
+        return {name: dump_json(value) for name, value in values.items()}
+
+
+async def run_query(func, *args, serialize=_call_json):
+    """在该查询类别的 worker 线程池中执行 DuckDB 查询并序列化为 JSON，避免阻塞事件循环"""
+    executor = get_query_executor(query_class_of(func))
+    try:
+        return await executor.run(serialize, func, *args, timeout=executor.timeout)
+    except QueryQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except QueryTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except ValueError as e:
+        # 参数校验失败（如无法解析的日期）
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def cached_json(key: str, func, *args) -> Response:
+    """缓存中保存的是序列化后的 JSON，直接作为响应体返回（跳过 response_model 的校验与再次序列化）"""
+    return Response(await cached(key, lambda: run_query(func, *args)), media_type="application/json")
+
+
+@router.get("/_metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """Prometheus 文本格式的接口耗时、查询与缓存统计"""
+    return PlainTextResponse(telemetry.render(), media_type="text/plain; version=0.0.4")
+
+
 @router.get("/segments")
 async def get_segments():
     key = cache_key("segments")
-    cached = await cache_get(key)
-    if cached:
-        return cached
-    data = service.get_segments()
-    await cache_set(key, data)
-    return data
+    return await cached_json(key, service.get_segments)
 
 
 @router.get("/top-items")
@@ -33,12 +81,7 @@ async def top_items(
     date_to: str | None = Query(None),
 ):
     key = cache_key("top-items", segment=segment, metric=metric, limit=limit, date_from=date_from, date_to=date_to)
-    cached = await cache_get(key)
-    if cached:
-        return cached
-    data = service.get_top_entities(segment, metric, "item", limit, date_from, date_to)
-    await cache_set(key, data)
-    return data
+    return await cached_json(key, service.get_top_entities, segment, metric, "item", limit, date_from, date_to)
 
 
 @router.get("/top-categories")
@@ -50,12 +93,7 @@ async def top_categories(
     date_to: str | None = Query(None),
 ):
     key = cache_key("top-categories", segment=segment, metric=metric, limit=limit, date_from=date_from, date_to=date_to)
-    cached = await cache_get(key)
-    if cached:
-        return cached
-    data = service.get_top_entities(segment, metric, "category", limit, date_from, date_to)
-    await cache_set(key, data)
-    return data
+    return await cached_json(key, service.get_top_entities, segment, metric, "category", limit, date_from, date_to)
 
 
 @router.get("/funnel")
@@ -65,12 +103,7 @@ async def funnel(
     date_to: str | None = Query(None),
 ):
     key = cache_key("funnel", segment=segment, date_from=date_from, date_to=date_to)
-    cached = await cache_get(key)
-    if cached:
-        return cached
-    data = service.get_funnel(segment, date_from, date_to)
-    await cache_set(key, data)
-    return data
+    return await cached_json(key, service.get_funnel, segment, date_from, date_to)
 
 
 @router.get("/event-counts")
@@ -80,12 +113,7 @@ async def event_counts(
     date_to: str | None = Query(None),
 ):
     key = cache_key("event-counts", segment=segment, date_from=date_from, date_to=date_to)
-    cached = await cache_get(key)
-    if cached:
-        return cached
-    data = service.get_event_counts(segment, date_from, date_to)
-    await cache_set(key, data)
-    return data
+    return await cached_json(key, service.get_event_counts, segment, date_from, date_to)
 
 
 @router.get("/active-hours")
@@ -95,12 +123,7 @@ async def active_hours(
     date_to: str | None = Query(None),
 ):
     key = cache_key("active-hours", segment=segment, date_from=date_from, date_to=date_to)
-    cached = await cache_get(key)
-    if cached:
-        return cached
-    data = service.get_active_hours(segment, date_from, date_to)
-    await cache_set(key, data)
-    return data
+    return await cached_json(key, service.get_active_hours, segment, date_from, date_to)
 
 
 @router.get("/drilldown/{entity_type}/{entity_id}", response_model=DrilldownResponse)
@@ -114,12 +137,7 @@ async def drilldown(
     if entity_type not in {"item", "category"}:
         raise HTTPException(status_code=400, detail="entity_type must be 'item' or 'category'")
     key = cache_key("drilldown", entity_type=entity_type, entity_id=entity_id, segment=segment, date_from=date_from, date_to=date_to)
-    cached = await cache_get(key)
-    if cached:
-        return cached
-    data = service.get_drilldown(entity_type, entity_id, segment, date_from, date_to)
-    await cache_set(key, data)
-    return data
+    return await cached_json(key, service.get_drilldown, entity_type, entity_id, segment, date_from, date_to)
 
 
 @router.get("/funnel-stage/{stage}", response_model=FunnelStageDetailResponse)
@@ -129,18 +147,14 @@ async def funnel_stage_detail(
     top_n: int = Query(10, ge=5, le=20),
     date_from: str | None = Query(None),
     date_to: str | None = Query(None),
+    approx: bool = Query(False, description="使用 HyperLogLog 近似去重用户数"),
 ):
     if stage not in {"view", "addtocart", "transaction"}:
         raise HTTPException(
             status_code=400, detail="stage must be 'view', 'addtocart', or 'transaction'"
         )
-    key = cache_key("funnel-stage", stage=stage, segment=segment, top_n=top_n, date_from=date_from, date_to=date_to)
-    cached = await cache_get(key)
-    if cached:
-        return cached
-    data = service.get_funnel_stage_detail(stage, segment, top_n, date_from, date_to)
-    await cache_set(key, data)
-    return data
+    key = cache_key("funnel-stage", stage=stage, segment=segment, top_n=top_n, date_from=date_from, date_to=date_to, approx=approx)
+    return await cached_json(key, service.get_funnel_stage_detail, stage, segment, top_n, date_from, date_to, approx)
 
 
 @router.get("/active-hour/{hour}", response_model=ActiveHourDetailResponse)
@@ -150,16 +164,12 @@ async def active_hour_detail(
     top_n: int = Query(10, ge=5, le=20),
     date_from: str | None = Query(None),
     date_to: str | None = Query(None),
+    approx: bool = Query(False, description="使用 HyperLogLog 近似去重用户数"),
 ):
     if hour < 0 or hour > 23:
         raise HTTPException(status_code=400, detail="hour must be between 0 and 23")
-    key = cache_key("active-hour", hour=hour, segment=segment, top_n=top_n, date_from=date_from, date_to=date_to)
-    cached = await cache_get(key)
-    if cached:
-        return cached
-    data = service.get_active_hour_detail(hour, segment, top_n, date_from, date_to)
-    await cache_set(key, data)
-    return data
+    key = cache_key("active-hour", hour=hour, segment=segment, top_n=top_n, date_from=date_from, date_to=date_to, approx=approx)
+    return await cached_json(key, service.get_active_hour_detail, hour, segment, top_n, date_from, date_to, approx)
 
 
 @router.get("/monthly-retention", response_model=list[MonthlyRetentionPoint])
@@ -169,12 +179,7 @@ async def monthly_retention(
     date_to: str | None = Query(None),
 ):
     key = cache_key("monthly-retention", segment=segment, date_from=date_from, date_to=date_to)
-    cached = await cache_get(key)
-    if cached:
-        return cached
-    data = service.get_monthly_retention(segment, date_from, date_to)
-    await cache_set(key, data)
-    return data
+    return await cached_json(key, service.get_monthly_retention, segment, date_from, date_to)
 
 
 @router.get("/weekday-users", response_model=WeekdayUsersResponse)
@@ -182,14 +187,10 @@ async def weekday_users(
     segment: SegmentName = Query("All"),
     date_from: str | None = Query(None),
     date_to: str | None = Query(None),
+    approx: bool = Query(False, description="使用 HyperLogLog 近似去重用户数"),
 ):
-    key = cache_key("weekday-users", segment=segment, date_from=date_from, date_to=date_to)
-    cached = await cache_get(key)
-    if cached:
-        return cached
-    data = service.get_weekday_users(segment, date_from, date_to)
-    await cache_set(key, data)
-    return data
+    key = cache_key("weekday-users", segment=segment, date_from=date_from, date_to=date_to, approx=approx)
+    return await cached_json(key, service.get_weekday_users, segment, date_from, date_to, None, approx)
 
 
 @router.get("/cohort-detail/{cohort_month}", response_model=CohortDetailResponse)
@@ -205,15 +206,9 @@ async def cohort_detail(
         cohort_month: cohort月份，格式为 'YYYY-MM' (如 '2024-01')
     """
     key = cache_key("cohort-detail", cohort_month=cohort_month, segment=segment, date_from=date_from, date_to=date_to)
-    cached = await cache_get(key)
-    if cached:
-        return cached
     try:
-        data = service.get_cohort_detail(cohort_month, segment, date_from, date_to)
-        await cache_set(key, data)
-        return data
+        return await cached_json(key, service.get_cohort_detail, cohort_month, segment, date_from, date_to)
     except ValueError as e:
-        from fastapi import HTTPException
         raise HTTPException(status_code=400, detail=str(e))
 
 
@@ -224,6 +219,7 @@ async def weekday_detail(
     top_n: int = Query(10, ge=5, le=20),
     date_from: str | None = Query(None),
     date_to: str | None = Query(None),
+    approx: bool = Query(False, description="使用 HyperLogLog 近似去重用户数"),
 ):
     """获取指定星期几的详细分析数据
     
@@ -232,14 +228,136 @@ async def weekday_detail(
     """
     if weekday < 1 or weekday > 7:
         raise HTTPException(status_code=400, detail="weekday must be between 1 and 7")
-    key = cache_key("weekday-detail", weekday=weekday, segment=segment, top_n=top_n, date_from=date_from, date_to=date_to)
-    cached = await cache_get(key)
-    if cached:
-        return cached
+    key = cache_key("weekday-detail", weekday=weekday, segment=segment, top_n=top_n, date_from=date_from, date_to=date_to, approx=approx)
     try:
-        data = service.get_weekday_detail(weekday, segment, top_n, date_from, date_to)
-        await cache_set(key, data)
-        return data
+        return await cached_json(key, service.get_weekday_detail, weekday, segment, top_n, date_from, date_to, approx)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+
+
+DASHBOARD_WIDGETS = (
+    "segments",
+    "top-items",
+    "top-categories",
+    "funnel",
+    "event-counts",
+    "active-hours",
+    "monthly-retention",
+    "weekday-users",
+)
+ACTIVITY_WIDGETS = ("monthly-retention", "weekday-users")
+
+
+async def _activity_widgets(names: list[str], segment: str, date_from: str | None, date_to: str | None) -> dict[str, bytes]:
+    """留存与星期分布共享一次事件扫描；两者都未命中缓存时合并计算"""
+    params = {"segment": segment, "date_from": date_from, "date_to": date_to}
+    # 与 /monthly-retention、/weekday-users（精确模式）的缓存 key 保持一致
+    keys = {
+        name: cache_key(name, **params, approx=False) if name == "weekday-users" else cache_key(name, **params)
+        for name in names
+    }
+    results = {name: await cache_get(key) for name, key in keys.items()}
+    missing = [name for name, value in results.items() if value is None]
+    if len(missing) == 1:
+        if missing[0] == "monthly-retention":
+            response = await monthly_retention(segment=segment, date_from=date_from, date_to=date_to)
+        else:
+            response = await weekday_users(segment=segment, date_from=date_from, date_to=date_to, approx=False)
+        results[missing[0]] = response.body
+    elif missing:
+        computed = await run_query(service.get_activity_widgets, segment, date_from, date_to, serialize=_call_json_parts)
+        for name in missing:
+            await cache_set(keys[name], computed[name])
+            results[name] = computed[name]
+    return results
+
+
+def _dashboard_jobs(
+    widgets: list[str],
+    segment: str,
+    metric: str,
+    limit: int,
+    date_from: str | None,
+    date_to: str | None,
+) -> list[tuple[list[str], Callable[[], Awaitable[dict[str, bytes]]]]]:
+    """将请求的组件拆分为 (组件名列表, 计算函数)；单个组件直接复用对应接口（共享缓存 key）"""
+    filters = {"segment": segment, "date_from": date_from, "date_to": date_to}
+    top_n = {"metric": metric, "limit": limit}
+    routes = {
+        "segments": get_segments,
+        "top-items": partial(top_items, **filters, **top_n),
+        "top-categories": partial(top_categories, **filters, **top_n),
+        "funnel": partial(funnel, **filters),
+        "event-counts": partial(event_counts, **filters),
+        "active-hours": partial(active_hours, **filters),
+    }
+
+    async def single(name: str) -> dict[str, bytes]:
+        return {name: (await routes[name]()).body}
+
+    jobs = [([name], partial(single, name)) for name in widgets if name in routes]
+    activity = [name for name in widgets if name in ACTIVITY_WIDGETS]
+    if activity:
+        jobs.append((activity, partial(_activity_widgets, activity, **filters)))
+    return jobs
+
+
+async def _stream_widgets(jobs: list[tuple[list[str], Callable[[], Awaitable[dict[str, bytes]]]]]) -> AsyncIterator[bytes]:
+    """按完成顺序逐行输出 NDJSON：{"widget": ..., "data": ...} 或 {"widget": ..., "error": ...}"""
+
+    def error(names: list[str], detail: Any) -> list[bytes]:
+        return [dump_json({"widget": name, "error": detail}) for name in names]
+
+    async def settle(names: list[str], job: Callable[[], Awaitable[dict[str, bytes]]]) -> list[bytes]:
+        try:
+            # 组件数据已是序列化后的 JSON，直接拼接进外层对象
+            return [b'{"widget":' + dump_json(name) + b',"data":' + data + b"}" for name, data in (await job()).items()]
+        except HTTPException as e:
+            return error(names, e.detail)
+        except ValueError as e:
+            return error(names, str(e))
+        except Exception:  # noqa: BLE001 - 单个组件失败不中断整个流
+            logger.exception("Dashboard widgets %s failed.", names)
+            return error(names, "internal error")
+
+    tasks = [asyncio.ensure_future(settle(names, job)) for names, job in jobs]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            for line in await next_done:
+                yield line + b"\n"
+    finally:
+        # 客户端提前断开时取消尚未完成的组件
+        for task in tasks:
+            task.cancel()
+
+
+@router.get("/dashboard")
+async def dashboard(
+    segment: SegmentName = Query("All"),
+    metric: EventMetric = Query("transaction"),
+    limit: int = Query(settings.default_top_n, ge=3, le=30),
+    date_from: str | None = Query(None),
+    date_to: str | None = Query(None),
+    widgets: list[str] | None = Query(None),
+    stream: bool = Query(False),
+):
+    """一次请求获取总览页的多个组件（默认全部）
+
+    每个组件仍按对应单独接口的缓存 key 读写缓存；stream=true 时以 NDJSON 逐个返回已完成的组件。
+    """
+    requested = widgets or list(DASHBOARD_WIDGETS)
+    unknown = sorted(set(requested) - set(DASHBOARD_WIDGETS))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"unknown widgets: {', '.join(unknown)}")
+    jobs = _dashboard_jobs(requested, segment, metric, limit, date_from, date_to)
+    if stream:
+        return StreamingResponse(_stream_widgets(jobs), media_type="application/x-ndjson")
+    results: dict[str, bytes] = {}
+    try:
+        for batch in await asyncio.gather(*(job() for _, job in jobs)):
+            results.update(batch)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    body = b",".join(dump_json(name) + b":" + results[name] for name in dict.fromkeys(requested))
+    return Response(b"{" + body + b"}", media_type="application/json")
@@ -0,0 +1,30 @@
+"""Background switch-over of read-only workers to newly published snapshots."""
+from __future__ import annotations
+
+import asyncio
+import logging
+
+from app.api.warmup import warm_cache
+from app.core.config import get_settings
+from app.services.cache import set_key_namespace
+from app.services.data_service import get_data_service
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+
+async def run_snapshot_watch_loop() -> None:
+    """定期检查发布路径；切换到新快照后更新缓存键命名空间并重新预热首屏视图"""
+    service = get_data_service()
+    while True:
+        await asyncio.sleep(settings.snapshot_poll_seconds)
+        try:
+            switched = await asyncio.to_thread(service.reload_if_published)
+        except Exception as exc:  # noqa: BLE001 - 新快照不可用时继续使用当前快照
+            logger.warning("Failed to attach published snapshot: %s", exc)
+            continue
+        if switched:
+            logger.info("Switched to snapshot %s.", service.snapshot_id)
+            set_key_namespace(service.snapshot_id)
+            if settings.cache_warmup_enabled:
+                await warm_cache()
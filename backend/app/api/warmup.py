@@ -0,0 +1,70 @@
+"""Background cache warm-up for the default dashboard views."""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from functools import partial
+from typing import Any, Awaitable, Callable
+
+from app.api.routes import metrics
+from app.core.config import get_settings
+from app.services.cache import force_refresh
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+
+def _default_views() -> list[Callable[[], Awaitable[Any]]]:
+    """前端首屏会请求的接口（默认指标 transaction、默认 Top N）
+
+    直接调用路由函数，保证缓存 key 与真实请求一致。
+    """
+    views: list[Callable[[], Awaitable[Any]]] = [metrics.get_segments]
+    for segment in settings.allowed_segments:
+        for date_from, date_to in settings.cache_warmup_date_ranges:
+            filters = {"segment": segment, "date_from": date_from, "date_to": date_to}
+            top_n = {"metric": "transaction", "limit": settings.default_top_n}
+            views += [
+                partial(metrics.top_items, **filters, **top_n),
+                partial(metrics.top_categories, **filters, **top_n),
+                partial(metrics.funnel, **filters),
+                partial(metrics.event_counts, **filters),
+                partial(metrics.active_hours, **filters),
+                partial(metrics.monthly_retention, **filters),
+                partial(metrics.weekday_users, **filters, approx=False),
+            ]
+    return views
+
+
+async def warm_cache() -> None:
+    """逐个重算默认视图并写入缓存（串行执行，避免占满查询线程池）"""
+    started = time.perf_counter()
+    failed = 0
+    views = _default_views()
+    with force_refresh():
+        for view in views:
+            try:
+                await view()
+            except Exception as exc:  # noqa: BLE001 - 预热失败不影响服务
+                failed += 1
+                logger.warning("Cache warm-up query failed: %s", exc)
+    logger.info(
+        "Warmed %d dashboard views in %.1fs (%d failed).", len(views) - failed, time.perf_counter() - started, failed
+    )
+
+
+async def run_warmup_loop() -> None:
+    """启动时预热一次，之后在缓存 TTL 到期前定期刷新
+
+    按每轮的开始时间计算间隔（扣除本轮耗时）：视图按相同顺序重算，每个 key 距上次写入约 interval 秒即被刷新，
+    不会因为整轮耗时而过期。
+    """
+    interval = max(settings.cache_ttl_seconds - settings.cache_warmup_margin_seconds, 10)
+    while True:
+        started = time.monotonic()
+        await warm_cache()
+        elapsed = time.monotonic() - started
+        if elapsed > interval:
+            logger.warning("Cache warm-up took %.1fs, longer than the %ds refresh interval.", elapsed, interval)
+        await asyncio.sleep(max(interval - elapsed, 0))
@@ -0,0 +1,278 @@
+"""Synthetic event generator and latency benchmark for ``DataService``.
+
+Every ``DataService.get_*`` method is run across segments and date ranges on
+deterministic synthetic data, so results from different commits can be
+compared directly. Each data size runs in its own process (settings are read
+once per process, and peak RSS is per process).
+
+Usage:
+    python -m app.cli generate-events --rows 10M --out bench/events_10m.parquet
+    python -m app.cli benchmark --rows 1M --rows 10M --out bench/results.json [--baseline old.json]
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import duckdb
+
+logger = logging.getLogger(__name__)
+
+SEGMENTS = ("All", "Hesitant", "Impulsive", "Collector")
+# 未指定、按整月对齐、10 天窗口（与合成数据的时间范围 2015-05-03 ~ 2015-09-17 对应）
+DATE_RANGES: tuple[tuple[Optional[str], Optional[str]], ...] = (
+    (None, None),
+    ("2015-06-01", "2015-08-31"),
+    ("2015-07-10", "2015-07-20"),
+)
+DATA_START = "2015-05-03"
+DATA_DAYS = 138
+SIZE_SUFFIXES = {"K": 1_000, "M": 1_000_000, "B": 1_000_000_000}
+
+
+def parse_rows(value: str) -> int:
+    """'1M' / '10M' / '250K' / '100000' -> 行数"""
+    value = value.strip().upper().replace("_", "")
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+def size_label(rows: int) -> str:
+    for suffix, scale in sorted(SIZE_SUFFIXES.items(), key=lambda item: -item[1]):
+        if rows >= scale and rows % scale == 0:
+            return f"{rows // scale}{suffix}"
+    return str(rows)
+
+
+def generate_events(rows: int, out: Path) -> Path:
+    """生成与 events 表同结构的合成数据（Parquet）
+
+    数据完全由行号的哈希决定（不依赖随机种子或线程数），同一 DuckDB 版本下每次生成结果一致：
+    访客、商品按幂律分布倾斜（少数头部访客/商品占大部分事件），每个商品固定属于一个类别，
+    约 10% 的访客为高购买倾向用户，事件时间集中在晚间。
+    """
+    visitors = max(rows // 20, 1_000)
+    items = max(rows // 50, 500)
+    categories = min(max(items // 100, 50), 1_700)
+    out.parent.mkdir(parents=True, exist_ok=True)
+
+    def uniform(salt: int, column: str = "i") -> str:
+        # 每个 (行号, salt) 对应不同的哈希输入，各字段之间相互独立
+        return f"(hash({column} * 16 + {salt}) / 18446744073709551616.0)"
+
+    con = duckdb.connect()
+    con.execute(
+        f"""
+        COPY (
+            WITH base AS (
+                SELECT
+                    i,
+                    CAST(floor(pow({uniform(1)}, 2.5) * {visitors}) AS BIGINT) AS visitorid,
+                    CAST(floor(pow({uniform(2)}, 3) * {items}) AS BIGINT) AS itemid,
+                    {uniform(3)} AS u_event,
+                    CAST(floor({uniform(4)} * {DATA_DAYS}) AS INTEGER) AS day,
+                    -- 晚间高峰：约 60% 的事件落在 17:00-23:59
+                    CASE WHEN {uniform(5)} < 0.6
+                        THEN 17 + CAST(floor({uniform(6)} * 7) AS INTEGER)
+                        ELSE CAST(floor({uniform(6)} * 24) AS INTEGER)
+                    END AS hour,
+                    CAST(floor({uniform(7)} * 3600) AS INTEGER) AS second_of_hour
+                FROM range({rows}) t(i)
+            )
+            SELECT
+                TIMESTAMP '{DATA_START}' + to_days(day) + to_hours(hour) + to_seconds(second_of_hour) AS timestamp,
+                visitorid,
+                CASE
+                    WHEN hash(visitorid * 16 + 8) % 10 = 0 THEN
+                        CASE WHEN u_event < 0.70 THEN 'view' WHEN u_event < 0.88 THEN 'addtocart' ELSE 'transaction' END
+                    ELSE
+                        CASE WHEN u_event < 0.97 THEN 'view' WHEN u_event < 0.995 THEN 'addtocart' ELSE 'transaction' END
+                END AS event,
+                itemid,
+                CAST(floor(pow({uniform(9, "itemid")}, 2) * {categories}) AS BIGINT) AS categoryid
+            FROM base
+        ) TO '{out.as_posix()}' (FORMAT parquet)
+        """
+    )
+    con.close()
+    return out
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    """最近秩百分位数"""
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def _summary(samples: list[float]) -> dict[str, float]:
+    return {
+        "p50_ms": round(_percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(_percentile(samples, 95) * 1000, 3),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 3),
+        "calls": len(samples),
+    }
+
+
+def _peak_rss_mb() -> float:
+    # Linux 下 ru_maxrss 单位为 KB
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _cases(service: Any) -> list[tuple[str, dict[str, Any], Callable[[], Any]]]:
+    """(方法名, 参数, 调用) 列表：覆盖每个 get_* 方法 × 分群 × 日期范围"""
+    top_item = service.get_top_entities("All", "view", "item", 1)[0]["entity_id"]
+    top_category = service.get_top_entities("All", "view", "category", 1)[0]["entity_id"]
+    cohort_month = service.get_monthly_retention("All")[0]["cohort_month"]
+    cases: list[tuple[str, dict[str, Any], Callable[[], Any]]] = [("get_segments", {}, service.get_segments)]
+
+    def add(method: str, **kwargs: Any) -> None:
+        label = {key: value for key, value in kwargs.items() if value is not None}
+        cases.append((method, label, lambda: getattr(service, method)(**kwargs)))
+
+    for segment in SEGMENTS:
+        for date_from, date_to in DATE_RANGES:
+            filters = {"segment": segment, "date_from": date_from, "date_to": date_to}
+            add("get_top_entities", metric="transaction", entity="item", limit=10, **filters)
+            add("get_top_entities", metric="view", entity="category", limit=10, **filters)
+            add("get_funnel", **filters)
+            add("get_event_counts", **filters)
+            add("get_active_hours", **filters)
+            add("get_monthly_retention", **filters)
+            add("get_weekday_users", **filters)
+            add("get_weekday_users", approx=True, **filters)
+            add("get_activity_widgets", **filters)
+            add("get_drilldown", entity_type="item", entity_id=top_item, **filters)
+            add("get_drilldown", entity_type="category", entity_id=top_category, **filters)
+            add("get_funnel_stage_detail", stage="addtocart", top_n=10, **filters)
+            add("get_funnel_stage_detail", stage="addtocart", top_n=10, approx=True, **filters)
+            add("get_active_hour_detail", hour=20, top_n=10, **filters)
+            add("get_weekday_detail", weekday=3, top_n=10, **filters)
+            add("get_cohort_detail", cohort_month=cohort_month, **filters)
+
+    covered = {method for method, _, _ in cases}
+    missing = sorted(name for name in dir(type(service)) if name.startswith("get_") and name not in covered)
+    if missing:
+        logger.warning("Benchmark does not cover: %s", ", ".join(missing))
+    return cases
+
+
+def run_size(data_source: Path, duckdb_path: Path, repeat: int) -> dict[str, Any]:
+    """在当前进程内对一份数据做完整基准测试；须在导入 app 配置之前设置好环境变量"""
+    os.environ["DATA_SOURCE"] = str(data_source)
+    os.environ["DUCKDB_PATH"] = str(duckdb_path)
+    for path in (duckdb_path, duckdb_path.with_name(duckdb_path.name + ".wal")):
+        path.unlink(missing_ok=True)
+
+    from app.services.data_service import DataService
+
+    started = time.perf_counter()
+    service = DataService()  # 冷启动：导入事件并构建全部派生表
+    cold_startup = time.perf_counter() - started
+    service._db.close()
+    started = time.perf_counter()
+    service = DataService()  # 热启动：指纹未变化，直接复用派生表
+    warm_startup = time.perf_counter() - started
+    rss_after_startup = _peak_rss_mb()
+
+    samples: dict[str, list[float]] = {}
+    results = []
+    for method, params, call in _cases(service):
+        call()  # 预热一次，不计入统计
+        durations = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            call()
+            durations.append(time.perf_counter() - started)
+        samples.setdefault(method, []).extend(durations)
+        results.append({"method": method, "params": params, **_summary(durations)})
+
+    rows = service.con.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+    return {
+        "rows": rows,
+        "label": size_label(rows),
+        "startup": {"cold_seconds": round(cold_startup, 3), "warm_seconds": round(warm_startup, 3)},
+        "peak_rss_mb": {"after_startup": rss_after_startup, "total": _peak_rss_mb()},
+        "methods": {method: _summary(durations) for method, durations in sorted(samples.items())},
+        "cases": results,
+    }
+
+
+def _environment() -> dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "duckdb": duckdb.__version__,
+        "cpu_count": os.cpu_count(),
+        "platform": platform.platform(),
+    }
+
+
+def run_benchmark(sizes: list[int], workdir: Path, repeat: int) -> dict[str, Any]:
+    """按数据规模依次在独立子进程中运行基准测试"""
+    workdir.mkdir(parents=True, exist_ok=True)
+    runs = []
+    for rows in sizes:
+        label = size_label(rows)
+        data_source = workdir / f"events_{label}.parquet"
+        if not data_source.exists():
+            logger.info("Generating %s synthetic events -> %s", label, data_source)
+            generate_events(rows, data_source)
+        logger.info("Benchmarking %s rows", label)
+        output = subprocess.run(
+            [sys.executable, "-m", "app.benchmark", str(data_source), str(workdir / f"bench_{label}.duckdb"), str(repeat)],
+            stdout=subprocess.PIPE,
+            text=True,
+            check=True,
+            cwd=Path(__file__).resolve().parents[1],
+        ).stdout
+        runs.append(json.loads(output))
+    return {**_environment(), "repeat": repeat, "runs": runs}
+
+
+def compare(current: dict[str, Any], baseline: dict[str, Any]) -> list[str]:
+    """与基线结果对比各方法的 p50/p95（同一数据规模）"""
+    lines = []
+    previous_runs = {run["label"]: run for run in baseline.get("runs", [])}
+    for run in current["runs"]:
+        previous = previous_runs.get(run["label"])
+        if previous is None:
+            continue
+        lines.append(f"{run['label']} rows (baseline {baseline.get('commit')} -> {current.get('commit')})")
+        for method, stats in run["methods"].items():
+            before = previous["methods"].get(method)
+            if before is None:
+                continue
+            ratios = [
+                f"{key} {before[key]:.1f} -> {stats[key]:.1f} ms ({stats[key] / before[key]:.2f}x)" if before[key] else key
+                for key in ("p50_ms", "p95_ms")
+            ]
+            lines.append(f"  {method:<26} " + ", ".join(ratios))
+        for key in ("cold_seconds", "warm_seconds"):
+            lines.append(f"  startup {key}: {previous['startup'][key]} -> {run['startup'][key]}")
+    return lines
+
+
+if __name__ == "__main__":
+    # 子进程入口：python -m app.benchmark <data_source> <duckdb_path> <repeat>
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    result = run_size(Path(sys.argv[1]), Path(sys.argv[2]), int(sys.argv[3]))
+    print(json.dumps(result))
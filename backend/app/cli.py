@@ -0,0 +1,100 @@
+"""Command line tools for maintaining the analytics database.
+
+Usage:
+    python -m app.cli ingest path/to/batch.parquet [more.csv ...]
+    python -m app.cli publish [path/to/batch.parquet ...]
+    python -m app.cli build-snapshot --out cache/events.snapshot.duckdb
+    python -m app.cli generate-events --rows 10M --out bench/events_10m.parquet
+    python -m app.cli benchmark --rows 1M --rows 10M --out bench/results.json [--baseline old.json]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+from pathlib import Path
+
+
+def _ingest(args: argparse.Namespace) -> None:
+    from app.services.ingest import ingest_files, invalidate_ingested
+
+    results = ingest_files([Path(path) for path in args.paths])
+    invalidated = asyncio.run(invalidate_ingested(results))
+    print(json.dumps({"batches": results, "invalidated_keys": invalidated}, ensure_ascii=False, indent=2))
+
+
+def _publish(args: argparse.Namespace) -> None:
+    from app.services.snapshot import publish_snapshot
+
+    result = publish_snapshot([Path(path) for path in args.paths])
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+def _build_snapshot(args: argparse.Namespace) -> None:
+    from app.services.snapshot import build_snapshot
+
+    base = Path(args.base) if args.base else None
+    manifest = build_snapshot(Path(args.out), [Path(path) for path in args.paths], base)
+    print(json.dumps(manifest, ensure_ascii=False, indent=2))
+
+
+def _generate_events(args: argparse.Namespace) -> None:
+    from app.benchmark import generate_events, parse_rows
+
+    print(generate_events(parse_rows(args.rows), Path(args.out)))
+
+
+def _benchmark(args: argparse.Namespace) -> None:
+    from app.benchmark import compare, parse_rows, run_benchmark
+
+    result = run_benchmark([parse_rows(rows) for rows in args.rows or ["1M"]], Path(args.workdir), args.repeat)
+    Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+    Path(args.out).write_text(json.dumps(result, indent=2))
+    if args.baseline:
+        print("\n".join(compare(result, json.loads(Path(args.baseline).read_text()))))
+    print(f"Results written to {args.out}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.cli")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest = subparsers.add_parser("ingest", help="append Parquet/CSV event batches to the events table")
+    ingest.add_argument("paths", nargs="+", help="Parquet or CSV files with the events schema")
+    ingest.set_defaults(func=_ingest)
+
+    publish = subparsers.add_parser(
+        "publish", help="build a new snapshot (optionally ingesting batches) and swap it in for read-only workers"
+    )
+    publish.add_argument("paths", nargs="*", help="Parquet or CSV files to ingest into the new snapshot")
+    publish.set_defaults(func=_publish)
+
+    snapshot = subparsers.add_parser(
+        "build-snapshot", help="write a compacted, read-only-attachable database with all derived tables built"
+    )
+    snapshot.add_argument("--out", required=True, help="output DuckDB file (a manifest is written to <out>.json)")
+    snapshot.add_argument("--base", help="start from this database instead of building from DATA_SOURCE")
+    snapshot.add_argument("paths", nargs="*", help="Parquet or CSV batches to ingest after building")
+    snapshot.set_defaults(func=_build_snapshot)
+
+    generate = subparsers.add_parser("generate-events", help="write deterministic synthetic events to Parquet")
+    generate.add_argument("--rows", default="1M", help="number of events, e.g. 1M, 10M, 100M")
+    generate.add_argument("--out", required=True, help="output Parquet path")
+    generate.set_defaults(func=_generate_events)
+
+    benchmark = subparsers.add_parser("benchmark", help="measure DataService latency, startup time and peak RSS")
+    benchmark.add_argument("--rows", action="append", help="data size, repeatable (default 1M)")
+    benchmark.add_argument("--repeat", type=int, default=5, help="timed runs per query case")
+    benchmark.add_argument("--workdir", default="bench", help="directory for generated data and DuckDB files")
+    benchmark.add_argument("--out", default="bench/results.json", help="JSON results path")
+    benchmark.add_argument("--baseline", help="previous results JSON to compare against")
+    benchmark.set_defaults(func=_benchmark)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -19,10 +19,48 @@ class Settings(BaseSettings):
     duckdb_path: Path = Field(
         default=Path(__file__).resolve().parents[2] / "cache" / "events.duckdb"
     )
+    # 只读 worker 模式：直接挂载构建进程发布的快照（duckdb_path 指向的文件），启动时不重建，可多进程共享
+    duckdb_read_only: bool = False
+    snapshot_dir: Path = Field(
+        default=Path(__file__).resolve().parents[2] / "cache" / "snapshots"
+    )
+    snapshot_keep: int = 3  # 发布新快照后保留的历史快照数（含当前）
+    snapshot_poll_seconds: float = 5.0  # worker 检查新快照的间隔
     redis_url: str = Field(default="redis://localhost:6379/0")
+    redis_connect_timeout_seconds: float = 0.5
     cache_ttl_seconds: int = 300
+    local_cache_max_entries: int = 512
+    local_cache_ttl_seconds: int = 300
+    local_cache_sync_seconds: float = 1.0  # 检查其他进程失效通知（Redis 中的失效计数）的间隔
+    # DuckDB 资源限制（作用于整个数据库实例）；溢写目录未设置时使用 DuckDB 默认（数据库文件旁的 .tmp）
+    duckdb_threads: int = 4
+    duckdb_memory_limit: Optional[str] = None  # 如 "2GB"
+    duckdb_temp_directory: Optional[Path] = None
+    duckdb_max_temp_directory_size: Optional[str] = None  # 如 "20GB"
+    # 汇总类查询（读取 rollup 表）的 worker 池
+    query_workers: int = 4
+    query_queue_limit: int = 32
+    query_timeout_seconds: float = 60.0
+    # 重查询（扫描事件明细：抽屉详情、留存）使用独立的 worker 池，不占用汇总查询的 worker
+    heavy_query_workers: int = 2
+    heavy_query_queue_limit: int = 16
+    heavy_query_timeout_seconds: float = 60.0
+    # 按 (分群, 日期范围) 物化的过滤后事件的总行数上限（约 50 字节/行，按最近使用淘汰）；0 表示关闭
+    filter_cache_max_rows: int = 2_000_000
     default_top_n: int = 10
+    cache_warmup_enabled: bool = True
+    cache_warmup_margin_seconds: int = 30  # 在缓存过期前多久刷新
+    # 与前端日期快捷选项一致：未选择日期、数据集全部、2015年5-7月、2015年6-9月
+    cache_warmup_date_ranges: tuple[tuple[Optional[str], Optional[str]], ...] = (
+        (None, None),
+        ("2015-05-01", "2015-09-30"),
+        ("2015-05-01", "2015-07-31"),
+        ("2015-06-01", "2015-09-30"),
+    )
     allowed_segments: tuple[str, ...] = ("All", "Hesitant", "Impulsive", "Collector")
+    admin_token: Optional[str] = None  # 未设置时禁用 /admin 接口
+    query_profiling_enabled: bool = False  # 启用后以 DuckDB 查询剖析统计扫描行数（/api/_metrics），默认关闭
+    slow_query_log_seconds: Optional[float] = None  # 设置后记录超过该耗时的 SQL
 
     class Config:
         env_file = ".env"
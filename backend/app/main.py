@@ -1,13 +1,50 @@
 """FastAPI application entrypoint."""
+import asyncio
+from contextlib import asynccontextmanager, suppress
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.api.routes import metrics
+from app.api.middleware import CompressionMiddleware, ConditionalGetMiddleware
+from app.api.routes import admin, metrics
+from app.api.snapshots import run_snapshot_watch_loop
+from app.api.warmup import run_warmup_loop
 from app.core.config import get_settings
+from app.services.cache import set_key_namespace
+from app.services.data_service import get_data_service
+from app.services.executor import QUERY_CLASSES, get_query_executor
+from app.services.telemetry import RequestTimingMiddleware
 
 settings = get_settings()
 
-app = FastAPI(title=settings.project_name, openapi_url=f"{settings.api_prefix}/openapi.json")
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    service = get_data_service()
+    set_key_namespace(service.snapshot_id)
+    tasks = []
+    if settings.cache_warmup_enabled:
+        tasks.append(asyncio.create_task(run_warmup_loop()))
+    if service.read_only:
+        tasks.append(asyncio.create_task(run_snapshot_watch_loop()))
+    yield
+    for task in tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    for query_class in QUERY_CLASSES:
+        get_query_executor(query_class).shutdown()
+
+
+app = FastAPI(title=settings.project_name, openapi_url=f"{settings.api_prefix}/openapi.json", lifespan=lifespan)
+
+# 后添加的中间件在外层：ETag 判断最靠近路由，304 与压缩后的响应仍经过 CORS 与耗时统计
+app.add_middleware(
+    ConditionalGetMiddleware,
+    data_version=lambda: get_data_service().data_version,
+    prefix=settings.api_prefix,
+)
+app.add_middleware(CompressionMiddleware, minimum_size=500)
 
 app.add_middleware(
     CORSMiddleware,
@@ -21,7 +58,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(RequestTimingMiddleware)
+
 app.include_router(metrics.router, prefix=settings.api_prefix)
+app.include_router(admin.router, prefix=settings.api_prefix)
 
 
 @app.get("/")
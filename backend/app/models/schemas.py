@@ -70,6 +70,7 @@ class FunnelStageDetailResponse(BaseModel):
     top_categories: List[TopEntity]
     user_segment_distribution: dict[str, int]
     dropoff_analysis: Optional[dict[str, Any]] = None  # 流失分析（如果不是第一阶段）
+    error_bound: Optional[float] = None  # approx=true 时 HLL 估算的相对标准误差
 
 
 class ActiveHourDetailResponse(BaseModel):
@@ -85,6 +86,7 @@ class ActiveHourDetailResponse(BaseModel):
     top_categories: List[TopEntity]
     user_segment_distribution: dict[str, int]
     comparison: dict[str, Any]  # 与相邻时间段和平均值的对比
+    error_bound: Optional[float] = None  # approx=true 时 HLL 估算的相对标准误差
 
 
 class MonthlyRetentionPoint(BaseModel):
@@ -107,6 +109,7 @@ class WeekdayUsersResponse(BaseModel):
     data: List[WeekdayUserPoint]  # 周一到周日的用户数据
     weekday_avg: float  # 工作日（周一到周五）的平均用户数
     weekend_avg: float  # 周末（周六、周日）的平均用户数
+    error_bound: Optional[float] = None  # approx=true 时 HLL 估算的相对标准误差
 
 
 class WeekdayDetailResponse(BaseModel):
@@ -125,6 +128,7 @@ class WeekdayDetailResponse(BaseModel):
     top_categories: List[TopEntity]  # Top 类别
     user_segment_distribution: dict[str, int]  # 用户细分群体分布
     comparison: dict[str, Any]  # 与工作日平均、周末平均、一周平均的对比
+    error_bound: Optional[float] = None  # approx=true 时 HLL 估算的相对标准误差
 
 
 class CohortDetailResponse(BaseModel):
@@ -140,3 +144,23 @@ class CohortDetailResponse(BaseModel):
     funnel: List[FunnelStage]  # 转化漏斗
     user_segment_distribution: dict[str, int]  # 用户细分群体分布
 
+
+
+class IngestRequest(BaseModel):
+    paths: List[str]  # 服务器上的 Parquet/CSV 文件路径
+
+
+class IngestBatchResult(BaseModel):
+    source: str
+    rows: int  # 导入的事件行数
+    visitors: int  # 涉及的访客数
+    new_visitors: int  # 此前没有事件的新访客数
+    reclassified: int  # 分群发生变化的已有访客数
+    segments: List[str]  # 受影响的用户群体
+    date_from: Optional[str] = None  # 受影响的日期范围
+    date_to: Optional[str] = None
+
+
+class IngestResponse(BaseModel):
+    batches: List[IngestBatchResult]
+    invalidated_keys: int  # 失效的缓存键数量
@@ -1,63 +1,247 @@
-"""Redis cache helpers (gracefully degrade when Redis is unavailable)."""
+"""Two-tier cache: in-process LRU in front of Redis, with request coalescing.
+
+Values are serialized JSON (bytes), so a cache hit is returned to the client
+as-is without being decoded and re-encoded. Redis is optional: when it is
+unreachable the cache backs off and retries later instead of failing requests.
+"""
 from __future__ import annotations
 
-import json
+import asyncio
 import logging
-from typing import Any, Optional
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Iterator, Optional
 
 import redis.asyncio as redis
 from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import TimeoutError as RedisTimeoutError
 
 from app.core.config import get_settings
+from app.services import telemetry
 
 logger = logging.getLogger(__name__)
 settings = get_settings()
 _redis: Optional[redis.Redis] = None
-_redis_available: bool = True
+_redis_retry_at: float = 0.0  # Redis 不可用时，下次重连的时间点
+_redis_backoff: float = 0.0
+
+REDIS_BACKOFF_INITIAL = 1.0
+REDIS_BACKOFF_MAX = 60.0
+LOCAL_INVALIDATION_KEY = "cache:local-invalidation"  # 每次失效后递增，通知其他进程清空本地缓存层
+
+_local: OrderedDict[str, tuple[float, bytes]] = OrderedDict()  # key -> (过期时间, JSON)
+_key_namespace: Optional[str] = None  # 只读快照模式下为当前快照 ID，切换快照后旧缓存键不再被读取
+_local_invalidation: Optional[bytes] = None  # 本进程最近看到的失效计数
+_local_synced_at: float = 0.0
+_inflight: dict[str, asyncio.Future] = {}
+_force_refresh: ContextVar[bool] = ContextVar("force_refresh", default=False)
 
 
 def get_redis_client() -> Optional[redis.Redis]:
-    global _redis, _redis_available
-    if not _redis_available:
+    global _redis
+    if time.monotonic() < _redis_retry_at:
         return None
     if _redis is None:
-        _redis = redis.from_url(settings.redis_url, encoding="utf-8", decode_responses=True)
+        _redis = redis.from_url(
+            settings.redis_url,
+            decode_responses=False,
+            socket_connect_timeout=settings.redis_connect_timeout_seconds,
+        )
     return _redis
 
 
-async def cache_get(key: str) -> Optional[Any]:
+def _local_get(key: str) -> Optional[bytes]:
+    entry = _local.get(key)
+    if entry is None:
+        return None
+    expires_at, value = entry
+    if expires_at < time.monotonic():
+        del _local[key]
+        return None
+    _local.move_to_end(key)
+    return value
+
+
+def _local_set(key: str, value: bytes, ttl: Optional[int] = None) -> None:
+    ttl = min(ttl or settings.cache_ttl_seconds, settings.local_cache_ttl_seconds)
+    _local[key] = (time.monotonic() + ttl, value)
+    _local.move_to_end(key)
+    while len(_local) > settings.local_cache_max_entries:
+        _local.popitem(last=False)
+
+
+async def _sync_local_tier() -> None:
+    """其他进程失效缓存后会递增 Redis 中的失效计数；发现计数变化时清空本进程的本地缓存层
+
+    至多每 local_cache_sync_seconds 检查一次，本地命中仍无需网络往返。
+    """
+    global _local_invalidation, _local_synced_at
+    now = time.monotonic()
+    if now - _local_synced_at < settings.local_cache_sync_seconds:
+        return
+    _local_synced_at = now
+    client = get_redis_client()
+    if client is None:
+        return
+    try:
+        counter = await client.get(LOCAL_INVALIDATION_KEY)
+    except (RedisConnectionError, RedisTimeoutError) as exc:
+        logger.warning("Redis unavailable for GET (%s). Continuing without cache.", exc)
+        _disable_cache()
+        return
+    _redis_ok()
+    if counter != _local_invalidation:
+        _local.clear()
+        _local_invalidation = counter
+
+
+async def cache_get(key: str) -> Optional[bytes]:
+    await _sync_local_tier()
+    value = _local_get(key)
+    if value is not None:
+        telemetry.record_cache(key, "local_hit")
+        return value
     client = get_redis_client()
     if client is None:
+        telemetry.record_cache(key, "miss")
         return None
     try:
         raw = await client.get(key)
-    except RedisConnectionError as exc:
+    except (RedisConnectionError, RedisTimeoutError) as exc:
         logger.warning("Redis unavailable for GET (%s). Continuing without cache.", exc)
         _disable_cache()
+        telemetry.record_cache(key, "miss")
         return None
+    _redis_ok()
     if raw is None:
+        telemetry.record_cache(key, "miss")
         return None
-    return json.loads(raw)
+    telemetry.record_cache(key, "redis_hit")
+    _local_set(key, raw)
+    return raw
 
 
-async def cache_set(key: str, value: Any, ttl: Optional[int] = None) -> None:
+async def cache_set(key: str, value: bytes, ttl: Optional[int] = None) -> None:
+    _local_set(key, value, ttl)
     client = get_redis_client()
     if client is None:
         return
     try:
-        await client.set(key, json.dumps(value), ex=ttl or settings.cache_ttl_seconds)
-    except RedisConnectionError as exc:
+        await client.set(key, value, ex=ttl or settings.cache_ttl_seconds)
+    except (RedisConnectionError, RedisTimeoutError) as exc:
         logger.warning("Redis unavailable for SET (%s). Continuing without cache.", exc)
         _disable_cache()
+        return
+    _redis_ok()
+
 
+async def cached(key: str, compute: Callable[[], Awaitable[bytes]], ttl: Optional[int] = None) -> bytes:
+    """读取缓存；未命中时执行 compute 并写回。
 
-def cache_key(prefix: str, **kwargs: Any) -> str:
+    同一 key 的并发未命中会合并为一次 compute（single-flight），其余请求等待其结果。
+    在 force_refresh() 上下文中跳过缓存读取，直接重算并覆盖。
+    """
+    await _sync_local_tier()
+    if not _force_refresh.get():
+        value = _local_get(key)
+        if value is not None:
+            telemetry.record_cache(key, "local_hit")
+            return value
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_load(key, compute, ttl))
+        _inflight[key] = task
+        task.add_done_callback(lambda done: _inflight.pop(key) if _inflight.get(key) is done else None)
+    else:
+        telemetry.record_cache(key, "coalesced")
+    # shield：某个请求断开时不取消其他请求共享的查询
+    return await asyncio.shield(task)
+
+
+async def _load(key: str, compute: Callable[[], Awaitable[bytes]], ttl: Optional[int]) -> bytes:
+    if not _force_refresh.get():
+        value = await cache_get(key)
+        if value is not None:
+            return value
+    else:
+        telemetry.record_cache(key, "refresh")
+    value = await compute()
+    await cache_set(key, value, ttl)
+    return value
+
+
+@contextmanager
+def force_refresh() -> Iterator[None]:
+    """在该上下文中调用 cached() 时忽略已有缓存，重新计算并写回（用于缓存预热）"""
+    token = _force_refresh.set(True)
+    try:
+        yield
+    finally:
+        _force_refresh.reset(token)
+
+
+def cache_key(prefix: str, **kwargs: object) -> str:
+    if _key_namespace is not None:
+        kwargs["snapshot"] = _key_namespace
     parts = [prefix] + [f"{k}={v}" for k, v in sorted(kwargs.items())]
     return "|".join(parts)
 
 
+def set_key_namespace(namespace: Optional[str]) -> None:
+    """切换到新的数据快照：之后的缓存键带上快照 ID，并丢弃本进程内旧快照的缓存"""
+    global _key_namespace
+    if namespace != _key_namespace:
+        _key_namespace = namespace
+        _local.clear()
+
+
+def parse_cache_key(key: str) -> tuple[str, dict[str, str]]:
+    prefix, *parts = key.split("|")
+    return prefix, dict(part.split("=", 1) for part in parts if "=" in part)
+
+
+async def cache_delete_matching(predicate: Callable[[str, dict[str, str]], bool]) -> int:
+    """删除 predicate(prefix, params) 为真的缓存键（本地与 Redis），返回删除数量
+
+    其他进程的本地缓存层无法逐键删除：递增 Redis 中的失效计数，它们在下次检查时整体清空本地层。
+    """
+    global _local_invalidation
+    deleted = 0
+    for key in list(_local):
+        if predicate(*parse_cache_key(key)):
+            del _local[key]
+            deleted += 1
+    client = get_redis_client()
+    if client is None:
+        return deleted
+    try:
+        async for key in client.scan_iter(count=500):
+            if key.decode() == LOCAL_INVALIDATION_KEY:
+                continue
+            prefix, params = parse_cache_key(key.decode())
+            if predicate(prefix, params):
+                deleted += await client.delete(key)
+        previous = _local_invalidation
+        counter = await client.incr(LOCAL_INVALIDATION_KEY)
+        if int(previous or 0) + 1 == counter:
+            # 期间没有其他进程失效：本进程已逐键删除，无需清空本地层
+            _local_invalidation = str(counter).encode()
+    except (RedisConnectionError, RedisTimeoutError) as exc:
+        logger.warning("Redis unavailable for invalidation (%s). Continuing without cache.", exc)
+        _disable_cache()
+    return deleted
+
+
+def _redis_ok() -> None:
+    global _redis_backoff
+    _redis_backoff = 0.0
+
+
 def _disable_cache() -> None:
-    global _redis, _redis_available
+    """暂停使用 Redis，按指数退避在稍后重连"""
+    global _redis, _redis_retry_at, _redis_backoff
     _redis = None
-    _redis_available = False # 禁用 Redis 缓存
-
+    _redis_backoff = min(max(_redis_backoff * 2, REDIS_BACKOFF_INITIAL), REDIS_BACKOFF_MAX)
+    _redis_retry_at = time.monotonic() + _redis_backoff
@@ -1,25 +1,457 @@
 """DuckDB-powered data service."""
 from __future__ import annotations
 
-from functools import lru_cache
+import hashlib
+import itertools
+import json
+import logging
+import math
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from functools import lru_cache, wraps
 from pathlib import Path
-from typing import Any, Literal
+from typing import Any, Callable, Literal, TypeVar
 
 import duckdb
 
 from app.core.config import get_settings
+from app.services import telemetry
 
+logger = logging.getLogger(__name__)
 settings = get_settings()
 
+# 派生表（user_stats、events.segment_mask、rollup、排行榜）结构或分群规则变化时递增，强制重建
+DERIVED_TABLES_VERSION = 8
+# events 表物理布局版本（按 timestamp 排序）；与库中记录不一致时启动时重写一次
+EVENTS_LAYOUT = "compact-timestamp-sorted-v2"
+# 只读挂载的快照须由结构相同的代码构建（见 app.services.snapshot）
+SNAPSHOT_FORMAT = f"derived-v{DERIVED_TABLES_VERSION}/{EVENTS_LAYOUT}"
+
+# events.event 的 ENUM 取值（按 1 字节编码存储）；与 ENUM 列比较的字面量与参数须显式转换为 event_type，
+# 否则 DuckDB 会把整列转换为 VARCHAR 再比较
+EVENT_TYPES = ("view", "addtocart", "transaction")
+
+# rollup 表名 -> [(维度列名, 取值表达式, 列类型)]
+ROLLUP_DIMENSIONS: dict[str, list[tuple[str, str, str]]] = {
+    "event_rollup": [
+        ("event_date", "e.event_date", "DATE"),
+        ("hour", "e.hour", "INTEGER"),
+        ("event", "e.event", "VARCHAR"),
+    ],
+    "itemid_rollup": [
+        ("event_date", "e.event_date", "DATE"),
+        ("event", "e.event", "VARCHAR"),
+        ("entity_id", "e.itemid", "BIGINT"),
+    ],
+    "categoryid_rollup": [
+        ("event_date", "e.event_date", "DATE"),
+        ("event", "e.event", "VARCHAR"),
+        ("entity_id", "e.categoryid", "BIGINT"),
+    ],
+}
+
+# Top N 排行榜表名 -> 来源 rollup 表：每个分群 × 事件 × 时间块只保存前 TOP_ENTITY_DEPTH 名，
+# entity_id 为 NULL 的行记录该块中其余实体计数的上界。时间块按 2 的幂天数对齐（1、2、4 … 天），
+# 任意日期范围都能拆成少量互不重叠的块，合并后若能证明结果精确则不必再聚合 rollup 表
+LEADERBOARD_SOURCES: dict[str, str] = {
+    "itemid_leaders": "itemid_rollup",
+    "categoryid_leaders": "categoryid_rollup",
+}
+TOP_ENTITY_MAX_LIMIT = 30  # 与 /top-items、/top-categories 的 limit 上限一致
+TOP_ENTITY_MARGIN = 98  # 额外保存的名次：块间排名不一致时仍能覆盖合并后的前 N 名
+TOP_ENTITY_DEPTH = TOP_ENTITY_MAX_LIMIT + TOP_ENTITY_MARGIN
+LEADERBOARD_LEVELS = 10  # 时间块层级 0..9，最大块为 512 天
+
+# user_stats.activity_months 为 UBIGINT 位图：第 i 位表示访客在 activity_base_month 之后第 i 个月有活动
+ACTIVITY_MONTH_BITS = 64
+
+# 近似去重（approx=true）使用的 HyperLogLog：2^HLL_PRECISION 个寄存器，寄存器取最大值即可合并
+HLL_PRECISION = 12
+HLL_REGISTERS = 1 << HLL_PRECISION
+HLL_ERROR_BOUND = round(1.04 / math.sqrt(HLL_REGISTERS), 4)  # 相对标准误差
+
+# 分群位掩码：user_stats.segment_mask / events.segment_mask 中的位；'All' 不占位
+SEGMENT_BITS: dict[str, int] = {"Hesitant": 1, "Impulsive": 2, "Collector": 4}
+SEGMENT_RULES: dict[str, str] = {
+    "Hesitant": """
+        view_count >= 10
+        AND COALESCE(transaction_count::DOUBLE / NULLIF(view_count, 0), 0) <= 0.05
+    """,
+    "Impulsive": """
+        transaction_count > 0
+        AND view_count >= 3
+        AND COALESCE(transaction_count::DOUBLE / NULLIF(view_count, 0), 0) >= 0.3
+        AND COALESCE(date_diff('hour', first_visit, first_purchase), 9999) <= 24
+    """,
+    "Collector": """
+        transaction_count > 0
+        AND addtocart_count >= 5
+        AND COALESCE(transaction_count::DOUBLE / NULLIF(view_count, 0), 0) >= 0.1
+    """,
+}
+
+# 未指定日期范围时使用的边界：日期过滤条件始终存在，同一接口的查询文本不随参数变化
+DATE_MIN = date(1, 1, 1)
+DATE_MAX = date(9999, 12, 30)
+
+# 按 (分群, 日期范围) 物化的过滤结果所在的内存库：挂载在数据库实例上，所有游标共享，只读模式下同样可写
+FILTER_CACHE_DATABASE = "filter_cache"
+_filter_table_ids = itertools.count()  # 表名在进程内唯一：同一文件上的多个 DataService 共享一个数据库实例
+
+# 每个游标上保留的预编译语句数（按最近使用淘汰）；过滤结果缓存表名不断变化，引用它们的 SQL 文本也随之变化
+MAX_PREPARED_STATEMENTS = 256
+# 过滤结果只在明显小于同日期范围的全部事件时缓存：按时间过滤本身可以按 zone map 跳过数据块，
+# 缓存的收益来自不再逐行检查其他分群的事件
+FILTER_CACHE_MAX_FRACTION = 0.5
+# 日期范围覆盖的事件不少于该比例时，按访客的聚合读取 visitor_events（全表扫描，但按访客连续）；
+# 更窄的范围按时间戳剪枝读取 events 更快
+VISITOR_EVENTS_MIN_FRACTION = 0.25
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def _drops_temp_tables(method: F) -> F:
+    """方法结束后清理其通过 _materialize 创建的临时表，并归还借用的过滤结果缓存表"""
+
+    @wraps(method)
+    def wrapper(self: "DataService", *args: Any, **kwargs: Any) -> Any:
+        # 可以嵌套调用（如 get_weekday_detail 内调用 get_weekday_users），只清理本次调用新增的部分
+        temp_start = len(getattr(self._local, "temp_tables", []))
+        lease_start = len(getattr(self._local, "filter_leases", []))
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            # 先删表再移出列表：列表非空时游标不会切换到新快照（见 DataService.con）
+            temp_tables = getattr(self._local, "temp_tables", [])
+            for table in temp_tables[temp_start:]:
+                self.con.execute(f"DROP TABLE IF EXISTS {table}")
+            del temp_tables[temp_start:]
+            leases = getattr(self._local, "filter_leases", [])
+            for relation in leases[lease_start:]:
+                self._release_filtered_relation(relation)
+            del leases[lease_start:]
+
+    return wrapper  # type: ignore[return-value]
+
+
+def _sql_literal(value: Any) -> str:
+    """将绑定参数编码为 SQL 字面量（EXECUTE 只接受字面量实参，不支持 ? 占位符）"""
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, datetime):
+        return f"TIMESTAMP '{value.isoformat(sep=' ')}'"
+    if isinstance(value, date):
+        return f"DATE '{value.isoformat()}'"
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    raise TypeError(f"Unsupported query parameter type: {type(value).__name__}")
+
+
+class _TrackedCursor:
+    """DuckDB 游标代理：记录每条 SQL 的执行耗时、扫描行数与取回行数（见 telemetry）
+
+    SELECT 的剖析信息在结果取回后才完整，因此查询语句在 fetch* 时记录，其余语句在 execute 后立即记录。
+    """
+
+    __slots__ = ("_cursor", "_profiling", "_pending", "_prepared", "_statement_ids", "__weakref__")
+
+    def __init__(self, cursor: duckdb.DuckDBPyConnection, profiling: bool) -> None:
+        self._cursor = cursor
+        self._profiling = profiling
+        # 尚未取回结果的查询 (SQL, 执行耗时, 参数)
+        self._pending: tuple[str, float, dict[str, Any] | None] | None = None
+        self._prepared: OrderedDict[str, str] = OrderedDict()  # SQL -> 该游标上的预编译语句名（按最近使用排序）
+        self._statement_ids = itertools.count()
+
+    def execute(self, query: str, parameters: Any = None) -> "_TrackedCursor":
+        start = time.perf_counter()
+        self._cursor.execute(query, parameters)
+        elapsed = time.perf_counter() - start
+        telemetry.record_execute(elapsed)
+        if query.lstrip().upper().startswith(("SELECT", "WITH")):
+            self._pending = (query, elapsed, parameters)
+        else:
+            self._pending = None
+            telemetry.record_query(query, elapsed, self._rows_scanned(), parameters)
+        return self
+
+    def run(self, query: str, params: dict[str, Any] | None = None) -> "_TrackedCursor":
+        """以预编译语句执行查询，参数以 $name 引用
+
+        同一 SQL 文本在每个游标上只 PREPARE 一次，之后的请求只需 EXECUTE 绑定新参数，
+        解析与规划的开销不随请求重复。DuckDB Python API 的 execute(sql, params) 每次调用都会重新
+        PREPARE，因此这里显式管理预编译语句。
+        """
+        start = time.perf_counter()
+        name = self._prepared.get(query)
+        if name is None:
+            name = f"stmt_{next(self._statement_ids)}"
+            self._cursor.execute(f"PREPARE {name} AS {query}")
+            self._prepared[query] = name
+            if len(self._prepared) > MAX_PREPARED_STATEMENTS:
+                _, evicted = self._prepared.popitem(last=False)
+                self._cursor.execute(f"DEALLOCATE {evicted}")
+        else:
+            self._prepared.move_to_end(query)
+        arguments = ", ".join(f"{key} := {_sql_literal(value)}" for key, value in (params or {}).items())
+        self._cursor.execute(f"EXECUTE {name}({arguments})" if arguments else f"EXECUTE {name}")
+        elapsed = time.perf_counter() - start
+        telemetry.record_execute(elapsed)
+        self._pending = (query, elapsed, params)
+        return self
+
+    def _rows_scanned(self) -> int | None:
+        if not self._profiling:
+            return None
+        try:
+            profile = json.loads(self._cursor.get_profiling_information(format="json"))
+        except (duckdb.Error, ValueError):
+            return None
+        return profile.get("cumulative_rows_scanned")
+
+    def _fetched(self, start: float, rows: int) -> None:
+        fetch_elapsed = time.perf_counter() - start
+        telemetry.record_fetch(fetch_elapsed, rows)
+        if self._pending is not None:
+            query, elapsed, params = self._pending
+            self._pending = None
+            telemetry.record_query(query, elapsed + fetch_elapsed, self._rows_scanned(), params)
+
+    def fetchone(self) -> tuple[Any, ...] | None:
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        if self._pending is not None and self._profiling:
+            # 结果取尽后剖析信息才完整；这里的 fetchone 都用于单行结果
+            self._cursor.fetchall()
+        self._fetched(start, 0 if row is None else 1)
+        return row
+
+    def fetchall(self) -> list[tuple[Any, ...]]:
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._fetched(start, len(rows))
+        return rows
+
+    def fetchnumpy(self) -> dict[str, Any]:
+        start = time.perf_counter()
+        columns = self._cursor.fetchnumpy()
+        self._fetched(start, len(next(iter(columns.values()), ())))
+        return columns
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+
+
+class _FilteredRelation:
+    """filter_cache 中按 (分群, 日期范围) 物化的过滤后事件"""
+
+    def __init__(self, table: str, rows: int, generation: int) -> None:
+        self.table = table
+        self.rows = rows
+        self.generation = generation  # 所属快照代号；切换快照后旧表随旧数据库实例释放
+        self.leases = 0  # 正在读取该表的调用数
+        self.evicted = False  # 已移出缓存，最后一个读取者归还时删除
+
+
+def _heavy_query(method: F) -> F:
+    """标记扫描事件明细的重查询：在独立的 worker 池中执行（见 executor.get_query_executor）"""
+    method.query_class = "heavy"  # type: ignore[attr-defined]
+    return method
+
+
+def _duckdb_config() -> dict[str, Any]:
+    """数据库实例级的线程数、内存上限与溢写设置（DuckDB 中这些设置对所有连接生效）"""
+    config: dict[str, Any] = {"threads": settings.duckdb_threads}
+    if settings.duckdb_memory_limit:
+        config["memory_limit"] = settings.duckdb_memory_limit
+    if settings.duckdb_temp_directory:
+        settings.duckdb_temp_directory.mkdir(parents=True, exist_ok=True)
+        config["temp_directory"] = str(settings.duckdb_temp_directory)
+    if settings.duckdb_max_temp_directory_size:
+        config["max_temp_directory_size"] = settings.duckdb_max_temp_directory_size
+    return config
+
+
+def _add_month(month: date) -> date:
+    """month（每月 1 日）的下一个月"""
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _month_index(base: date, day: date) -> int:
+    """day 所在月份相对 base 月份的偏移（activity_months 中的位序号）"""
+    return (day.year - base.year) * 12 + day.month - base.month
+
 
 class DataService:
-    """Encapsulates analytics queries against DuckDB."""
+    """Encapsulates analytics queries against DuckDB.
+
+    By default the database is opened read-write and derived tables are rebuilt
+    at startup when the event data changed. With ``read_only=True`` (worker
+    processes, see ``app.services.snapshot``) a published snapshot is attached
+    as-is and can be swapped for a newer one with ``reload_if_published``.
+    """
 
-    def __init__(self) -> None:
-        self.con = duckdb.connect(str(settings.duckdb_path))
-        self.con.execute("PRAGMA threads=4")
+    def __init__(self, database: Path | None = None, read_only: bool | None = None) -> None:
+        self._database = database or settings.duckdb_path
+        self.read_only = settings.duckdb_read_only if read_only is None else read_only
+        self.snapshot_id: str | None = None  # 只读模式下当前快照的 ID
+        self._data_version: str | None = None
+        self._snapshot_path: Path | None = None
+        self._generation = 0  # 每次切换快照递增，游标据此重建
+        self._local = threading.local()
+        self._cursors: dict[int, duckdb.DuckDBPyConnection] = {}  # 线程 id -> 原始游标（用于中断）
+        self._open_cursors: dict[int, int] = {}  # 代号 -> 仍打开的游标数
+        self._retired: dict[int, duckdb.DuckDBPyConnection] = {}  # 代号 -> 已被替换、仍有游标在用的快照实例
+        self._generation_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        # (分群, date_from, date_to) -> 过滤结果表，按最近使用排序；总行数不超过 FILTER_CACHE_MAX_ROWS
+        self._filter_cache: OrderedDict[tuple[str, str | None, str | None], _FilteredRelation] = OrderedDict()
+        self._filter_cache_rows = 0
+        self._filter_cache_lock = threading.Lock()
+        self._data_epoch = 0  # 每次导入提交后递增，物化期间数据变化的过滤结果不进入缓存
+        if self.read_only:
+            self._attach_snapshot()
+            return
+        self._db = self._connect(self._database)
+        self.con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS derived_state (
+                name VARCHAR PRIMARY KEY,
+                fingerprint VARCHAR
+            )
+            """
+        )
         self._init_events_table()
-        self._refresh_user_segments()
+        self._refresh_derived_tables()
+        self._data_version = self._get_state("derived_tables")
+
+    def _connect(self, path: Path) -> duckdb.DuckDBPyConnection:
+        db = duckdb.connect(str(path), read_only=self.read_only, config=_duckdb_config())
+        db.execute(f"ATTACH IF NOT EXISTS ':memory:' AS {FILTER_CACHE_DATABASE} (READ_WRITE)")
+        return db
+
+    @property
+    def con(self) -> _TrackedCursor:
+        """当前线程专属的 DuckDB 游标（共享同一个数据库实例）
+
+        切换快照后，各线程在下一次调用时改用新快照上的游标；正在使用临时表的调用继续用旧游标直到结束。
+        旧快照的最后一个游标关闭时，旧实例随之关闭。
+        """
+        cursor = getattr(self._local, "cursor", None)
+        if cursor is not None and self._local.generation != self._generation:
+            if not getattr(self._local, "temp_tables", None):
+                cursor.close()
+                self._local.release()
+                cursor = None
+        if cursor is None:
+            with self._generation_lock:
+                db, generation = self._db, self._generation
+                self._open_cursors[generation] = self._open_cursors.get(generation, 0) + 1
+            raw = db.cursor()
+            if settings.query_profiling_enabled:
+                # 仅收集扫描行数，剖析结果不输出
+                raw.execute("PRAGMA enable_profiling = 'no_output'")
+                raw.execute("""SET custom_profiling_settings = '{"CUMULATIVE_ROWS_SCANNED": "true"}'""")
+            cursor = _TrackedCursor(raw, settings.query_profiling_enabled)
+            self._local.cursor = cursor
+            self._local.generation = generation
+            # 游标关闭或随线程退出被回收时归还其代号的计数
+            self._local.release = weakref.finalize(cursor, self._release_generation, generation)
+            self._cursors[threading.get_ident()] = raw
+        return cursor
+
+    def _release_generation(self, generation: int) -> None:
+        """某代号的一个游标已关闭；若该代号的快照已被替换且不再有游标，关闭其数据库实例"""
+        with self._generation_lock:
+            remaining = self._open_cursors.pop(generation, 0) - 1
+            if remaining > 0:
+                self._open_cursors[generation] = remaining
+                return
+            db = self._retired.pop(generation, None)
+        if db is not None:
+            db.close()
+            logger.info("Closed replaced snapshot instance (generation %d).", generation)
+
+    @property
+    def data_version(self) -> str | None:
+        """当前数据的版本：只读模式下为快照 ID，否则为派生表指纹（每次导入后变化）；用于生成 HTTP ETag"""
+        return self.snapshot_id if self.read_only else self._data_version
+
+    def _attach_snapshot(self) -> None:
+        """以只读方式打开发布路径当前指向的快照文件，不做任何重建"""
+        path = self._database.resolve()
+        if not path.exists():
+            raise FileNotFoundError(
+                f"No published snapshot at {self._database}; run `python -m app.cli publish` first."
+            )
+        # DuckDB 按文件路径复用进程内的数据库实例，因此每个快照必须是不同的文件，而不是原地覆盖
+        db = self._connect(path)
+        try:
+            state = dict(db.execute("SELECT name, fingerprint FROM derived_state").fetchall())
+        except duckdb.CatalogException:
+            state = {}
+        if state.get("snapshot_format") != SNAPSHOT_FORMAT:
+            db.close()
+            raise RuntimeError(
+                f"{path} is not a snapshot in format {SNAPSHOT_FORMAT} (found {state.get('snapshot_format')}); "
+                "rebuild it with `python -m app.cli build-snapshot` or `publish`."
+            )
+        self._snapshot_path = path
+        self.snapshot_id = state.get("snapshot_id") or path.stem
+        with self._filter_cache_lock:
+            self._filter_cache.clear()
+            self._filter_cache_rows = 0
+        with self._generation_lock:
+            replaced = self._db if self._generation else None
+            self._db = db
+            if replaced is not None:
+                if self._open_cursors.get(self._generation):
+                    # 旧实例（及其中的过滤结果表）在最后一个旧游标关闭时关闭，见 _release_generation
+                    self._retired[self._generation] = replaced
+                    replaced = None
+            self._generation += 1
+        if replaced is not None:
+            replaced.close()
+        logger.info("Attached read-only snapshot %s (%s).", self.snapshot_id, path)
+
+    def reload_if_published(self) -> bool:
+        """只读模式下检查发布路径是否已指向新快照；是则切换（进行中的调用继续使用旧快照直到结束）"""
+        if not self.read_only or self._database.resolve() == self._snapshot_path:
+            return False
+        self._attach_snapshot()
+        return True
+
+    def stamp_snapshot(self, snapshot_id: str) -> None:
+        """记录快照 ID 与格式并写入检查点（构建进程发布快照前调用）"""
+        self._set_state("snapshot_id", snapshot_id)
+        self._set_state("snapshot_format", SNAPSHOT_FORMAT)
+        self.con.execute("CHECKPOINT")
+
+    def close(self) -> None:
+        for cursor in self._cursors.values():
+            cursor.close()
+        self._cursors.clear()
+        self._local = threading.local()
+        for db in self._retired.values():
+            db.close()
+        self._retired.clear()
+        self._open_cursors.clear()
+        self._db.close()
+
+    def interrupt(self, thread_id: int) -> None:
+        """中断指定 worker 线程上正在执行的查询"""
+        cursor = self._cursors.get(thread_id)
+        if cursor is not None:
+            cursor.interrupt()
 
     def _init_events_table(self) -> None:
         table_exists = self.con.execute(
@@ -30,6 +462,10 @@ class DataService:
             """
         ).fetchone()
         if table_exists:
+            if self._get_state("events_layout") != EVENTS_LAYOUT:
+                self._rewrite_events_table("events")
+            # 旧版本在 visitorid 上建的 ART 索引：按访客的聚合读取 visitor_events，该索引只会拖慢写入
+            self.con.execute("DROP INDEX IF EXISTS idx_events_segment")
             return
 
         source: Path
@@ -43,91 +479,794 @@ class DataService:
         if not source.exists():
             raise FileNotFoundError(f"Data source not found: {source}")
 
+        self._rewrite_events_table(f"{reader}($source)", {"source": source.as_posix()})
+
+    def _rewrite_events_table(self, relation: str, params: dict[str, Any] | None = None) -> None:
+        """按紧凑结构、按时间戳排序写入 events 表，使日期范围过滤可以利用 zone map 跳过行组
+
+        params 为 relation 中的绑定参数（如源文件路径）。
+        """
+        logger.info("Writing events table ordered by timestamp.")
+        event_types = ", ".join(f"'{event}'" for event in EVENT_TYPES)
+        self.con.execute(f"CREATE TYPE IF NOT EXISTS event_type AS ENUM ({event_types})")
         self.con.execute(
             f"""
-            CREATE TABLE events AS
-            SELECT *
-            FROM {reader}('{source.as_posix()}')
-            """
+            CREATE OR REPLACE TABLE events_sorted AS
+            {self._events_select(relation)}
+            ORDER BY timestamp
+            """,
+            params,
         )
-        self.con.execute("CREATE INDEX idx_events_segment ON events (visitorid)")
+        self.con.execute("DROP TABLE IF EXISTS events")
+        self.con.execute("ALTER TABLE events_sorted RENAME TO events")
+        self._set_state("events_layout", EVENTS_LAYOUT)
 
-    def _refresh_user_segments(self) -> None:
-        self.con.execute("DROP TABLE IF EXISTS user_stats")
-        self.con.execute(
-            """
-            CREATE TABLE user_stats AS
+    def _events_select(self, relation: str) -> str:
+        """将事件源（Parquet/CSV 或旧版 events 表）转换为 events 的紧凑结构
+
+        event 为 ENUM（1 字节），ID 为 INTEGER，并预先计算日期、小时与星期（1=周一 … 7=周日），
+        查询直接读取这些列，不再对每行做 CAST / EXTRACT。不在 EVENT_TYPES 中的事件类型会导致转换失败。
+        """
+        return f"""
+        SELECT
+            CAST(timestamp AS TIMESTAMP) AS timestamp,
+            CAST(visitorid AS INTEGER) AS visitorid,
+            CAST(event AS event_type) AS event,
+            CAST(itemid AS INTEGER) AS itemid,
+            CAST(categoryid AS INTEGER) AS categoryid,
+            CAST(timestamp AS DATE) AS event_date,
+            CAST(HOUR(timestamp) AS UTINYINT) AS hour,
+            CAST(ISODOW(timestamp) AS UTINYINT) AS weekday
+        FROM {relation}
+        """
+
+    def _get_state(self, name: str) -> str | None:
+        row = self.con.execute("SELECT fingerprint FROM derived_state WHERE name = ?", [name]).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, name: str, value: str) -> None:
+        self.con.execute("INSERT OR REPLACE INTO derived_state VALUES (?, ?)", [name, value])
+
+    def _source_fingerprint(self) -> str:
+        """事件数据的指纹：行数、最大时间戳及源文件大小/修改时间"""
+        row_count, max_timestamp = self.con.execute("SELECT COUNT(*), MAX(timestamp) FROM events").fetchone()
+        parts = [f"v{DERIVED_TABLES_VERSION}", str(row_count), str(max_timestamp)]
+        for source in (settings.data_source, settings.fallback_csv):
+            if source.exists():
+                stat = source.stat()
+                parts.append(f"{source.name}:{stat.st_size}:{int(stat.st_mtime)}")
+        return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+    def _refresh_derived_tables(self) -> None:
+        """仅在事件数据变化时重建 user_stats / 分群掩码 / rollup 表 / 排行榜"""
+        fingerprint = self._source_fingerprint()
+        if self._get_state("derived_tables") == fingerprint:
+            logger.info("Derived tables are up to date (fingerprint %s), skipping rebuild.", fingerprint[:12])
+            return
+        logger.info("Event data changed, rebuilding derived tables.")
+        self._refresh_user_segments()
+        self._refresh_visitor_events()
+        self._refresh_rollups()
+        self._refresh_leaderboards()
+        self._refresh_visitor_sketch()
+        self._set_state("derived_tables", fingerprint)
+
+    def _activity_base_month(self) -> date | None:
+        value = self._get_state("activity_base_month")
+        return date.fromisoformat(value) if value else None
+
+    def _set_activity_base_month(self) -> None:
+        """以最早事件所在月份作为 activity_months 位图的第 0 位"""
+        first_month = self.con.execute("SELECT DATE_TRUNC('month', MIN(timestamp))::DATE FROM events").fetchone()[0]
+        self._set_state("activity_base_month", str(first_month))
+
+    def _user_stats_select(self, where: str = "TRUE") -> str:
+        segment_mask = " | ".join(
+            f"CASE WHEN {SEGMENT_RULES[segment]} THEN {bit} ELSE 0 END" for segment, bit in SEGMENT_BITS.items()
+        )
+        month_index = f"date_diff('month', DATE '{self._activity_base_month()}', event_date)"
+        return f"""
+        SELECT *, ({segment_mask})::UTINYINT AS segment_mask
+        FROM (
             SELECT
                 visitorid,
-                SUM(CASE WHEN event = 'view' THEN 1 ELSE 0 END) AS view_count,
-                SUM(CASE WHEN event = 'addtocart' THEN 1 ELSE 0 END) AS addtocart_count,
-                SUM(CASE WHEN event = 'transaction' THEN 1 ELSE 0 END) AS transaction_count,
+                SUM(CASE WHEN event = 'view'::event_type THEN 1 ELSE 0 END) AS view_count,
+                SUM(CASE WHEN event = 'addtocart'::event_type THEN 1 ELSE 0 END) AS addtocart_count,
+                SUM(CASE WHEN event = 'transaction'::event_type THEN 1 ELSE 0 END) AS transaction_count,
                 MIN(timestamp)::TIMESTAMP AS first_visit,
-                MIN(CASE WHEN event = 'transaction' THEN timestamp END)::TIMESTAMP AS first_purchase
+                MIN(CASE WHEN event = 'transaction'::event_type THEN timestamp END)::TIMESTAMP AS first_purchase,
+                BIT_OR(
+                    CASE WHEN {month_index} BETWEEN 0 AND {ACTIVITY_MONTH_BITS - 1}
+                    THEN 1::UBIGINT << {month_index} ELSE 0::UBIGINT END
+                ) AS activity_months
             FROM events
+            WHERE {where}
             GROUP BY visitorid
-            """
         )
+        """
+
+    def _refresh_user_segments(self) -> None:
+        """重建 user_stats（含分群位掩码 segment_mask 与活跃月份位图 activity_months），并把分群掩码反范式化写入 events"""
+        self._set_activity_base_month()
+        self.con.execute("DROP TABLE IF EXISTS user_stats")
+        self.con.execute(f"CREATE TABLE user_stats AS {self._user_stats_select()}")
         self.con.execute("DROP TABLE IF EXISTS user_segments")
+        self.con.execute("ALTER TABLE events ADD COLUMN IF NOT EXISTS segment_mask UTINYINT")
+        self._update_event_segment_masks()
+
+    def _update_event_segment_masks(self, visitors: str | None = None) -> None:
+        """将 user_stats 中的分群掩码同步到 events；visitors 为访客表名时只更新这些访客
+
+        只改写掩码实际变化的行（新导入的行，以及分群发生变化的访客的历史行）。
+        """
+        visitor_clause = f"AND us.visitorid IN (SELECT visitorid FROM {visitors})" if visitors else ""
         self.con.execute(
+            f"""
+            UPDATE events
+            SET segment_mask = us.segment_mask
+            FROM user_stats us
+            WHERE events.visitorid = us.visitorid
+              AND events.segment_mask IS DISTINCT FROM us.segment_mask
+              {visitor_clause}
             """
-            CREATE TABLE user_segments AS
-            SELECT visitorid, 'All' AS segment FROM user_stats
-            UNION ALL
+        )
+
+    def _segment_predicate(self, segment: str, column: str = "segment_mask") -> str:
+        """分群过滤谓词：'All' 无需任何过滤，其余分群检查对应的位"""
+        if segment == "All":
+            return "TRUE"
+        return f"({column} & {SEGMENT_BITS[segment]}) <> 0"
+
+    def _segment_distribution(
+        self, relation: str, approx: bool = False, params: dict[str, Any] | None = None
+    ) -> dict[str, int]:
+        """统计关系中去重访客在各分群的分布（一个访客可同时属于多个分群）；params 为 relation 中引用的参数"""
+        if approx:
+            registers = f"""
+            SELECT s.segment, r.register, MAX(r.rho) AS rho
+            FROM ({self._hll_registers(relation, ["segment_mask"])}) r
+            JOIN {self._segment_bits()}
+              ON s.bit = 0 OR (r.segment_mask & s.bit) <> 0
+            GROUP BY ALL
+            """
+            rows = self.con.run(self._hll_estimate(registers, ["segment"]), params).fetchall()
+            estimates = dict(rows)
+            return {segment: int(estimates[segment]) for segment in settings.allowed_segments if estimates.get(segment)}
+        counts = ",\n            ".join(
+            f"COUNT(*) FILTER (WHERE {self._segment_predicate(segment)}) AS \"{segment}\""
+            for segment in settings.allowed_segments
+        )
+        cursor = self.con.run(
+            f"""
             SELECT
-                visitorid,
-                'Hesitant'
-            FROM user_stats
-            WHERE view_count >= 10
-              AND COALESCE(transaction_count::DOUBLE / NULLIF(view_count, 0), 0) <= 0.05
-            UNION ALL
+            {counts}
+            FROM (
+                SELECT DISTINCT visitorid, segment_mask
+                FROM {relation}
+            )
+            """,
+            params,
+        )
+        row = cursor.fetchone()
+        return {segment: int(count) for segment, count in zip(settings.allowed_segments, row) if count}
+
+    def _rollup_select(self, table: str, where: str = "TRUE") -> str:
+        """生成某张 rollup 表的聚合查询（维度见 ROLLUP_DIMENSIONS）
+
+        先按 segment_mask 聚合事件，再展开到各个分群，避免事件与分群表的连接。
+        """
+        dimensions = ",\n                ".join(f"{expr} AS {name}" for name, expr, _ in ROLLUP_DIMENSIONS[table])
+        return f"""
+        WITH by_mask AS (
             SELECT
-                visitorid,
-                'Impulsive'
-            FROM user_stats
-            WHERE transaction_count > 0
-              AND view_count >= 3
-              AND COALESCE(transaction_count::DOUBLE / NULLIF(view_count, 0), 0) >= 0.3
-              AND COALESCE(date_diff('hour', first_visit, first_purchase), 9999) <= 24
+                e.segment_mask,
+                {dimensions},
+                COUNT(*) AS event_count
+            FROM events e
+            WHERE {where}
+            GROUP BY ALL
+        )
+        SELECT
+            s.segment,
+            by_mask.* EXCLUDE (segment_mask, event_count),
+            SUM(by_mask.event_count) AS event_count
+        FROM by_mask
+        JOIN {self._segment_bits()}
+          ON s.bit = 0 OR (by_mask.segment_mask & s.bit) <> 0
+        GROUP BY ALL
+        """
+
+    def _segment_bits(self) -> str:
+        """分群名与位的常量表 s(segment, bit)；'All' 的 bit 为 0，匹配所有掩码"""
+        segments = ", ".join(f"('{segment}', {SEGMENT_BITS.get(segment, 0)})" for segment in settings.allowed_segments)
+        return f"(VALUES {segments}) s(segment, bit)"
+
+    def _hll_registers(self, relation: str, keys: list[str]) -> str:
+        """按 keys 分组计算访客的 HyperLogLog 寄存器 (keys..., register, rho)
+
+        visitorid 哈希的高 HLL_PRECISION 位选择寄存器，其余位中首个 1 的位置为 rho。
+        """
+        group = "".join(f"{key}, " for key in keys)
+        low_bits = 64 - HLL_PRECISION
+        return f"""
+        SELECT {group}register, MAX(rho)::UTINYINT AS rho
+        FROM (
+            SELECT
+                {group}
+                (hash(visitorid) >> {low_bits})::USMALLINT AS register,
+                bit_position('1'::BIT, (hash(visitorid) & {(1 << low_bits) - 1}::UBIGINT)::BIGINT::BIT) AS first_one,
+                CASE WHEN first_one = 0 THEN {low_bits + 1} ELSE first_one - {HLL_PRECISION} END AS rho
+            FROM {relation}
+        )
+        GROUP BY ALL
+        """
+
+    def _hll_estimate(self, registers: str, keys: list[str]) -> str:
+        """由寄存器估算去重访客数 (keys..., user_count)；基数较小时使用线性计数修正
+
+        rho 为无符号类型，取负前先转为有符号整数，否则 -rho 会回绕成很大的正数。
+        """
+        group = "".join(f"{key}, " for key in keys)
+        alpha = 0.7213 / (1 + 1.079 / HLL_REGISTERS)
+        return f"""
+        SELECT
+            {group}
+            ROUND(CASE
+                WHEN raw_estimate <= {2.5 * HLL_REGISTERS} AND empty_registers > 0
+                THEN {HLL_REGISTERS} * LN({HLL_REGISTERS} / empty_registers)
+                ELSE raw_estimate
+            END)::BIGINT AS user_count
+        FROM (
+            SELECT
+                {group}
+                {alpha * HLL_REGISTERS * HLL_REGISTERS} / (SUM(POW(2.0, -rho::INTEGER)) + {HLL_REGISTERS} - COUNT(*)) AS raw_estimate,
+                {HLL_REGISTERS} - COUNT(*) AS empty_registers
+            FROM ({registers})
+            GROUP BY ALL
+        )
+        """
+
+    def _approx_distinct(self, relation: str, keys: list[str]) -> str:
+        """近似 COUNT(DISTINCT visitorid)，按 keys 分组"""
+        return self._hll_estimate(self._hll_registers(relation, keys), keys)
+
+    def _visitor_sketch_select(self, where: str = "TRUE") -> str:
+        """每日 × 分群的访客 HLL 寄存器；任意日期范围的去重访客数只需合并寄存器"""
+        relation = f"(SELECT segment_mask, event_date, visitorid FROM events WHERE {where})"
+        return f"""
+        WITH by_mask AS (
+            {self._hll_registers(relation, ["segment_mask", "event_date"])}
+        )
+        SELECT s.segment, by_mask.event_date, by_mask.register, MAX(by_mask.rho) AS rho
+        FROM by_mask
+        JOIN {self._segment_bits()}
+          ON s.bit = 0 OR (by_mask.segment_mask & s.bit) <> 0
+        GROUP BY ALL
+        """
+
+    def _visitor_events_select(self, where: str = "TRUE") -> str:
+        return f"""
+        SELECT
+            DATE_TRUNC('month', us.first_visit)::DATE AS cohort_month,
+            e.visitorid,
+            e.timestamp,
+            e.event,
+            us.segment_mask,
+            e.event_date,
+            e.hour,
+            e.weekday
+        FROM events e
+        JOIN user_stats us ON e.visitorid = us.visitorid
+        WHERE {where}
+        ORDER BY cohort_month, e.visitorid, e.timestamp
+        """
+
+    def _refresh_visitor_events(self, visitors: str | None = None) -> None:
+        """构建 visitor_events：按 (首次访问月份, visitorid, 时间) 排序的事件投影
+
+        每个 cohort、每个访客的事件都连续存放：cohort 详情只读取该 cohort 的行块，按访客的聚合
+        （首次访问、去重计数）在连续的分组上进行，比在按时间排序的 events 上快约一倍（见 _visitor_events）。
+        visitors 为访客表名时只重写这些访客的事件（首次访问月份与分群只取决于访客自身的事件）。
+        """
+        if visitors is None:
+            self.con.execute(f"CREATE OR REPLACE TABLE visitor_events AS {self._visitor_events_select()}")
+            return
+        affected = f"visitorid IN (SELECT visitorid FROM {visitors})"
+        self.con.execute(f"DELETE FROM visitor_events WHERE {affected}")
+        self.con.execute(f"INSERT INTO visitor_events {self._visitor_events_select('e.' + affected)}")
+
+    def _refresh_visitor_sketch(self, dates: str | None = None) -> None:
+        """构建 visitor_sketch；dates 为日期表名时只重算这些日期（HLL 无法删除元素，受影响的日期整体重算）"""
+        if dates is None:
+            self.con.execute(f"CREATE OR REPLACE TABLE visitor_sketch AS {self._visitor_sketch_select()}")
+            return
+        self.con.execute(f"DELETE FROM visitor_sketch WHERE event_date IN (SELECT event_date FROM {dates})")
+        where = f"event_date IN (SELECT event_date FROM {dates})"
+        self.con.execute(f"INSERT INTO visitor_sketch {self._visitor_sketch_select(where)}")
+
+    def _refresh_rollups(self) -> None:
+        """全量重建预聚合表（segment × 日期 × 小时 × 事件，及商品/类别的日粒度计数）
+
+        增量导入不经过这里，而是按受影响访客合并正负增量（见 _ingest_events）。
+        """
+        for table, dimensions in ROLLUP_DIMENSIONS.items():
+            columns = ", ".join(f"{name} {column_type}" for name, _, column_type in dimensions)
+            self.con.execute(f"DROP TABLE IF EXISTS {table}")
+            self.con.execute(f"CREATE TABLE {table} (segment VARCHAR, {columns}, event_count BIGINT)")
+            self.con.execute(f"INSERT INTO {table} {self._rollup_select(table)}")
+
+    def _leaderboard_select(self, source: str, blocks: str | None = None) -> str:
+        """按时间块汇总实体 rollup 表，保留每块前 TOP_ENTITY_DEPTH 名及其余实体计数的上界
+
+        Args:
+            source: 实体 rollup 表
+            blocks: (level, block_start) 表名，只计算这些块；为 None 时计算全部
+        """
+        block_days = "(1 << l.level)"
+        block_filter = f"SEMI JOIN {blocks} USING (level, block_start)" if blocks else ""
+        return f"""
+        WITH blocks AS (
+            SELECT segment, event, level, block_start, entity_id, SUM(event_count) AS event_count
+            FROM (
+                SELECT
+                    r.segment,
+                    r.event,
+                    CAST(l.level AS INTEGER) AS level,
+                    DATE '1970-01-01'
+                        + CAST((r.event_date - DATE '1970-01-01') // {block_days} * {block_days} AS INTEGER) AS block_start,
+                    r.entity_id,
+                    r.event_count
+                FROM {source} r, range({LEADERBOARD_LEVELS}) l(level)
+            ) {block_filter}
+            GROUP BY ALL
+        ),
+        ranked AS (
+            SELECT
+                *,
+                row_number() OVER (
+                    PARTITION BY segment, event, level, block_start ORDER BY event_count DESC, entity_id
+                ) AS rank
+            FROM blocks
+        ),
+        leaders AS (
+            SELECT segment, event, level, block_start, entity_id, event_count
+            FROM ranked
+            WHERE rank <= {TOP_ENTITY_DEPTH}
             UNION ALL
             SELECT
-                visitorid,
-                'Collector'
-            FROM user_stats
-            WHERE transaction_count > 0
-              AND addtocart_count >= 5
-              AND COALESCE(transaction_count::DOUBLE / NULLIF(view_count, 0), 0) >= 0.1
+                segment, event, level, block_start, NULL,
+                COALESCE(MAX(event_count) FILTER (WHERE rank > {TOP_ENTITY_DEPTH}), 0)
+            FROM ranked
+            GROUP BY ALL
+        )
+        SELECT
+            segment,
+            event,
+            level,
+            block_start,
+            block_start + ((1 << level) - 1) AS block_end,
+            -- 上一级块的范围；最高一级没有上一级
+            CASE WHEN level < {LEADERBOARD_LEVELS - 1} THEN DATE '1970-01-01'
+                + CAST((block_start - DATE '1970-01-01') // (2 << level) * (2 << level) AS INTEGER) END AS parent_start,
+            parent_start + ((2 << level) - 1) AS parent_end,
+            entity_id,
+            CAST(event_count AS BIGINT) AS event_count
+        FROM leaders
+        """
+
+    def _refresh_leaderboards(self, dates: str | None = None) -> None:
+        """构建排行榜；dates 为日期表名时只重算包含这些日期的时间块"""
+        for table, source in LEADERBOARD_SOURCES.items():
+            if dates is None:
+                # 按查询的过滤列排序，读取某个分群 × 事件的块时可以按 zonemap 跳过其余数据
+                self.con.execute(
+                    f"CREATE OR REPLACE TABLE {table} AS {self._leaderboard_select(source)} "
+                    "ORDER BY segment, event, block_start, level"
+                )
+                continue
+            self.con.execute(
+                f"""
+                CREATE OR REPLACE TEMP TABLE leaderboard_blocks AS
+                SELECT DISTINCT
+                    CAST(l.level AS INTEGER) AS level,
+                    DATE '1970-01-01'
+                        + CAST((d.event_date - DATE '1970-01-01') // (1 << l.level) * (1 << l.level) AS INTEGER) AS block_start
+                FROM {dates} d, range({LEADERBOARD_LEVELS}) l(level)
+                """
+            )
+            self.con.execute(f"DELETE FROM {table} t USING leaderboard_blocks b WHERE t.level = b.level AND t.block_start = b.block_start")
+            self.con.execute(f"INSERT INTO {table} {self._leaderboard_select(source, 'leaderboard_blocks')}")
+            self.con.execute("DROP TABLE leaderboard_blocks")
+
+    def ingest_events(self, source: Path) -> dict[str, Any]:
+        """增量追加一批事件（Parquet/CSV），只更新受影响访客的统计、分群和 rollup
+
+        Returns:
+            本次导入的摘要，包括受影响的分群与日期范围（用于精确失效缓存）
+        """
+        if self.read_only:
+            raise RuntimeError("Database is opened read-only; publish new batches with `python -m app.cli publish`.")
+        if not source.exists():
+            raise FileNotFoundError(f"Data source not found: {source}")
+        reader = "read_parquet" if source.suffix == ".parquet" else "read_csv_auto"
+
+        with self._write_lock:
+            self.con.execute("BEGIN TRANSACTION")
+            try:
+                summary = self._ingest_events(f"{reader}($source)", {"source": source.as_posix()})
+                fingerprint = self._source_fingerprint()
+                self._set_state("derived_tables", fingerprint)
+                self.con.execute("COMMIT")
+            except Exception:
+                self.con.execute("ROLLBACK")
+                raise
+            self._data_version = fingerprint
+            self._data_epoch += 1
+            self._clear_filter_cache()
+        summary["source"] = str(source)
+        return summary
+
+    def _ingest_events(self, relation: str, params: dict[str, Any] | None = None) -> dict[str, Any]:
+        self.con.execute(f"CREATE OR REPLACE TEMP TABLE ingest_batch AS {self._events_select(relation)}", params)
+        rows = int(self.con.execute("SELECT COUNT(*) FROM ingest_batch").fetchone()[0])
+        if rows == 0:
+            return {"rows": 0, "visitors": 0, "new_visitors": 0, "reclassified": 0, "segments": [], "date_from": None, "date_to": None}
+
+        self.con.execute(
+            "CREATE OR REPLACE TEMP TABLE ingest_visitors AS SELECT DISTINCT visitorid FROM ingest_batch"
+        )
+        affected = "visitorid IN (SELECT visitorid FROM ingest_visitors)"
+        self.con.execute(
+            """
+            CREATE OR REPLACE TEMP TABLE ingest_old_masks AS
+            SELECT v.visitorid, us.segment_mask
+            FROM ingest_visitors v
+            LEFT JOIN user_stats us ON v.visitorid = us.visitorid
             """
         )
-        self.con.execute("CREATE INDEX idx_segments ON user_segments (segment, visitorid)")
+
+        # 旧的 rollup 贡献（按旧分群）记为负数
+        for table in ROLLUP_DIMENSIONS:
+            self.con.execute(
+                f"CREATE OR REPLACE TEMP TABLE {table}_delta AS "
+                f"SELECT * REPLACE (-event_count AS event_count) FROM ({self._rollup_select(table, 'e.' + affected)})"
+            )
+
+        self.con.execute("INSERT INTO events BY NAME SELECT * FROM ingest_batch")
+
+        # 受影响访客的 user_stats 按全部事件重算（活跃月份位图随之置位），并同步 events 上的分群掩码；
+        # 导入了早于位图起始月份的事件时，位图整体平移，需要全量重建 user_stats
+        batch_start = self.con.execute("SELECT MIN(event_date) FROM ingest_batch").fetchone()[0]
+        if batch_start < self._activity_base_month():
+            self._set_activity_base_month()
+            self.con.execute(f"CREATE OR REPLACE TABLE user_stats AS {self._user_stats_select()}")
+        else:
+            self.con.execute(f"DELETE FROM user_stats WHERE {affected}")
+            self.con.execute(f"INSERT INTO user_stats {self._user_stats_select(affected)}")
+        self._update_event_segment_masks("ingest_visitors")
+        self._refresh_visitor_events("ingest_visitors")
+
+        # 新的 rollup 贡献（按新分群）记为正数，与旧贡献相抵后合并回 rollup 表
+        for table, dimensions in ROLLUP_DIMENSIONS.items():
+            keys = ["segment"] + [name for name, _, _ in dimensions]
+            key_list = ", ".join(keys)
+            key_match = " AND ".join(f"r.{key} IS NOT DISTINCT FROM d.{key}" for key in keys)
+            self.con.execute(
+                f"INSERT INTO {table}_delta {self._rollup_select(table, 'e.' + affected)}"
+            )
+            self.con.execute(
+                f"""
+                CREATE OR REPLACE TEMP TABLE {table}_merged AS
+                SELECT {key_list}, SUM(event_count) AS event_count
+                FROM (
+                    SELECT r.* FROM {table} r SEMI JOIN {table}_delta d ON {key_match}
+                    UNION ALL
+                    SELECT * FROM {table}_delta
+                )
+                GROUP BY ALL
+                HAVING SUM(event_count) <> 0
+                """
+            )
+            self.con.execute(f"DELETE FROM {table} r USING {table}_delta d WHERE {key_match}")
+            self.con.execute(f"INSERT INTO {table} SELECT {key_list}, event_count FROM {table}_merged")
+
+        self.con.execute(
+            """
+            CREATE OR REPLACE TEMP TABLE ingest_reclassified AS
+            SELECT o.visitorid, o.segment_mask AS old_mask, us.segment_mask AS new_mask
+            FROM ingest_old_masks o
+            JOIN user_stats us ON o.visitorid = us.visitorid
+            WHERE o.segment_mask IS NOT NULL AND o.segment_mask <> us.segment_mask
+            """
+        )
+        visitors = int(self.con.execute("SELECT COUNT(*) FROM ingest_visitors").fetchone()[0])
+        new_visitors = int(
+            self.con.execute("SELECT COUNT(*) FROM ingest_old_masks WHERE segment_mask IS NULL").fetchone()[0]
+        )
+        reclassified = int(self.con.execute("SELECT COUNT(*) FROM ingest_reclassified").fetchone()[0])
+        # 受影响分群：这些访客新旧掩码中出现过的所有分群
+        combined_mask = self.con.execute(
+            """
+            SELECT BIT_OR(COALESCE(o.segment_mask, 0) | us.segment_mask)
+            FROM ingest_old_masks o
+            JOIN user_stats us ON o.visitorid = us.visitorid
+            """
+        ).fetchone()[0] or 0
+        segments = sorted(
+            segment for segment in settings.allowed_segments
+            if segment == "All" or combined_mask & SEGMENT_BITS[segment]
+        )
+        # 受影响日期：新事件的日期，以及分群发生变化的访客的全部历史事件日期
+        self.con.execute(
+            """
+            CREATE OR REPLACE TEMP TABLE ingest_dates AS
+            SELECT event_date FROM ingest_batch
+            UNION
+            SELECT event_date FROM events
+            WHERE visitorid IN (SELECT visitorid FROM ingest_reclassified)
+            """
+        )
+        date_from, date_to = self.con.execute("SELECT MIN(event_date), MAX(event_date) FROM ingest_dates").fetchone()
+        self._refresh_leaderboards("ingest_dates")
+        self._refresh_visitor_sketch("ingest_dates")
+
+        temp_tables = ["ingest_batch", "ingest_visitors", "ingest_old_masks", "ingest_reclassified", "ingest_dates"]
+        temp_tables += [f"{table}_{suffix}" for table in ROLLUP_DIMENSIONS for suffix in ("delta", "merged")]
+        for table in temp_tables:
+            self.con.execute(f"DROP TABLE IF EXISTS {table}")
+
+        return {
+            "rows": rows,
+            "visitors": visitors,
+            "new_visitors": new_visitors,
+            "reclassified": reclassified,
+            "segments": segments,
+            "date_from": str(date_from),
+            "date_to": str(date_to),
+        }
+
+    def _segment_bit(self, segment: str) -> int:
+        """分群对应的位；'All' 为 0（不过滤）"""
+        return 0 if segment == "All" else SEGMENT_BITS[segment]
+
+    def _segment_filter(self, column: str = "segment_mask") -> str:
+        """参数化的分群过滤谓词（$segment_bit 为 0 时匹配所有访客）"""
+        return f"($segment_bit = 0 OR ({column} & $segment_bit) <> 0)"
+
+    def _rollup_filter(self) -> str:
+        """rollup 表的分群与日期过滤（参数见 _rollup_params）"""
+        return "segment = $segment AND event_date BETWEEN $date_from AND $date_to"
+
+    def _rollup_params(self, segment: str, date_from: str | None = None, date_to: str | None = None) -> dict[str, Any]:
+        return {
+            "segment": segment,
+            "date_from": date.fromisoformat(date_from) if date_from else DATE_MIN,
+            "date_to": date.fromisoformat(date_to) if date_to else DATE_MAX,
+        }
+
+    def _materialize(self, name: str, query: str, params: dict[str, Any] | None = None) -> str:
+        """将查询结果物化为当前游标上的临时表，供同一抽屉内的多个聚合复用（只扫描一次基础数据）
+
+        临时表名固定（每个游标独立），读取它的查询文本不随请求变化，可以复用预编译语句。
+        """
+        self.con.execute(f"CREATE OR REPLACE TEMP TABLE {name} AS {query}", params)
+        if not hasattr(self._local, "temp_tables"):
+            self._local.temp_tables = []
+        self._local.temp_tables.append(name)
+        return name
 
     def _filtered_events(self, segment: str, date_from: str | None = None, date_to: str | None = None) -> str:
-        base_query = f"""
+        """按分群与时间戳半开区间过滤的事件（参数见 _filter_params）
+
+        同一过滤条件的结果已物化在 filter_cache 中时读取缓存表；表中的行都满足条件，谓词照常保留，参数不变。
+        """
+        return f"""
         SELECT e.*
-        FROM events e
-        JOIN user_segments s
-          ON e.visitorid = s.visitorid
-        WHERE s.segment = '{segment}'
+        FROM {self._filtered_source(segment, date_from, date_to)} e
+        WHERE {self._segment_filter("e.segment_mask")}
+          AND e.timestamp >= $ts_from
+          AND e.timestamp < $ts_to
         """
-        if date_from:
-            base_query += f" AND CAST(e.timestamp AS DATE) >= '{date_from}'"
-        if date_to:
-            base_query += f" AND CAST(e.timestamp AS DATE) <= '{date_to}'"
-        return base_query
 
-    def get_segments(self) -> list[dict[str, Any]]:
-        rows = self.con.execute(
+    def _visitor_events(self, segment: str, date_from: str | None = None, date_to: str | None = None) -> str:
+        """与 _filtered_events 相同的过滤（参数相同），供按 visitorid 分组/去重的查询使用
+
+        只有 visitorid、timestamp、event、segment_mask、event_date、hour、weekday 列。过滤结果已缓存时读取缓存表；否则日期范围较宽时
+        读取按访客聚簇的 visitor_events，每个访客的行连续，分组与去重比在按时间排序的 events 上快约一倍。
+        """
+        source = self._filtered_source(segment, date_from, date_to)
+        if source == "events" and self._range_fraction(date_from, date_to) >= VISITOR_EVENTS_MIN_FRACTION:
+            source = "visitor_events"
+        return f"""
+        SELECT e.visitorid, e.timestamp, e.event, e.segment_mask, e.event_date, e.hour, e.weekday
+        FROM {source} e
+        WHERE {self._segment_filter("e.segment_mask")}
+          AND e.timestamp >= $ts_from
+          AND e.timestamp < $ts_to
+        """
+
+    def _range_fraction(self, date_from: str | None, date_to: str | None) -> float:
+        """日期范围内的事件占全部事件的比例（由 event_rollup 得出）"""
+        if not date_from and not date_to:
+            return 1.0
+        range_rows, total_rows = self.con.run(
             """
-            SELECT segment, COUNT(*) AS user_count
-            FROM (
-                SELECT DISTINCT visitorid, segment
-                FROM user_segments
-            )
-            GROUP BY segment
-            ORDER BY segment
+            SELECT
+                COALESCE(SUM(event_count) FILTER (WHERE event_date BETWEEN $date_from AND $date_to), 0),
+                COALESCE(SUM(event_count), 0)
+            FROM event_rollup
+            WHERE segment = $segment
+            """,
+            self._rollup_params("All", date_from, date_to),
+        ).fetchone()
+        return range_rows / total_rows if total_rows else 0.0
+
+    def _filtered_source(self, segment: str, date_from: str | None, date_to: str | None) -> str:
+        """过滤条件对应的事件来源：filter_cache 中的物化表，或无法缓存时的 events
+
+        某个过滤条件第一次被使用时扫描 events 并物化，之后所有方法、所有线程在该条件下都读取这张表。
+        借用的表在方法结束时归还（见 _drops_temp_tables），被淘汰的表等到没有调用在读取时才删除。
+        """
+        if settings.filter_cache_max_rows <= 0 or segment == "All":
+            return "events"  # 缓存已关闭，或只按日期过滤（直接按 zone map 跳过即可）
+        key = (segment, date_from or None, date_to or None)
+        with self._filter_cache_lock:
+            relation = self._filter_cache.get(key)
+            if relation is not None:
+                self._filter_cache.move_to_end(key)
+                relation.leases += 1
+        result = "hit"
+        if relation is None:
+            relation = self._cache_filtered_relation(key)
+            result = "miss" if relation is not None else "bypass"
+        telemetry.record_filter_cache(result)
+        if relation is None:
+            return "events"
+        if not hasattr(self._local, "filter_leases"):
+            self._local.filter_leases = []
+        self._local.filter_leases.append(relation)
+        return f"{FILTER_CACHE_DATABASE}.{relation.table}"
+
+    def _cache_filtered_relation(self, key: tuple[str, str | None, str | None]) -> _FilteredRelation | None:
+        """物化过滤结果并放入缓存（已借出一次）
+
+        行数（由 event_rollup 得出）超过缓存上限，或不明显少于同日期范围的全部事件时返回 None，由调用方直接读取 events。
+        """
+        segment, date_from, date_to = key
+        rows, range_rows = self.con.run(
             """
-        ).fetchall()
-        return [{"segment": row[0], "user_count": int(row[1])} for row in rows]
+            SELECT
+                COALESCE(SUM(event_count) FILTER (WHERE segment = $segment), 0),
+                COALESCE(SUM(event_count) FILTER (WHERE segment = 'All'), 0)
+            FROM event_rollup
+            WHERE segment IN ($segment, 'All') AND event_date BETWEEN $date_from AND $date_to
+            """,
+            self._rollup_params(segment, date_from, date_to),
+        ).fetchone()
+        if rows > settings.filter_cache_max_rows or rows > range_rows * FILTER_CACHE_MAX_FRACTION:
+            return None
+        generation, epoch = self._generation, self._data_epoch
+        relation = _FilteredRelation(f"filtered_{next(_filter_table_ids)}", int(rows), generation)
+        self.con.execute(
+            f"""
+            CREATE TABLE {FILTER_CACHE_DATABASE}.{relation.table} AS
+            SELECT e.*
+            FROM events e
+            WHERE {self._segment_filter("e.segment_mask")}
+              AND e.timestamp >= $ts_from
+              AND e.timestamp < $ts_to
+            """,
+            self._filter_params(segment, date_from, date_to),
+        )
+        relation.leases = 1
+        stale: list[_FilteredRelation] = []
+        with self._filter_cache_lock:
+            current = self._filter_cache.get(key)
+            if generation != self._generation or epoch != self._data_epoch:
+                relation.evicted = True  # 物化期间切换了快照或导入了新事件：只供本次调用使用
+            elif current is not None:
+                # 其他线程同时物化了同一条件：改用已缓存的表，本次的表归还后删除
+                current.leases += 1
+                self._filter_cache.move_to_end(key)
+                relation.leases = 0
+                stale.append(relation)
+                relation = current
+            else:
+                self._filter_cache[key] = relation
+                self._filter_cache_rows += relation.rows
+                stale += self._evict_filtered_relations(keep=key)
+        for evicted in stale:
+            self._drop_filtered_relation(evicted)
+        return relation
+
+    def _evict_filtered_relations(self, keep: tuple[str, str | None, str | None]) -> list[_FilteredRelation]:
+        """淘汰最久未使用的表直到总行数不超过上限；返回可以立即删除（无人读取）的表。调用方持有锁"""
+        droppable = []
+        for key in list(self._filter_cache):
+            if self._filter_cache_rows <= settings.filter_cache_max_rows:
+                break
+            if key == keep:
+                continue
+            relation = self._filter_cache.pop(key)
+            self._filter_cache_rows -= relation.rows
+            relation.evicted = True
+            if relation.leases == 0:
+                droppable.append(relation)
+        return droppable
+
+    def _release_filtered_relation(self, relation: _FilteredRelation) -> None:
+        with self._filter_cache_lock:
+            relation.leases -= 1
+            drop = relation.evicted and relation.leases == 0
+        if drop:
+            self._drop_filtered_relation(relation)
+
+    def _drop_filtered_relation(self, relation: _FilteredRelation) -> None:
+        if relation.generation == self._generation:
+            self.con.execute(f"DROP TABLE IF EXISTS {FILTER_CACHE_DATABASE}.{relation.table}")
+
+    def _clear_filter_cache(self) -> None:
+        """事件数据变化后清空过滤结果缓存（正在读取的表归还后删除）"""
+        with self._filter_cache_lock:
+            relations = list(self._filter_cache.values())
+            self._filter_cache.clear()
+            self._filter_cache_rows = 0
+            for relation in relations:
+                relation.evicted = True
+            droppable = [relation for relation in relations if relation.leases == 0]
+        for relation in droppable:
+            self._drop_filtered_relation(relation)
+
+    def _filter_params(self, segment: str, date_from: str | None = None, date_to: str | None = None) -> dict[str, Any]:
+        start = date.fromisoformat(date_from) if date_from else DATE_MIN
+        end = date.fromisoformat(date_to) + timedelta(days=1) if date_to else DATE_MAX
+        return {
+            "segment_bit": self._segment_bit(segment),
+            "ts_from": datetime.combine(start, datetime.min.time()),
+            "ts_to": datetime.combine(end, datetime.min.time()),
+        }
+
+    def _fetch_columns(self, query: str, params: dict[str, Any] | None = None) -> dict[str, list[Any]]:
+        """按列取回查询结果：DuckDB 直接产出 NumPy 列，整列转换为 Python 列表，避免逐行逐值转换"""
+        return {name: column.tolist() for name, column in self.con.run(query, params).fetchnumpy().items()}
+
+    def _fetch_records(self, query: str, params: dict[str, Any] | None = None) -> list[dict[str, Any]]:
+        """查询结果转换为记录列表，列名即字段名（类型与格式在 SQL 中确定）"""
+        columns = self._fetch_columns(query, params)
+        return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+    def _fetch_series(
+        self, query: str, label: str | None = None, params: dict[str, Any] | None = None
+    ) -> list[dict[str, Any]]:
+        """将 (period, [label,] value) 结果组装为折线序列；给定 label 时整个结果为单条序列"""
+        columns = self._fetch_columns(f"SELECT * REPLACE (CAST(period AS VARCHAR) AS period) FROM ({query})", params)
+        points = [{"period": period, "value": value} for period, value in zip(columns["period"], columns["value"])]
+        if label is not None:
+            return [{"label": label, "data": points}]
+        series: dict[str, list[dict[str, Any]]] = {}
+        for name, point in zip(columns["label"], points):
+            series.setdefault(name, []).append(point)
+        return [{"label": name, "data": data} for name, data in series.items()]
+
+    def _top_entity_records(
+        self, query: str, label_prefix: str, metric: str, params: dict[str, Any] | None = None
+    ) -> list[dict[str, Any]]:
+        """(entity_id, value) 的 Top N 结果补充展示名与指标后返回"""
+        return self._fetch_records(
+            f"""
+            SELECT
+                entity_id::BIGINT AS entity_id,
+                '{label_prefix} ' || entity_id AS label,
+                $metric AS metric,
+                value::BIGINT AS value
+            FROM ({query})
+            """,
+            {**(params or {}), "metric": metric},
+        )
+
+    def get_segments(self) -> list[dict[str, Any]]:
+        distribution = self._segment_distribution("user_stats")
+        return [{"segment": segment, "user_count": count} for segment, count in sorted(distribution.items())]
 
     def get_top_entities(
         self,
@@ -139,43 +1278,87 @@ class DataService:
         date_to: str | None = None,
     ) -> list[dict[str, Any]]:
         entity_field = "itemid" if entity == "item" else "categoryid"
+        params = {**self._rollup_params(segment, date_from, date_to), "row_limit": int(limit)}
+        label_prefix = "Item" if entity == "item" else "Category"
+        if limit <= TOP_ENTITY_MAX_LIMIT:
+            records = self._top_entity_records(self._leaderboard_query(f"{entity_field}_leaders"), label_prefix, metric, params)
+            if records:
+                return records
+        # 排行榜合并结果无法证明精确（或范围内没有事件）时，回退到完整的 rollup 聚合
         query = f"""
-        WITH filtered AS (
-            {self._filtered_events(segment, date_from, date_to)}
-        )
         SELECT
-            {entity_field} AS entity_id,
-            COUNT(*) AS value
-        FROM filtered
-        WHERE event = '{metric}'
+            entity_id,
+            SUM(event_count) AS value
+        FROM {entity_field}_rollup
+        WHERE {self._rollup_filter()}
+          AND event = $metric
         GROUP BY 1
         ORDER BY value DESC
-        LIMIT {limit}
+        LIMIT $row_limit
+        """
+        return self._top_entity_records(query, label_prefix, metric, params)
+
+    def _leaderboard_query(self, table: str) -> str:
+        """合并日期范围内的排行榜时间块，只在能证明前 $row_limit 名精确时返回结果
+
+        选中的块是范围内包含的、上一级块不被范围包含的块，它们恰好不重叠地覆盖整个范围。
+        某实体的下界为其在各块前列中的计数之和，上界再加上它未进入前列的块的上界；
+        前 N 名的上下界都相等、且其余实体（含未进入任何前列的实体）的上界不超过第 N 名时，结果与完整聚合一致。
+        """
+        return f"""
+        WITH blocks AS (
+            SELECT
+                entity_id,
+                event_count,
+                MAX(event_count) FILTER (WHERE entity_id IS NULL) OVER (PARTITION BY level, block_start) AS block_bound,
+                SUM(event_count) FILTER (WHERE entity_id IS NULL) OVER () AS rest_bound
+            FROM {table}
+            WHERE segment = $segment
+              AND event = $metric
+              AND block_start >= $date_from
+              AND block_end <= $date_to
+              AND (parent_start IS NULL OR parent_start < $date_from OR parent_end > $date_to)
+        ),
+        scored AS (
+            SELECT
+                entity_id,
+                SUM(event_count) AS value,
+                SUM(event_count) + ANY_VALUE(rest_bound) - SUM(block_bound) AS upper_bound,
+                ANY_VALUE(rest_bound) AS rest_bound
+            FROM blocks
+            WHERE entity_id IS NOT NULL
+            GROUP BY 1
+        ),
+        ranked AS (
+            SELECT *, row_number() OVER (ORDER BY value DESC, entity_id) AS rank
+            FROM scored
+        ),
+        checked AS (
+            SELECT
+                *,
+                bool_and(upper_bound = value) FILTER (WHERE rank <= $row_limit) OVER () AS leaders_exact,
+                -- 不足 N 个候选时门槛为 0：必须没有任何遗漏的实体
+                CASE WHEN COUNT(*) OVER () >= $row_limit
+                    THEN MIN(value) FILTER (WHERE rank <= $row_limit) OVER () ELSE 0 END AS threshold,
+                GREATEST(COALESCE(MAX(upper_bound) FILTER (WHERE rank > $row_limit) OVER (), 0), rest_bound) AS others_bound
+            FROM ranked
+        )
+        SELECT entity_id, value
+        FROM checked
+        WHERE rank <= $row_limit AND leaders_exact AND others_bound <= threshold
+        ORDER BY rank
         """
-        rows = self.con.execute(query).fetchall()
-        label_prefix = "Item" if entity == "item" else "Category"
-        return [
-            {
-                "entity_id": int(row[0]),
-                "label": f"{label_prefix} {int(row[0])}",
-                "metric": metric,
-                "value": int(row[1]),
-            }
-            for row in rows
-        ]
 
     def get_funnel(self, segment: str, date_from: str | None = None, date_to: str | None = None) -> list[dict[str, Any]]:
         query = f"""
-        WITH filtered AS (
-            {self._filtered_events(segment, date_from, date_to)}
-        )
         SELECT
-            SUM(CASE WHEN event = 'view' THEN 1 ELSE 0 END) AS views,
-            SUM(CASE WHEN event = 'addtocart' THEN 1 ELSE 0 END) AS carts,
-            SUM(CASE WHEN event = 'transaction' THEN 1 ELSE 0 END) AS purchases
-        FROM filtered
+            SUM(CASE WHEN event = 'view' THEN event_count ELSE 0 END) AS views,
+            SUM(CASE WHEN event = 'addtocart' THEN event_count ELSE 0 END) AS carts,
+            SUM(CASE WHEN event = 'transaction' THEN event_count ELSE 0 END) AS purchases
+        FROM event_rollup
+        WHERE {self._rollup_filter()}
         """
-        views, carts, purchases = self.con.execute(query).fetchone()
+        views, carts, purchases = self.con.run(query, self._rollup_params(segment, date_from, date_to)).fetchone()
         view_count = max(int(views or 0), 1)
         return [
             {"stage": "浏览", "count": int(views or 0), "percentage": 100.0},
@@ -193,31 +1376,28 @@ class DataService:
 
     def get_active_hours(self, segment: str, date_from: str | None = None, date_to: str | None = None) -> list[dict[str, Any]]:
         query = f"""
-        WITH filtered AS (
-            {self._filtered_events(segment, date_from, date_to)}
-        )
         SELECT
-            EXTRACT(HOUR FROM timestamp) AS hour,
-            COUNT(*) AS value
-        FROM filtered
+            hour::INTEGER AS hour,
+            SUM(event_count)::BIGINT AS value
+        FROM event_rollup
+        WHERE {self._rollup_filter()}
         GROUP BY hour
         ORDER BY hour
         """
-        rows = self.con.execute(query).fetchall()
-        return [{"hour": int(row[0]), "value": int(row[1])} for row in rows]
+        return self._fetch_records(query, self._rollup_params(segment, date_from, date_to))
 
     def get_event_counts(self, segment: str, date_from: str | None = None, date_to: str | None = None) -> dict[str, int]:
         query = f"""
-        WITH filtered AS (
-            {self._filtered_events(segment, date_from, date_to)}
-        )
-        SELECT event, COUNT(*) AS value
-        FROM filtered
+        SELECT event, SUM(event_count) AS value
+        FROM event_rollup
+        WHERE {self._rollup_filter()}
         GROUP BY event
         """
-        rows = self.con.execute(query).fetchall()
+        rows = self.con.run(query, self._rollup_params(segment, date_from, date_to)).fetchall()
         return {row[0]: int(row[1]) for row in rows}
 
+    @_heavy_query
+    @_drops_temp_tables
     def get_drilldown(
         self,
         entity_type: Literal["item", "category"],
@@ -228,21 +1408,21 @@ class DataService:
     ) -> dict[str, Any]:
         field = "itemid" if entity_type == "item" else "categoryid"
         label_prefix = "商品" if entity_type == "item" else "类别"
-        query_base = f"""
+        base = self._materialize("drilldown_base", f"""
         WITH filtered AS (
             {self._filtered_events(segment, date_from, date_to)}
         )
         SELECT *
         FROM filtered
-        WHERE {field} = {entity_id}
-        """
+        WHERE {field} = $entity_id
+        """, {**self._filter_params(segment, date_from, date_to), "entity_id": int(entity_id)})
         # 基础统计
         summary_query = f"""
         SELECT event, COUNT(*) AS value
-        FROM ({query_base})
+        FROM {base}
         GROUP BY event
         """
-        summary_rows = self.con.execute(summary_query).fetchall()
+        summary_rows = self.con.run(summary_query).fetchall()
         summary = {row[0]: int(row[1]) for row in summary_rows}
         
         # 计算转化率
@@ -260,30 +1440,24 @@ class DataService:
         series_query = f"""
         SELECT
             date_trunc('week', timestamp) AS period,
-            event,
+            event::VARCHAR AS label,
             COUNT(*) AS value
-        FROM ({query_base})
+        FROM {base}
         GROUP BY 1, 2
         ORDER BY period
         """
-        series_rows = self.con.execute(series_query).fetchall()
-        series_map: dict[str, list[dict[str, Any]]] = {}
-        for period, event, value in series_rows:
-            key = event
-            # period 已经是 date 类型（date_trunc 返回 date），直接转换为字符串
-            series_map.setdefault(key, []).append({"period": str(period), "value": int(value)})
+        series = self._fetch_series(series_query)
         
         # 活跃时间段分布
         hourly_query = f"""
         SELECT
-            EXTRACT(HOUR FROM timestamp) AS hour,
+            hour,
             COUNT(*) AS count
-        FROM ({query_base})
+        FROM {base}
         GROUP BY hour
         ORDER BY hour
         """
-        hourly_rows = self.con.execute(hourly_query).fetchall()
-        hourly_distribution = [{"hour": int(row[0]), "count": int(row[1])} for row in hourly_rows]
+        hourly_distribution = self._fetch_records(hourly_query)
         
         # 转化漏斗
         funnel_stages = [
@@ -297,14 +1471,35 @@ class DataService:
             "entity_label": f"{label_prefix} {entity_id}",
             "segment": segment,
             "summary": summary,
-            "series": [
-                {"label": event, "data": points} for event, points in series_map.items()
-            ],
+            "series": series,
             "conversion_rates": conversion_rates,
             "hourly_distribution": hourly_distribution,
             "funnel": funnel_stages,
         }
 
+    def _stage_user_counts(self, relation: str, from_event: str, to_event: str, approx: bool = False) -> tuple[int, int]:
+        """两个漏斗阶段各自的独立用户数"""
+        params = {"from_event": from_event, "to_event": to_event}
+        if approx:
+            counts = dict(self.con.run(
+                self._approx_distinct(
+                    f"(SELECT event, visitorid FROM {relation} WHERE event IN ($from_event::event_type, $to_event::event_type))", ["event"]
+                ),
+                params,
+            ).fetchall())
+            return counts.get(from_event, 0), counts.get(to_event, 0)
+        return self.con.run(
+            f"""
+            SELECT
+                COUNT(DISTINCT visitorid) FILTER (WHERE event = $from_event::event_type) AS from_count,
+                COUNT(DISTINCT visitorid) FILTER (WHERE event = $to_event::event_type) AS to_count
+            FROM {relation}
+            """,
+            params,
+        ).fetchone()
+
+    @_heavy_query
+    @_drops_temp_tables
     def get_funnel_stage_detail(
         self,
         stage: Literal["view", "addtocart", "transaction"],
@@ -312,6 +1507,7 @@ class DataService:
         top_n: int = 10,
         date_from: str | None = None,
         date_to: str | None = None,
+        approx: bool = False,
     ) -> dict[str, Any]:
         """获取漏斗阶段的详细分析数据"""
         stage_mapping = {
@@ -320,19 +1516,23 @@ class DataService:
             "transaction": "购买",
         }
         stage_label = stage_mapping[stage]
+        # 流失分析需要上一阶段的用户，一并物化，避免再次扫描
+        previous_stage = {"addtocart": "view", "transaction": "addtocart"}.get(stage, stage)
         
-        query_base = f"""
+        base = self._materialize("stage_base", f"""
         WITH filtered AS (
             {self._filtered_events(segment, date_from, date_to)}
         )
         SELECT *
         FROM filtered
-        WHERE event = '{stage}'
-        """
+        WHERE event IN ($stage::event_type, $previous_stage::event_type)
+        """, {**self._filter_params(segment, date_from, date_to), "stage": stage, "previous_stage": previous_stage})
+        stage_events = f"(SELECT * FROM {base} WHERE event = $stage::event_type)"
+        stage_params = {"stage": stage}
         
         # 基础统计
-        count_query = f"SELECT COUNT(*) FROM ({query_base})"
-        count = int(self.con.execute(count_query).fetchone()[0])
+        count_query = f"SELECT COUNT(*) FROM {stage_events}"
+        count = int(self.con.run(count_query, stage_params).fetchone()[0])
         
         # 获取整体漏斗数据以计算百分比
         funnel_data = self.get_funnel(segment, date_from, date_to)
@@ -344,112 +1544,56 @@ class DataService:
         SELECT
             date_trunc('week', timestamp) AS period,
             COUNT(*) AS value
-        FROM ({query_base})
+        FROM {stage_events}
         GROUP BY period
         ORDER BY period
         """
-        series_rows = self.con.execute(series_query).fetchall()
-        time_series = [
-            {"label": stage, "data": [{"period": str(row[0]), "value": int(row[1])} for row in series_rows]}
-        ]
+        time_series = self._fetch_series(series_query, label=stage, params=stage_params)
         
         # 活跃时间段分布
         hourly_query = f"""
         SELECT
-            EXTRACT(HOUR FROM timestamp) AS hour,
+            hour,
             COUNT(*) AS count
-        FROM ({query_base})
+        FROM {stage_events}
         GROUP BY hour
         ORDER BY hour
         """
-        hourly_rows = self.con.execute(hourly_query).fetchall()
-        hourly_distribution = [{"hour": int(row[0]), "count": int(row[1])} for row in hourly_rows]
+        hourly_distribution = self._fetch_records(hourly_query, stage_params)
         
         # Top 商品
         top_items_query = f"""
         SELECT
             itemid AS entity_id,
             COUNT(*) AS value
-        FROM ({query_base})
+        FROM {stage_events}
         GROUP BY itemid
         ORDER BY value DESC
-        LIMIT {top_n}
+        LIMIT $row_limit
         """
-        top_items_rows = self.con.execute(top_items_query).fetchall()
-        top_items = [
-            {
-                "entity_id": int(row[0]),
-                "label": f"Item {int(row[0])}",
-                "metric": stage,
-                "value": int(row[1]),
-            }
-            for row in top_items_rows
-        ]
+        top_params = {**stage_params, "row_limit": int(top_n)}
+        top_items = self._top_entity_records(top_items_query, "Item", stage, top_params)
         
         # Top 类别
         top_categories_query = f"""
         SELECT
             categoryid AS entity_id,
             COUNT(*) AS value
-        FROM ({query_base})
+        FROM {stage_events}
         GROUP BY categoryid
         ORDER BY value DESC
-        LIMIT {top_n}
+        LIMIT $row_limit
         """
-        top_categories_rows = self.con.execute(top_categories_query).fetchall()
-        top_categories = [
-            {
-                "entity_id": int(row[0]),
-                "label": f"Category {int(row[0])}",
-                "metric": stage,
-                "value": int(row[1]),
-            }
-            for row in top_categories_rows
-        ]
+        top_categories = self._top_entity_records(top_categories_query, "Category", stage, top_params)
         
         # 用户群体分布（该阶段中各用户群体的占比）
-        user_segment_query = f"""
-        WITH filtered AS (
-            {self._filtered_events(segment, date_from, date_to)}
-        ),
-        stage_events AS (
-            SELECT DISTINCT visitorid
-            FROM filtered
-            WHERE event = '{stage}'
-        )
-        SELECT
-            s.segment,
-            COUNT(DISTINCT se.visitorid) AS count
-        FROM stage_events se
-        JOIN user_segments s ON se.visitorid = s.visitorid
-        GROUP BY s.segment
-        """
-        user_segment_rows = self.con.execute(user_segment_query).fetchall()
-        user_segment_distribution = {row[0]: int(row[1]) for row in user_segment_rows}
+        user_segment_distribution = self._segment_distribution(stage_events, approx, stage_params)
         
         # 流失分析（如果不是第一阶段）
         dropoff_analysis = None
         if stage == "addtocart":
             # 从浏览到加购的流失分析
-            dropoff_query = f"""
-            WITH filtered AS (
-                {self._filtered_events(segment, date_from, date_to)}
-            ),
-            views AS (
-                SELECT COUNT(DISTINCT visitorid) AS count
-                FROM filtered
-                WHERE event = 'view'
-            ),
-            carts AS (
-                SELECT COUNT(DISTINCT visitorid) AS count
-                FROM filtered
-                WHERE event = 'addtocart'
-            )
-            SELECT
-                (SELECT count FROM views) AS from_count,
-                (SELECT count FROM carts) AS to_count
-            """
-            dropoff_row = self.con.execute(dropoff_query).fetchone()
+            dropoff_row = self._stage_user_counts(base, "view", "addtocart", approx)
             if dropoff_row:
                 from_count = int(dropoff_row[0])
                 to_count = int(dropoff_row[1])
@@ -464,25 +1608,7 @@ class DataService:
                 }
         elif stage == "transaction":
             # 从加购到购买的流失分析
-            dropoff_query = f"""
-            WITH filtered AS (
-                {self._filtered_events(segment, date_from, date_to)}
-            ),
-            carts AS (
-                SELECT COUNT(DISTINCT visitorid) AS count
-                FROM filtered
-                WHERE event = 'addtocart'
-            ),
-            purchases AS (
-                SELECT COUNT(DISTINCT visitorid) AS count
-                FROM filtered
-                WHERE event = 'transaction'
-            )
-            SELECT
-                (SELECT count FROM carts) AS from_count,
-                (SELECT count FROM purchases) AS to_count
-            """
-            dropoff_row = self.con.execute(dropoff_query).fetchone()
+            dropoff_row = self._stage_user_counts(base, "addtocart", "transaction", approx)
             if dropoff_row:
                 from_count = int(dropoff_row[0])
                 to_count = int(dropoff_row[1])
@@ -508,8 +1634,11 @@ class DataService:
             "top_categories": top_categories,
             "user_segment_distribution": user_segment_distribution,
             "dropoff_analysis": dropoff_analysis,
+            "error_bound": HLL_ERROR_BOUND if approx else None,
         }
 
+    @_heavy_query
+    @_drops_temp_tables
     def get_active_hour_detail(
         self,
         hour: int,
@@ -517,23 +1646,24 @@ class DataService:
         top_n: int = 10,
         date_from: str | None = None,
         date_to: str | None = None,
+        approx: bool = False,
     ) -> dict[str, Any]:
         """获取指定时间段的详细分析数据"""
         if hour < 0 or hour > 23:
             raise ValueError("hour must be between 0 and 23")
         
-        query_base = f"""
+        base = self._materialize("hour_base", f"""
         WITH filtered AS (
             {self._filtered_events(segment, date_from, date_to)}
         )
         SELECT *
         FROM filtered
-        WHERE EXTRACT(HOUR FROM timestamp) = {hour}
-        """
+        WHERE hour = $hour
+        """, {**self._filter_params(segment, date_from, date_to), "hour": int(hour)})
         
         # 基础统计
-        count_query = f"SELECT COUNT(*) FROM ({query_base})"
-        total_count = int(self.con.execute(count_query).fetchone()[0])
+        count_query = f"SELECT COUNT(*) FROM {base}"
+        total_count = int(self.con.run(count_query).fetchone()[0])
         
         # 获取全天总数以计算百分比
         all_hours = self.get_active_hours(segment, date_from, date_to)
@@ -543,10 +1673,10 @@ class DataService:
         # 事件类型分布
         event_query = f"""
         SELECT event, COUNT(*) AS value
-        FROM ({query_base})
+        FROM {base}
         GROUP BY event
         """
-        event_rows = self.con.execute(event_query).fetchall()
+        event_rows = self.con.run(event_query).fetchall()
         event_distribution = {row[0]: int(row[1]) for row in event_rows}
         
         # 计算转化率
@@ -572,76 +1702,39 @@ class DataService:
         SELECT
             date_trunc('week', timestamp) AS period,
             COUNT(*) AS value
-        FROM ({query_base})
+        FROM {base}
         GROUP BY period
         ORDER BY period
         """
-        series_rows = self.con.execute(series_query).fetchall()
-        time_series = [
-            {"label": "活动量", "data": [{"period": str(row[0]), "value": int(row[1])} for row in series_rows]}
-        ]
+        time_series = self._fetch_series(series_query, label="活动量")
         
         # Top 商品
         top_items_query = f"""
         SELECT
             itemid AS entity_id,
             COUNT(*) AS value
-        FROM ({query_base})
+        FROM {base}
         GROUP BY itemid
         ORDER BY value DESC
-        LIMIT {top_n}
+        LIMIT $row_limit
         """
-        top_items_rows = self.con.execute(top_items_query).fetchall()
-        top_items = [
-            {
-                "entity_id": int(row[0]),
-                "label": f"Item {int(row[0])}",
-                "metric": "view",  # 默认使用 view，实际可以统计所有事件
-                "value": int(row[1]),
-            }
-            for row in top_items_rows
-        ]
+        top_params = {"row_limit": int(top_n)}
+        top_items = self._top_entity_records(top_items_query, "Item", "view", top_params)
         
         # Top 类别
         top_categories_query = f"""
         SELECT
             categoryid AS entity_id,
             COUNT(*) AS value
-        FROM ({query_base})
+        FROM {base}
         GROUP BY categoryid
         ORDER BY value DESC
-        LIMIT {top_n}
+        LIMIT $row_limit
         """
-        top_categories_rows = self.con.execute(top_categories_query).fetchall()
-        top_categories = [
-            {
-                "entity_id": int(row[0]),
-                "label": f"Category {int(row[0])}",
-                "metric": "view",
-                "value": int(row[1]),
-            }
-            for row in top_categories_rows
-        ]
+        top_categories = self._top_entity_records(top_categories_query, "Category", "view", top_params)
         
         # 用户群体分布
-        user_segment_query = f"""
-        WITH filtered AS (
-            {self._filtered_events(segment, date_from, date_to)}
-        ),
-        hour_events AS (
-            SELECT DISTINCT visitorid
-            FROM filtered
-            WHERE EXTRACT(HOUR FROM timestamp) = {hour}
-        )
-        SELECT
-            s.segment,
-            COUNT(DISTINCT he.visitorid) AS count
-        FROM hour_events he
-        JOIN user_segments s ON he.visitorid = s.visitorid
-        GROUP BY s.segment
-        """
-        user_segment_rows = self.con.execute(user_segment_query).fetchall()
-        user_segment_distribution = {row[0]: int(row[1]) for row in user_segment_rows}
+        user_segment_distribution = self._segment_distribution(base, approx)
         
         # 与相邻时间段和平均值对比
         prev_hour = (hour - 1) % 24
@@ -699,30 +1792,80 @@ class DataService:
             "top_categories": top_categories,
             "user_segment_distribution": user_segment_distribution,
             "comparison": comparison,
+            "error_bound": HLL_ERROR_BOUND if approx else None,
         }
 
-    def get_monthly_retention(
+    def _covers_first_month(self, date_from: str | None) -> bool:
+        """范围起点不晚于数据的第一个月（范围内的首次访问即全局首次访问）"""
+        base = self._activity_base_month()
+        return base is not None and (not date_from or date.fromisoformat(date_from) <= base)
+
+    def _activity_month_range(self, date_from: str | None, date_to: str | None) -> tuple[int, int] | None:
+        """将日期范围映射为 activity_months 的位区间 [lo, hi]
+
+        只有按整月对齐（或未指定）的范围才能用月份位图精确回答；否则返回 None，由调用方回退到扫描事件表。
+        范围与数据没有交集（如整个范围早于第一个数据月份）时返回空区间 (0, -1)，调用方据此直接返回空结果。
+        """
+        base = self._activity_base_month()
+        if base is None:
+            return None
+        start = date.fromisoformat(date_from) if date_from else base
+        end = date.fromisoformat(date_to) if date_to else None
+        if start.day != 1 or (end is not None and (end + timedelta(days=1)).day != 1):
+            return None
+        last_event_date = self.con.run("SELECT MAX(event_date) FROM event_rollup").fetchone()[0]
+        if last_event_date is None:
+            return None
+        if end is None or end > last_event_date:
+            end = last_event_date
+
+        lo, hi = max(_month_index(base, start), 0), _month_index(base, end)
+        if hi < lo:
+            return 0, -1
+        if hi >= ACTIVITY_MONTH_BITS:
+            return None
+        return lo, hi
+
+    def _activity_source(
+        self, segment: str, date_from: str | None, date_to: str | None, source: str | None
+    ) -> tuple[str, dict[str, Any]]:
+        """活跃记录来源 (SQL, 参数)：过滤后的事件，或调用方已物化的访客-日期表"""
+        if source is None:
+            return self._visitor_events(segment, date_from, date_to), self._filter_params(segment, date_from, date_to)
+        return f"SELECT * FROM {source}", {}
+
+    @_heavy_query
+    @_drops_temp_tables
+    def get_activity_widgets(
         self,
         segment: str,
         date_from: str | None = None,
         date_to: str | None = None,
-    ) -> list[dict[str, Any]]:
-        """获取月度用户留存率数据
-        
-        计算逻辑：
-        1. 找出每个用户的首次访问月份（cohort month）
-        2. 对于每个cohort，计算后续每个月的留存用户数和留存率
-        3. 返回每个cohort每月的留存率数据
+    ) -> dict[str, Any]:
+        """一次扫描同时计算月度留存与星期用户分布
+
+        两者只依赖“访客-日期”的活跃记录，物化一次后共享，避免重复扫描事件表。
         """
-        query = f"""
-        WITH filtered AS (
-            {self._filtered_events(segment, date_from, date_to)}
+        visitor_days = self._materialize("visitor_days", f"""
+            SELECT DISTINCT visitorid, event_date, weekday
+            FROM ({self._visitor_events(segment, date_from, date_to)})
+        """, self._filter_params(segment, date_from, date_to))
+        return {
+            "monthly-retention": self.get_monthly_retention(segment, date_from, date_to, source=visitor_days),
+            "weekday-users": self.get_weekday_users(segment, date_from, date_to, source=visitor_days),
+        }
+
+    def _retention_cells_from_events(self, filtered: str) -> str:
+        """从事件明细计算 cohort × 月份的留存人数（CTE 片段，产出 cohort_month_counts）"""
+        return f"""
+        filtered AS (
+            {filtered}
         ),
         -- 计算每个用户的首次访问月份
         user_first_month AS (
             SELECT
                 visitorid,
-                DATE_TRUNC('month', MIN(CAST(timestamp AS DATE))) AS first_month
+                DATE_TRUNC('month', MIN(event_date)) AS first_month
             FROM filtered
             GROUP BY visitorid
         ),
@@ -730,7 +1873,7 @@ class DataService:
         user_month_activity AS (
             SELECT DISTINCT
                 e.visitorid,
-                DATE_TRUNC('month', CAST(e.timestamp AS DATE)) AS activity_month
+                DATE_TRUNC('month', e.event_date) AS activity_month
             FROM filtered e
         ),
         -- 合并首次访问月份和活动月份
@@ -754,7 +1897,79 @@ class DataService:
                 COUNT(DISTINCT visitorid) AS user_count
             FROM user_cohorts
             GROUP BY cohort_month, month_diff, activity_month
+        )
+        """
+
+    def _retention_cells_from_bitsets(self) -> str:
+        """从 user_stats.activity_months 位图计算 cohort × 月份的留存人数（CTE 片段，产出 cohort_month_counts）
+
+        截取 [lo, hi] 位后，活跃月份完全相同的访客合并计数，只需展开少量位图，无需对事件去重。
+        参数见 _retention_bitset_params。
+        """
+        return f"""
+        patterns AS (
+            SELECT activity_months & $mask::UBIGINT AS bits, COUNT(*) AS visitors
+            FROM user_stats
+            WHERE {self._segment_filter()}
+            GROUP BY 1
+            HAVING bits <> 0
+        ),
+        -- 展开每种位图的活跃月份，最低位即首次访问月份
+        pattern_months AS (
+            SELECT
+                p.visitors,
+                m.month_index,
+                MIN(m.month_index) OVER (PARTITION BY p.bits) AS first_index
+            FROM patterns p
+            JOIN range($lo, $hi + 1) m(month_index) ON (p.bits >> m.month_index) & 1 = 1
         ),
+        cohort_month_counts AS (
+            SELECT
+                ($base_month + TO_MONTHS(first_index::INTEGER))::DATE AS cohort_month,
+                month_index - first_index AS month_diff,
+                ($base_month + TO_MONTHS(month_index::INTEGER))::DATE AS activity_month,
+                SUM(visitors) AS user_count
+            FROM pattern_months
+            GROUP BY ALL
+        )
+        """
+
+    def _retention_bitset_params(self, segment: str, lo: int, hi: int) -> dict[str, Any]:
+        return {
+            "mask": ((1 << (hi + 1)) - 1) ^ ((1 << lo) - 1),
+            "segment_bit": self._segment_bit(segment),
+            "lo": lo,
+            "hi": hi,
+            "base_month": self._activity_base_month(),
+        }
+
+    @_heavy_query
+    @_drops_temp_tables
+    def get_monthly_retention(
+        self,
+        segment: str,
+        date_from: str | None = None,
+        date_to: str | None = None,
+        source: str | None = None,
+    ) -> list[dict[str, Any]]:
+        """获取月度用户留存率数据
+        
+        计算逻辑：
+        1. 找出每个用户的首次访问月份（cohort month）
+        2. 对于每个cohort，计算后续每个月的留存用户数和留存率
+        3. 返回每个cohort每月的留存率数据
+        """
+        month_range = self._activity_month_range(date_from, date_to)
+        if month_range is not None and month_range[1] < month_range[0]:
+            return []
+        if month_range is not None:
+            cells = self._retention_cells_from_bitsets()
+            params = self._retention_bitset_params(segment, *month_range)
+        else:
+            filtered, params = self._activity_source(segment, date_from, date_to, source)
+            cells = self._retention_cells_from_events(filtered)
+        query = f"""
+        WITH {cells},
         -- 计算每个cohort的初始用户数（month_diff = 0）
         -- 对于month_diff=0，activity_month应该等于cohort_month，所以使用MAX确保获取一个值
         cohort_sizes AS (
@@ -765,12 +1980,12 @@ class DataService:
             WHERE month_diff = 0
             GROUP BY cohort_month
         ),
-        -- 计算每个实际月份的总活跃用户数（从user_cohorts直接计算，去重）
+        -- 计算每个实际月份的总活跃用户数（每个用户只属于一个cohort，各cohort人数相加即为去重人数）
         monthly_active_users AS (
             SELECT
                 activity_month::DATE AS actual_month,
-                COUNT(DISTINCT visitorid) AS total_active_users
-            FROM user_cohorts
+                SUM(user_count) AS total_active_users
+            FROM cohort_month_counts
             GROUP BY activity_month
         ),
         -- 计算留存率数据，使用cohort_month_counts中已有的activity_month
@@ -791,37 +2006,43 @@ class DataService:
         )
         -- 返回留存数据并关联实际月份的活跃用户数
         SELECT
-            rd.cohort_month,
-            rd.month_diff,
-            rd.user_count,
-            rd.cohort_size,
-            rd.retention_rate,
-            rd.actual_month,
-            COALESCE(mau.total_active_users, 0) AS monthly_active_users
+            rd.cohort_month::VARCHAR AS cohort_month,
+            rd.month_diff::INTEGER AS month_diff,
+            rd.user_count::BIGINT AS user_count,
+            rd.cohort_size::BIGINT AS cohort_size,
+            rd.retention_rate::DOUBLE AS retention_rate,
+            rd.actual_month::VARCHAR AS actual_month,
+            COALESCE(mau.total_active_users, 0)::BIGINT AS monthly_active_users
         FROM retention_data rd
         LEFT JOIN monthly_active_users mau ON rd.actual_month = mau.actual_month
         ORDER BY rd.cohort_month, rd.month_diff
         """
-        rows = self.con.execute(query).fetchall()
-        return [
-            {
-                "cohort_month": str(row[0]),
-                "month_diff": int(row[1]),
-                "user_count": int(row[2]),
-                "cohort_size": int(row[3]),
-                "retention_rate": float(row[4]),
-                "actual_month": str(row[5]),
-                "monthly_active_users": int(row[6]),
-            }
-            for row in rows
-        ]
+        return self._fetch_records(query, params)
 
 
+    def _exact_weekday_counts(self, filtered: str) -> str:
+        """按星期几统计独立用户数 (weekday, user_count)"""
+        return f"""
+        WITH filtered AS (
+            {filtered}
+        )
+        -- 按星期几统计独立用户数（weekday：1=周一，2=周二，...7=周日）
+        SELECT
+            weekday,
+            COUNT(DISTINCT visitorid) AS user_count
+        FROM filtered
+        GROUP BY weekday
+        """
+
+    @_heavy_query
+    @_drops_temp_tables
     def get_weekday_users(
         self,
         segment: str,
         date_from: str | None = None,
         date_to: str | None = None,
+        source: str | None = None,
+        approx: bool = False,
     ) -> dict[str, Any]:
         """获取周一到周日的用户数统计
         
@@ -829,37 +2050,24 @@ class DataService:
         1. 按星期几分组，统计每个星期几的独立用户数（去重）
         2. 计算工作日（周一到周五）的平均用户数
         3. 计算周末（周六、周日）的平均用户数
+
+        approx=True 时合并 visitor_sketch 中对应日期的 HLL 寄存器估算独立用户数，不扫描事件表。
         """
+        if approx:
+            registers = f"""
+            SELECT ISODOW(event_date) AS weekday, register, MAX(rho) AS rho
+            FROM visitor_sketch
+            WHERE {self._rollup_filter()}
+            GROUP BY ALL
+            """
+            weekday_counts = self._hll_estimate(registers, ["weekday"])
+            params = self._rollup_params(segment, date_from, date_to)
+        else:
+            filtered, params = self._activity_source(segment, date_from, date_to, source)
+            weekday_counts = self._exact_weekday_counts(filtered)
         query = f"""
-        WITH filtered AS (
-            {self._filtered_events(segment, date_from, date_to)}
-        ),
-        -- 提取每个用户在每个日期和星期几的唯一记录
-        weekday_data AS (
-            SELECT DISTINCT
-                visitorid,
-                CAST(timestamp AS DATE) AS visit_date,
-                EXTRACT(DOW FROM timestamp) AS day_of_week_raw
-            FROM filtered
-        ),
-        -- 转换为标准星期几格式（1=周一，2=周二，...7=周日）
-        weekday_normalized AS (
-            SELECT
-                visitorid,
-                visit_date,
-                CASE 
-                    WHEN day_of_week_raw = 0 THEN 7  -- 周日 -> 7
-                    ELSE day_of_week_raw::INTEGER  -- 周一(1)到周六(6)
-                END AS weekday
-            FROM weekday_data
-        ),
-        -- 按星期几统计独立用户数
-        weekday_counts AS (
-            SELECT
-                weekday,
-                COUNT(DISTINCT visitorid) AS user_count
-            FROM weekday_normalized
-            GROUP BY weekday
+        WITH weekday_counts AS (
+            {weekday_counts}
         ),
         -- 计算工作日平均（周一到周五）
         weekday_avg AS (
@@ -881,7 +2089,7 @@ class DataService:
         FROM weekday_counts wc
         ORDER BY wc.weekday
         """
-        rows = self.con.execute(query).fetchall()
+        rows = self.con.run(query, params).fetchall()
         
         # 获取平均值（从第一行读取，因为所有行的平均值相同）
         weekday_avg = float(rows[0][2]) if rows and rows[0][2] is not None else 0
@@ -900,12 +2108,68 @@ class DataService:
                 "user_count": weekday_data_map.get(i, 0),
             })
         
-        return {
+        result = {
             "data": result_data,
             "weekday_avg": round(weekday_avg, 2),
             "weekend_avg": round(weekend_avg, 2),
+            "error_bound": HLL_ERROR_BOUND if approx else None,
         }
+        return result
+
+    def _cohort_users_query(
+        self,
+        cohort_start: date,
+        segment: str,
+        date_from: str | None = None,
+        date_to: str | None = None,
+    ) -> tuple[str, dict[str, Any]]:
+        """筛选范围内首次访问月份为 cohort_start 的访客（visitorid, segment_mask），返回 (SQL, 参数)"""
+        if self._covers_first_month(date_from):
+            # 范围从数据起点开始：范围内的首次访问就是 user_stats.first_visit（不晚于范围终点时）
+            return f"""
+            SELECT visitorid, segment_mask
+            FROM user_stats
+            WHERE {self._segment_filter()}
+              AND first_visit >= $cohort_start
+              AND first_visit < $cohort_end
+              AND first_visit < $ts_to
+            """, {
+                "segment_bit": self._segment_bit(segment),
+                "ts_to": self._filter_params(segment, date_from, date_to)["ts_to"],
+                "cohort_start": datetime.combine(cohort_start, datetime.min.time()),
+                "cohort_end": datetime.combine(_add_month(cohort_start), datetime.min.time()),
+            }
+        month_range = self._activity_month_range(date_from, date_to)
+        if month_range is not None:
+            lo, hi = month_range
+            index = _month_index(self._activity_base_month(), cohort_start)
+            if not lo <= index <= hi:
+                return "SELECT visitorid, segment_mask FROM user_stats WHERE FALSE", {}
+            # 位区间 [lo, index) 全为 0 且第 index 位为 1，即首次活跃月份为该 cohort
+            return f"""
+            SELECT visitorid, segment_mask
+            FROM user_stats
+            WHERE {self._segment_filter()}
+              AND activity_months & $earlier_months::UBIGINT = 0
+              AND activity_months & $cohort_month_bit::UBIGINT <> 0
+            """, {
+                "segment_bit": self._segment_bit(segment),
+                "earlier_months": ((1 << index) - 1) ^ ((1 << lo) - 1),
+                "cohort_month_bit": 1 << index,
+            }
+        return f"""
+        SELECT us.visitorid, us.segment_mask
+        FROM (
+            SELECT visitorid
+            FROM ({self._visitor_events(segment, date_from, date_to)})
+            GROUP BY visitorid
+            HAVING DATE_TRUNC('month', MIN(timestamp)) = $cohort_start
+        ) cu
+        JOIN user_stats us ON cu.visitorid = us.visitorid
+        """, {**self._filter_params(segment, date_from, date_to), "cohort_start": cohort_start}
 
+    @_heavy_query
+    @_drops_temp_tables
     def get_cohort_detail(
         self,
         cohort_month: str,
@@ -934,80 +2198,36 @@ class DataService:
         except Exception:
             raise ValueError(f"Invalid cohort_month format: {cohort_month}")
         
-        query_base = f"""
-        WITH filtered AS (
-            {self._filtered_events(segment, date_from, date_to)}
-        ),
-        -- 找到cohort的所有用户（首次访问月份为该cohort_month）
-        user_first_month AS (
-            SELECT
-                visitorid,
-                DATE_TRUNC('month', MIN(CAST(timestamp AS DATE))) AS first_month
-            FROM filtered
-            GROUP BY visitorid
-        ),
-        -- 获取该cohort的用户列表
-        cohort_users AS (
-            SELECT DISTINCT visitorid
-            FROM user_first_month
-            WHERE DATE_TRUNC('month', first_month) = DATE_TRUNC('month', CAST('{cohort_month_date}' AS DATE))
-        ),
-        -- 获取cohort用户的所有事件
-        cohort_events AS (
-            SELECT e.*
-            FROM filtered e
-            JOIN cohort_users cu ON e.visitorid = cu.visitorid
-        )
-        SELECT *
-        FROM cohort_events
-        """
-        
+        cohort_start = date.fromisoformat(cohort_month_date).replace(day=1)
+        cohort_users = self._materialize("cohort_users", *self._cohort_users_query(cohort_start, segment, date_from, date_to))
+        # 获取cohort用户的所有事件（物化一次，供下面的多个聚合复用）：visitor_events 按首次访问月份聚簇，
+        # 范围从数据起点开始时只读取该 cohort 自身的行块；否则成员的全局首次访问月份不晚于该 cohort
+        # （此时 'All' 的成员就是该 cohort 中在范围终点前有事件的全部访客，无需再与成员表连接）
+        covers_first_month = self._covers_first_month(date_from)
+        first_cohort = cohort_start if covers_first_month else DATE_MIN
+        members = "" if covers_first_month and segment == "All" else f"SEMI JOIN {cohort_users} cu ON ve.visitorid = cu.visitorid"
+        filter_params = self._filter_params(segment, date_from, date_to)
+        cohort_events = self._materialize("cohort_detail_events", f"""
+        SELECT ve.visitorid, ve.timestamp, ve.event, ve.hour
+        FROM visitor_events ve
+        {members}
+        WHERE ve.cohort_month BETWEEN $first_cohort AND $cohort_start
+          AND ve.timestamp >= $ts_from
+          AND ve.timestamp < $ts_to
+        """, {
+            "ts_from": filter_params["ts_from"],
+            "ts_to": filter_params["ts_to"],
+            "first_cohort": first_cohort,
+            "cohort_start": cohort_start,
+        })
+        query_base = f"SELECT * FROM {cohort_events}"
+
         # 获取cohort的基本信息（cohort_size等）
-        cohort_info_query = f"""
-        WITH filtered AS (
-            {self._filtered_events(segment, date_from, date_to)}
-        ),
-        user_first_month AS (
-            SELECT
-                visitorid,
-                DATE_TRUNC('month', MIN(CAST(timestamp AS DATE))) AS first_month
-            FROM filtered
-            GROUP BY visitorid
-        ),
-        cohort_users AS (
-            SELECT DISTINCT visitorid
-            FROM user_first_month
-            WHERE DATE_TRUNC('month', first_month) = DATE_TRUNC('month', CAST('{cohort_month_date}' AS DATE))
-        )
-        SELECT COUNT(DISTINCT visitorid) AS cohort_size
-        FROM cohort_users
-        """
-        cohort_size_row = self.con.execute(cohort_info_query).fetchone()
-        cohort_size = int(cohort_size_row[0]) if cohort_size_row else 0
-        
-        # 获取当前留存用户数（在选定日期范围内仍有活动的用户）
-        current_active_query = f"""
-        WITH filtered AS (
-            {self._filtered_events(segment, date_from, date_to)}
-        ),
-        user_first_month AS (
-            SELECT
-                visitorid,
-                DATE_TRUNC('month', MIN(CAST(timestamp AS DATE))) AS first_month
-            FROM filtered
-            GROUP BY visitorid
-        ),
-        cohort_users AS (
-            SELECT DISTINCT visitorid
-            FROM user_first_month
-            WHERE DATE_TRUNC('month', first_month) = DATE_TRUNC('month', CAST('{cohort_month_date}' AS DATE))
-        )
-        SELECT COUNT(DISTINCT e.visitorid) AS active_users
-        FROM filtered e
-        JOIN cohort_users cu ON e.visitorid = cu.visitorid
-        """
-        current_active_row = self.con.execute(current_active_query).fetchone()
-        current_active_users = int(current_active_row[0]) if current_active_row else 0
+        cohort_size = int(self.con.run(f"SELECT COUNT(*) FROM {cohort_users}").fetchone()[0])
+
+        # 当前留存用户数（在选定日期范围内仍有活动的用户）：cohort 按筛选范围内的首次访问划分，
+        # 其成员在范围内必然有活动，因此等于 cohort_size
+        current_active_users = cohort_size
         current_retention_rate = round((current_active_users * 100 / cohort_size) if cohort_size > 0 else 0, 2)
         
         # 基础统计（事件计数）
@@ -1016,7 +2236,7 @@ class DataService:
         FROM ({query_base})
         GROUP BY event
         """
-        summary_rows = self.con.execute(summary_query).fetchall()
+        summary_rows = self.con.run(summary_query).fetchall()
         summary = {row[0]: int(row[1]) for row in summary_rows}
         
         # 计算转化率
@@ -1034,28 +2254,24 @@ class DataService:
         series_query = f"""
         SELECT
             date_trunc('week', timestamp) AS period,
-            event,
+            event::VARCHAR AS label,
             COUNT(*) AS value
         FROM ({query_base})
         GROUP BY 1, 2
         ORDER BY period
         """
-        series_rows = self.con.execute(series_query).fetchall()
-        series_map: dict[str, list[dict[str, Any]]] = {}
-        for period, event, value in series_rows:
-            series_map.setdefault(event, []).append({"period": str(period), "value": int(value)})
+        series = self._fetch_series(series_query)
         
         # 活跃时间段分布
         hourly_query = f"""
         SELECT
-            EXTRACT(HOUR FROM timestamp) AS hour,
+            hour,
             COUNT(*) AS count
         FROM ({query_base})
         GROUP BY hour
         ORDER BY hour
         """
-        hourly_rows = self.con.execute(hourly_query).fetchall()
-        hourly_distribution = [{"hour": int(row[0]), "count": int(row[1])} for row in hourly_rows]
+        hourly_distribution = self._fetch_records(hourly_query)
         
         # 转化漏斗
         funnel_stages = [
@@ -1065,31 +2281,7 @@ class DataService:
         ]
         
         # 用户群体分布（该cohort中各用户细分群体的分布）
-        user_segment_query = f"""
-        WITH filtered AS (
-            {self._filtered_events(segment, date_from, date_to)}
-        ),
-        user_first_month AS (
-            SELECT
-                visitorid,
-                DATE_TRUNC('month', MIN(CAST(timestamp AS DATE))) AS first_month
-            FROM filtered
-            GROUP BY visitorid
-        ),
-        cohort_users AS (
-            SELECT DISTINCT visitorid
-            FROM user_first_month
-            WHERE DATE_TRUNC('month', first_month) = DATE_TRUNC('month', CAST('{cohort_month_date}' AS DATE))
-        )
-        SELECT
-            s.segment,
-            COUNT(DISTINCT cu.visitorid) AS count
-        FROM cohort_users cu
-        JOIN user_segments s ON cu.visitorid = s.visitorid
-        GROUP BY s.segment
-        """
-        user_segment_rows = self.con.execute(user_segment_query).fetchall()
-        user_segment_distribution = {row[0]: int(row[1]) for row in user_segment_rows}
+        user_segment_distribution = self._segment_distribution(cohort_users)
         
         # 格式化cohort月份显示名称
         cohort_display = cohort_month[:7] if len(cohort_month) > 7 else cohort_month
@@ -1101,15 +2293,15 @@ class DataService:
             "current_retention_rate": current_retention_rate,
             "segment": segment,
             "summary": summary,
-            "series": [
-                {"label": event, "data": points} for event, points in series_map.items()
-            ],
+            "series": series,
             "conversion_rates": conversion_rates,
             "hourly_distribution": hourly_distribution,
             "funnel": funnel_stages,
             "user_segment_distribution": user_segment_distribution,
         }
 
+    @_heavy_query
+    @_drops_temp_tables
     def get_weekday_detail(
         self,
         weekday: int,
@@ -1117,6 +2309,7 @@ class DataService:
         top_n: int = 10,
         date_from: str | None = None,
         date_to: str | None = None,
+        approx: bool = False,
     ) -> dict[str, Any]:
         """获取指定星期几的详细分析数据
         
@@ -1130,32 +2323,22 @@ class DataService:
         if weekday < 1 or weekday > 7:
             raise ValueError("weekday must be between 1 and 7")
         
-        # 构建基础查询：筛选指定星期几的数据
-        # DuckDB 的 EXTRACT(DOW FROM timestamp) 返回：0=周日，1=周一，...6=周六
-        # 我们需要转换为：1=周一，2=周二，...7=周日
-        query_base = f"""
+        # 构建基础查询：筛选指定星期几的数据（events.weekday：1=周一，2=周二，...7=周日）
+        base = self._materialize("weekday_base", f"""
         WITH filtered AS (
             {self._filtered_events(segment, date_from, date_to)}
-        ),
-        weekday_normalized AS (
-            SELECT *,
-                CASE 
-                    WHEN EXTRACT(DOW FROM timestamp) = 0 THEN 7  -- 周日 -> 7
-                    ELSE EXTRACT(DOW FROM timestamp)::INTEGER  -- 周一(1)到周六(6)
-                END AS weekday
-            FROM filtered
         )
         SELECT *
-        FROM weekday_normalized
-        WHERE weekday = {weekday}
-        """
+        FROM filtered
+        WHERE weekday = $weekday
+        """, {**self._filter_params(segment, date_from, date_to), "weekday": int(weekday)})
         
         # 基础统计（事件总数）
-        count_query = f"SELECT COUNT(*) FROM ({query_base})"
-        total_count = int(self.con.execute(count_query).fetchone()[0])
+        count_query = f"SELECT COUNT(*) FROM {base}"
+        total_count = int(self.con.run(count_query).fetchone()[0])
         
         # 获取当前星期几的用户数和一周统计数据
-        weekday_users = self.get_weekday_users(segment, date_from, date_to)
+        weekday_users = self.get_weekday_users(segment, date_from, date_to, approx=approx)
         current_weekday_data = next((item for item in weekday_users["data"] if item["weekday"] == weekday), None)
         current_weekday_user_count = current_weekday_data["user_count"] if current_weekday_data else 0
         
@@ -1168,10 +2351,10 @@ class DataService:
         # 事件类型分布
         event_query = f"""
         SELECT event, COUNT(*) AS value
-        FROM ({query_base})
+        FROM {base}
         GROUP BY event
         """
-        event_rows = self.con.execute(event_query).fetchall()
+        event_rows = self.con.run(event_query).fetchall()
         event_distribution = {row[0]: int(row[1]) for row in event_rows}
         
         # 计算转化率
@@ -1193,100 +2376,57 @@ class DataService:
         ]
         
         # 24小时分布（该星期几的活跃时间段）
-        hourly_query = f"""
-        SELECT
-            EXTRACT(HOUR FROM timestamp) AS hour,
-            COUNT(DISTINCT visitorid) AS user_count
-        FROM ({query_base})
-        GROUP BY hour
-        ORDER BY hour
-        """
-        hourly_rows = self.con.execute(hourly_query).fetchall()
-        hourly_distribution = [{"hour": int(row[0]), "count": int(row[1])} for row in hourly_rows]
+        if approx:
+            hourly_users = self._approx_distinct(f"(SELECT hour, visitorid FROM {base})", ["hour"])
+        else:
+            hourly_users = f"""
+            SELECT
+                hour,
+                COUNT(DISTINCT visitorid) AS user_count
+            FROM {base}
+            GROUP BY hour
+            """
+        hourly_query = f"SELECT hour, user_count AS count FROM ({hourly_users}) ORDER BY hour"
+        hourly_distribution = self._fetch_records(hourly_query)
         
         # 时间序列数据（周度趋势）
         series_query = f"""
         SELECT
             date_trunc('week', timestamp) AS period,
             COUNT(*) AS value
-        FROM ({query_base})
+        FROM {base}
         GROUP BY period
         ORDER BY period
         """
-        series_rows = self.con.execute(series_query).fetchall()
-        time_series = [
-            {"label": "活动量", "data": [{"period": str(row[0]), "value": int(row[1])} for row in series_rows]}
-        ]
+        time_series = self._fetch_series(series_query, label="活动量")
         
         # Top 商品
         top_items_query = f"""
         SELECT
             itemid AS entity_id,
             COUNT(*) AS value
-        FROM ({query_base})
+        FROM {base}
         GROUP BY itemid
         ORDER BY value DESC
-        LIMIT {top_n}
+        LIMIT $row_limit
         """
-        top_items_rows = self.con.execute(top_items_query).fetchall()
-        top_items = [
-            {
-                "entity_id": int(row[0]),
-                "label": f"Item {int(row[0])}",
-                "metric": "view",
-                "value": int(row[1]),
-            }
-            for row in top_items_rows
-        ]
+        top_params = {"row_limit": int(top_n)}
+        top_items = self._top_entity_records(top_items_query, "Item", "view", top_params)
         
         # Top 类别
         top_categories_query = f"""
         SELECT
             categoryid AS entity_id,
             COUNT(*) AS value
-        FROM ({query_base})
+        FROM {base}
         GROUP BY categoryid
         ORDER BY value DESC
-        LIMIT {top_n}
+        LIMIT $row_limit
         """
-        top_categories_rows = self.con.execute(top_categories_query).fetchall()
-        top_categories = [
-            {
-                "entity_id": int(row[0]),
-                "label": f"Category {int(row[0])}",
-                "metric": "view",
-                "value": int(row[1]),
-            }
-            for row in top_categories_rows
-        ]
+        top_categories = self._top_entity_records(top_categories_query, "Category", "view", top_params)
         
         # 用户群体分布
-        user_segment_query = f"""
-        WITH filtered AS (
-            {self._filtered_events(segment, date_from, date_to)}
-        ),
-        weekday_normalized AS (
-            SELECT *,
-                CASE 
-                    WHEN EXTRACT(DOW FROM timestamp) = 0 THEN 7
-                    ELSE EXTRACT(DOW FROM timestamp)::INTEGER
-                END AS weekday
-            FROM filtered
-        ),
-        weekday_events AS (
-            SELECT DISTINCT visitorid
-            FROM weekday_normalized
-            WHERE weekday = {weekday}
-        )
-        SELECT
-            s.segment,
-            COUNT(DISTINCT we.visitorid) AS count
-        FROM weekday_events we
-        JOIN user_segments s ON we.visitorid = s.visitorid
-        GROUP BY s.segment
-        """
-        user_segment_rows = self.con.execute(user_segment_query).fetchall()
-        user_segment_distribution = {row[0]: int(row[1]) for row in user_segment_rows}
+        user_segment_distribution = self._segment_distribution(base, approx)
         
         # 对比分析：与工作日平均、周末平均、一周平均对比
         weekday_avg = weekday_users.get("weekday_avg", 0)
@@ -1347,6 +2487,7 @@ class DataService:
             "top_categories": top_categories,
             "user_segment_distribution": user_segment_distribution,
             "comparison": comparison,
+            "error_bound": HLL_ERROR_BOUND if approx else None,
         }
 
 
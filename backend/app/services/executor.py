@@ -0,0 +1,137 @@
+"""Bounded worker pools that keep DuckDB work off the asyncio event loop.
+
+Queries are split into classes with separate pools: cheap summary reads (rollup
+tables) and heavy reads that scan event detail (drawers, retention). Each pool
+has its own worker threads, and therefore its own DuckDB cursors, plus its own
+queue limit and timeout, so a burst of heavy queries cannot occupy the workers
+that serve summary widgets.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Optional, TypeVar
+
+from app.core.config import get_settings
+from app.services.data_service import get_data_service
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+T = TypeVar("T")
+
+QUERY_CLASSES = ("summary", "heavy")
+
+
+class QueryQueueFullError(RuntimeError):
+    """Raised when too many queries are already waiting for a worker."""
+
+
+class QueryTimeoutError(TimeoutError):
+    """Raised when a query does not finish within its time budget."""
+
+
+class _Job:
+    __slots__ = ("thread_id", "done")
+
+    def __init__(self) -> None:
+        self.thread_id: Optional[int] = None
+        self.done = False
+
+
+class QueryExecutor:
+    """Runs blocking callables on a fixed pool of worker threads.
+
+    Each worker thread gets its own DuckDB cursor (see ``DataService.con``), so
+    queries run concurrently against the shared database while the event loop
+    stays free to serve cache hits.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_pending: int,
+        on_timeout: Optional[Callable[[int], None]] = None,
+        timeout: Optional[float] = None,
+        thread_name_prefix: str = "duckdb-worker",
+    ) -> None:
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.timeout = timeout  # 该类查询的默认时间预算（由调用方传给 run）
+        self._max_pending = max_pending
+        self._on_timeout = on_timeout
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    async def run(self, func: Callable[..., T], *args: Any, timeout: Optional[float] = None) -> T:
+        with self._lock:
+            if self._pending >= self._max_pending:
+                raise QueryQueueFullError(f"query queue is full ({self._max_pending} pending)")
+            self._pending += 1
+
+        job = _Job()
+        future = self._pool.submit(self._call, job, func, *args)
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            self._cancel(job, future)
+            raise QueryTimeoutError(f"query exceeded {timeout}s") from None
+
+    def _call(self, job: _Job, func: Callable[..., T], *args: Any) -> T:
+        with self._lock:
+            job.thread_id = threading.get_ident()
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                job.done = True
+
+    def _cancel(self, job: _Job, future: Any) -> None:
+        if future.cancel():
+            return
+        # 已经在 worker 中执行：中断该线程上的 DuckDB 查询
+        with self._lock:
+            if job.done or job.thread_id is None or self._on_timeout is None:
+                return
+            logger.warning("Interrupting query on worker %s after timeout.", job.thread_id)
+            self._on_timeout(job.thread_id)
+
+    def _release(self, _future: Any) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def query_class_of(func: Callable[..., Any]) -> str:
+    """DataService 方法所属的查询类别（见 data_service._heavy_query），默认为 summary"""
+    return getattr(func, "query_class", "summary")
+
+
+@lru_cache
+def get_query_executor(query_class: str = "summary") -> QueryExecutor:
+    if query_class == "heavy":
+        workers, pending, timeout = (
+            settings.heavy_query_workers,
+            settings.heavy_query_queue_limit,
+            settings.heavy_query_timeout_seconds,
+        )
+    elif query_class == "summary":
+        workers, pending, timeout = settings.query_workers, settings.query_queue_limit, settings.query_timeout_seconds
+    else:
+        raise ValueError(f"Unknown query class: {query_class}")
+    return QueryExecutor(
+        max_workers=workers,
+        max_pending=pending,
+        on_timeout=get_data_service().interrupt,
+        timeout=timeout,
+        thread_name_prefix=f"duckdb-{query_class}",
+    )
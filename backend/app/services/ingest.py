@@ -0,0 +1,44 @@
+"""Incremental event ingestion and targeted cache invalidation."""
+from __future__ import annotations
+
+import logging
+from pathlib import Path
+from typing import Any
+
+from app.services.cache import cache_delete_matching
+from app.services.data_service import get_data_service
+
+logger = logging.getLogger(__name__)
+
+
+def ingest_files(paths: list[Path]) -> list[dict[str, Any]]:
+    """按顺序导入每个 Parquet/CSV 批次"""
+    service = get_data_service()
+    results = []
+    for path in paths:
+        result = service.ingest_events(path)
+        logger.info("Ingested %s rows from %s", result["rows"], path)
+        results.append(result)
+    return results
+
+
+def _is_affected(prefix: str, params: dict[str, str], results: list[dict[str, Any]]) -> bool:
+    if "segment" not in params:
+        return True
+    for result in results:
+        if not result["rows"] or params["segment"] not in result["segments"]:
+            continue
+        key_from = params.get("date_from", "None")
+        key_to = params.get("date_to", "None")
+        if (key_from == "None" or key_from <= result["date_to"]) and (
+            key_to == "None" or key_to >= result["date_from"]
+        ):
+            return True
+    return False
+
+
+async def invalidate_ingested(results: list[dict[str, Any]]) -> int:
+    """仅失效与导入批次的分群和日期范围有交集的缓存键"""
+    if not any(result["rows"] for result in results):
+        return 0
+    return await cache_delete_matching(lambda prefix, params: _is_affected(prefix, params, results))
@@ -0,0 +1,177 @@
+"""Snapshot artifacts for read-only worker processes.
+
+A snapshot is a self-contained, compacted DuckDB file with the events table and
+every derived table (user_stats, rollups, visitor_sketch) already built, plus a
+JSON manifest next to it. Servers started with ``DUCKDB_READ_ONLY=true`` only
+attach such a file, so their startup time does not depend on the data size.
+
+``build_snapshot`` writes one artifact (e.g. at deploy/build time).
+``publish_snapshot`` is the long-running builder's variant: it builds from the
+current snapshot plus new batches into a versioned file under ``SNAPSHOT_DIR``
+and atomically re-points ``DUCKDB_PATH`` (a symlink) at it. Workers notice the
+new target and switch over between requests (``DataService.reload_if_published``).
+"""
+from __future__ import annotations
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Iterator
+
+import duckdb
+
+from app.core.config import get_settings
+from app.services.data_service import SNAPSHOT_FORMAT, DataService
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+SNAPSHOT_PATTERN = "events-*.duckdb"
+
+
+def new_snapshot_id() -> str:
+    """以构建时间开头，按名称排序即按时间排序"""
+    return f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+
+def build_snapshot(
+    out: Path,
+    batches: list[Path] | None = None,
+    base: Path | None = None,
+    snapshot_id: str | None = None,
+) -> dict[str, Any]:
+    """构建快照文件 out 及其清单 out.json，返回清单
+
+    Args:
+        out: 输出的 DuckDB 文件
+        batches: 构建后依次增量导入的事件批次
+        base: 以该数据库为起点（复制后导入）；为 None 时从 DATA_SOURCE 全量构建
+        snapshot_id: 快照 ID，默认按当前时间生成
+    """
+    snapshot_id = snapshot_id or new_snapshot_id()
+    out.parent.mkdir(parents=True, exist_ok=True)
+    staging = out.with_name(out.name + ".building")
+    compacted = out.with_name(out.name + ".compacting")
+    try:
+        _remove_database(staging)
+        if base is not None:
+            shutil.copyfile(base, staging)
+        service = DataService(staging, read_only=False)
+        try:
+            results = [service.ingest_events(path) for path in batches or []]
+            service.stamp_snapshot(snapshot_id)
+        finally:
+            service.close()
+        _compact(staging, compacted)
+        os.replace(compacted, out)
+    finally:
+        _remove_database(staging)
+        _remove_database(compacted)
+
+    manifest = {
+        "snapshot_id": snapshot_id,
+        "format": SNAPSHOT_FORMAT,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "duckdb": duckdb.__version__,
+        "file": out.name,
+        "size_bytes": out.stat().st_size,
+        "sha256": _sha256(out),
+        "tables": _table_rows(out),
+        "batches": results,
+    }
+    out.with_name(out.name + ".json").write_text(json.dumps(manifest, ensure_ascii=False, indent=2))
+    logger.info("Built snapshot %s -> %s (%d bytes)", snapshot_id, out, manifest["size_bytes"])
+    return manifest
+
+
+def publish_snapshot(batches: list[Path] | None = None) -> dict[str, Any]:
+    """在当前快照的基础上导入批次（并按需重建派生表），生成新快照后原子切换发布路径
+
+    没有已发布的数据库时，从 DATA_SOURCE 构建第一个快照。
+    """
+    published = settings.duckdb_path
+    settings.snapshot_dir.mkdir(parents=True, exist_ok=True)
+    with _builder_lock():
+        snapshot_id = new_snapshot_id()
+        target = settings.snapshot_dir / f"events-{snapshot_id}.duckdb"
+        base = published.resolve() if published.exists() else None
+        manifest = build_snapshot(target, batches, base, snapshot_id)
+        _point_to(published, target)
+        pruned = _prune_snapshots(target)
+    logger.info("Published snapshot %s -> %s", manifest["snapshot_id"], target)
+    return {**manifest, "path": str(target), "pruned": pruned}
+
+
+def _compact(source: Path, target: Path) -> None:
+    """将数据库完整复制到新文件：重建、更新与增量导入留下的空闲块不会带入快照"""
+    _remove_database(target)
+    con = duckdb.connect()
+    try:
+        con.execute(f"ATTACH '{source.as_posix()}' AS source_db (READ_ONLY)")
+        con.execute(f"ATTACH '{target.as_posix()}' AS target_db")
+        con.execute("COPY FROM DATABASE source_db TO target_db")
+        con.execute("DETACH target_db")
+    finally:
+        con.close()
+
+
+def _remove_database(path: Path) -> None:
+    for candidate in (path, path.with_name(path.name + ".wal")):
+        candidate.unlink(missing_ok=True)
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _table_rows(path: Path) -> dict[str, int]:
+    con = duckdb.connect(str(path), read_only=True)
+    try:
+        tables = [row[0] for row in con.execute("SELECT table_name FROM duckdb_tables() ORDER BY table_name").fetchall()]
+        return {table: con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in tables}
+    finally:
+        con.close()
+
+
+@contextmanager
+def _builder_lock() -> Iterator[None]:
+    """同一时间只允许一个构建进程发布快照"""
+    with open(settings.snapshot_dir / ".publish.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _point_to(link: Path, target: Path) -> None:
+    """原子地将发布路径替换为指向 target 的符号链接（worker 不会看到中间状态）"""
+    link.parent.mkdir(parents=True, exist_ok=True)
+    temp_link = link.with_name(f".{link.name}.{os.getpid()}.tmp")
+    temp_link.unlink(missing_ok=True)
+    temp_link.symlink_to(target.resolve())
+    os.replace(temp_link, link)
+
+
+def _prune_snapshots(current: Path) -> list[str]:
+    """只保留最近 SNAPSHOT_KEEP 个快照；仍打开旧文件的 worker 不受影响，切换后即释放"""
+    snapshots = sorted(settings.snapshot_dir.glob(SNAPSHOT_PATTERN), reverse=True)
+    pruned = []
+    for path in snapshots[max(settings.snapshot_keep, 1):]:
+        if path != current:
+            path.unlink(missing_ok=True)
+            path.with_name(path.name + ".json").unlink(missing_ok=True)
+            pruned.append(path.name)
+    return pruned
@@ -0,0 +1,258 @@
+"""In-process query and cache instrumentation, exported in Prometheus text format.
+
+Metrics live in module-level registries guarded by a lock, so they can be
+updated from the DuckDB worker threads as well as the event loop. DuckDB time,
+rows returned and rows scanned are accumulated per thread for the service call
+currently running on it (see ``track_service_call``).
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import textwrap
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+from app.core.config import get_settings
+
+slow_query_logger = logging.getLogger("app.slow_query")
+settings = get_settings()
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...]) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...], buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}  # key -> (各桶计数, [总和, 次数])
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with _lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * len(self.buckets), [0.0, 0])
+            counts, totals = entry
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            totals[0] += value
+            totals[1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (counts, (total, count)) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels + ("le",), key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels + ('le',), key + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template.", ("method", "endpoint", "status")
+)
+SERVICE_CALL_DURATION = Histogram(
+    "dataservice_call_duration_seconds", "DataService method latency (excluding JSON serialization).", ("method",)
+)
+SERVICE_PHASE_DURATION = Histogram(
+    "dataservice_phase_duration_seconds",
+    "Time spent per phase of a DataService call: duckdb (execute + fetch), python (post-processing), serialize (JSON).",
+    ("method", "phase"),
+)
+QUERY_ROWS_RETURNED = Counter("duckdb_rows_returned_total", "Rows fetched from DuckDB.", ("method",))
+QUERY_ROWS_SCANNED = Counter("duckdb_rows_scanned_total", "Rows scanned by DuckDB operators.", ("method",))
+QUERY_COUNT = Counter("duckdb_queries_total", "SQL statements executed.", ("method",))
+SLOW_QUERIES = Counter("duckdb_slow_queries_total", "SQL statements slower than SLOW_QUERY_LOG_SECONDS.", ("method",))
+CACHE_REQUESTS = Counter(
+    "cache_requests_total", "Cache lookups by key prefix and result (local_hit, redis_hit, miss, coalesced, refresh).", ("prefix", "result")
+)
+FILTER_CACHE_REQUESTS = Counter(
+    "dataservice_filter_cache_total", "Filtered-relation cache lookups by result (hit, miss, bypass).", ("result",)
+)
+
+REGISTRY = (
+    HTTP_REQUEST_DURATION,
+    SERVICE_CALL_DURATION,
+    SERVICE_PHASE_DURATION,
+    QUERY_COUNT,
+    QUERY_ROWS_RETURNED,
+    QUERY_ROWS_SCANNED,
+    SLOW_QUERIES,
+    CACHE_REQUESTS,
+    FILTER_CACHE_REQUESTS,
+)
+
+
+def render() -> str:
+    with _lock:
+        lines = [line for metric in REGISTRY for line in metric.render()]
+    return "\n".join(lines) + "\n"
+
+
+class _CallStats:
+    __slots__ = ("method", "duckdb_seconds", "rows_returned", "rows_scanned", "queries")
+
+    def __init__(self, method: str) -> None:
+        self.method = method
+        self.duckdb_seconds = 0.0
+        self.rows_returned = 0
+        self.rows_scanned = 0
+        self.queries = 0
+
+
+@contextmanager
+def track_service_call(method: str) -> Iterator[None]:
+    """统计当前线程上一次 DataService 调用的总耗时、DuckDB 耗时与行数"""
+    stats = _CallStats(method)
+    previous = getattr(_local, "stats", None)
+    _local.stats = stats
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _local.stats = previous
+        SERVICE_CALL_DURATION.observe(elapsed, method=method)
+        SERVICE_PHASE_DURATION.observe(stats.duckdb_seconds, method=method, phase="duckdb")
+        SERVICE_PHASE_DURATION.observe(max(elapsed - stats.duckdb_seconds, 0.0), method=method, phase="python")
+        QUERY_COUNT.inc(stats.queries, method=method)
+        QUERY_ROWS_RETURNED.inc(stats.rows_returned, method=method)
+        QUERY_ROWS_SCANNED.inc(stats.rows_scanned, method=method)
+
+
+@contextmanager
+def track_serialization(method: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        SERVICE_PHASE_DURATION.observe(time.perf_counter() - start, method=method, phase="serialize")
+
+
+def _current_method() -> str:
+    stats = getattr(_local, "stats", None)
+    return stats.method if stats is not None else "background"
+
+
+def record_execute(elapsed: float) -> None:
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats.duckdb_seconds += elapsed
+
+
+def record_query(sql: str, elapsed: float, rows_scanned: Optional[int], params: Any = None) -> None:
+    """记录一条 SQL 的执行耗时（含取回结果）；超过慢查询阈值时连同 SQL 与参数写入慢查询日志"""
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats.queries += 1
+        stats.rows_scanned += rows_scanned or 0
+    threshold = settings.slow_query_log_seconds
+    if threshold is not None and elapsed >= threshold:
+        method = _current_method()
+        SLOW_QUERIES.inc(method=method)
+        slow_query_logger.warning(
+            "Slow query in %s: %.3fs, %s rows scanned, params %s\n%s",
+            method,
+            elapsed,
+            rows_scanned,
+            params,
+            _compact_sql(sql),
+        )
+
+
+def record_fetch(elapsed: float, rows: int) -> None:
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats.duckdb_seconds += elapsed
+        stats.rows_returned += rows
+
+
+def _compact_sql(sql: str) -> str:
+    return textwrap.dedent(sql).strip()
+
+
+def record_cache(key: str, result: str) -> None:
+    CACHE_REQUESTS.inc(prefix=key.split("|", 1)[0], result=result)
+
+
+def record_filter_cache(result: str) -> None:
+    FILTER_CACHE_REQUESTS.inc(result=result)
+
+
+class RequestTimingMiddleware:
+    """按路由模板（如 /api/drilldown/{entity_type}/{entity_id}）统计请求耗时，流式响应计到最后一个分块"""
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+
+    async def __call__(self, scope: dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = "500"
+
+        async def send_wrapper(message: dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - start, method=scope["method"], endpoint=_route_template(scope), status=status
+            )
+
+
+def _route_template(scope: dict[str, Any]) -> str:
+    """匹配到的路由模板；include_router 的路由只记录自身路径，前缀取自实际请求路径的对应部分"""
+    route_path = getattr(scope.get("route"), "path", None)
+    if not route_path:
+        return "unmatched"
+    prefix = scope["path"].split("/")[: -route_path.count("/")]
+    return "/".join(prefix) + route_path
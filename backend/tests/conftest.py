@@ -0,0 +1,68 @@
+"""Shared fixtures: a small synthetic event set and DuckDB databases built from it.
+
+The environment is configured before any ``app`` module is imported, because the
+settings and the route-level DataService are created at import time.
+"""
+from __future__ import annotations
+
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Callable, Iterator
+
+import pytest
+
+WORKDIR = Path(tempfile.mkdtemp(prefix="metrics-tests-"))
+EVENT_ROWS = 100_000
+
+os.environ.update(
+    {
+        "DATA_SOURCE": str(WORKDIR / "events.parquet"),
+        "FALLBACK_CSV": str(WORKDIR / "missing.csv"),
+        "DUCKDB_PATH": str(WORKDIR / "events.duckdb"),
+        "DUCKDB_READ_ONLY": "false",
+        "SNAPSHOT_DIR": str(WORKDIR / "snapshots"),
+        "REDIS_URL": "redis://127.0.0.1:1/0",  # 不可达：缓存只使用进程内一层
+        "CACHE_WARMUP_ENABLED": "false",
+    }
+)
+
+from app.benchmark import generate_events  # noqa: E402
+from app.core.config import get_settings  # noqa: E402
+from app.services.data_service import DataService, get_data_service  # noqa: E402
+
+settings = get_settings()
+generate_events(EVENT_ROWS, WORKDIR / "events.parquet")
+
+
+def pytest_sessionfinish(session: pytest.Session, exitstatus: int) -> None:
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def events_source() -> Path:
+    """全部合成事件（Parquet）"""
+    return WORKDIR / "events.parquet"
+
+
+@pytest.fixture(scope="session")
+def service() -> DataService:
+    """API 使用的共享 DataService（由 events_source 全量构建）"""
+    return get_data_service()
+
+
+@pytest.fixture
+def build_service(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Iterator[Callable[[Path], DataService]]:
+    """以给定事件文件为数据源，在临时目录中全量构建一个独立的可写 DataService"""
+    services: list[DataService] = []
+
+    def build(source: Path, name: str = "events.duckdb") -> DataService:
+        monkeypatch.setattr(settings, "data_source", source)
+        built = DataService(tmp_path / name, read_only=False)
+        services.append(built)
+        return built
+
+    yield build
+    for built in services:
+        built.close()
@@ -0,0 +1,58 @@
+"""HyperLogLog estimates (approx=true) stay within their stated error and merge exactly."""
+from __future__ import annotations
+
+import pytest
+
+from app.services.data_service import HLL_ERROR_BOUND
+
+# 3 倍相对标准误差：正常实现下几乎不会越界，寄存器或修正公式出错时会明显越界
+TOLERANCE = 3 * HLL_ERROR_BOUND
+
+RANGES = [(None, None), ("2015-06-01", "2015-06-30"), ("2015-08-10", "2015-08-10")]
+
+
+def _counts(result: dict) -> dict[int, int]:
+    return {row["weekday"]: row["user_count"] for row in result["data"]}
+
+
+@pytest.mark.parametrize("segment", ["All", "Hesitant", "Collector"])
+@pytest.mark.parametrize("date_from, date_to", RANGES)
+def test_approx_weekday_users_within_error_bound(service, segment, date_from, date_to):
+    exact = _counts(service.get_weekday_users(segment, date_from, date_to))
+    approx = service.get_weekday_users(segment, date_from, date_to, approx=True)
+
+    assert approx["error_bound"] == HLL_ERROR_BOUND
+    assert _counts(approx).keys() == exact.keys()
+    for weekday, count in exact.items():
+        assert abs(_counts(approx)[weekday] - count) <= max(TOLERANCE * count, 1), (weekday, count)
+
+
+def test_approx_distinct_large_cardinality(service):
+    # 基数远大于 2.5 × 寄存器数，估算走原始 HLL 公式而不是线性计数
+    relation = "(SELECT i % 7 AS k, i AS visitorid FROM range(300000) t(i))"
+    rows = service.con.execute(service._approx_distinct(relation, ["k"])).fetchall()
+
+    assert len(rows) == 7
+    for k, estimate in rows:
+        exact = len(range(k, 300000, 7))
+        assert abs(estimate - exact) <= TOLERANCE * exact, (k, estimate, exact)
+
+
+@pytest.mark.parametrize("segment", ["All", "Hesitant"])
+@pytest.mark.parametrize("date_from, date_to", RANGES)
+def test_merged_daily_sketches_equal_direct_estimate(service, segment, date_from, date_to):
+    # 寄存器按最大值合并是精确的：合并每日寄存器与直接对整段事件计算寄存器得到相同的估算
+    relation = f"""
+    (SELECT e.visitorid, e.weekday
+     FROM events e
+     WHERE {service._segment_filter("e.segment_mask")}
+       AND e.timestamp >= $ts_from
+       AND e.timestamp < $ts_to)
+    """
+    direct = service.con.execute(
+        f"SELECT weekday, user_count FROM ({service._approx_distinct(relation, ['weekday'])})",
+        service._filter_params(segment, date_from, date_to),
+    ).fetchall()
+
+    merged = _counts(service.get_weekday_users(segment, date_from, date_to, approx=True))
+    assert {weekday: count for weekday, count in merged.items() if count} == dict(direct)
@@ -0,0 +1,139 @@
+"""The shared filter-result cache: same answers as scanning events, LRU eviction,
+leases that outlive eviction, and no stale tables across an ingest."""
+from __future__ import annotations
+
+import threading
+
+import duckdb
+import pytest
+
+from app.core.config import get_settings
+from app.services.data_service import FILTER_CACHE_DATABASE
+
+settings = get_settings()
+
+KEYS = [
+    ("Collector", "2015-06-01", "2015-06-30"),
+    ("Collector", "2015-07-01", "2015-08-15"),
+    ("Impulsive", None, None),
+]
+
+
+@pytest.fixture
+def cached(service):
+    """共享 DataService，测试前后清空过滤结果缓存"""
+    service._clear_filter_cache()
+    yield service
+    service._clear_filter_cache()
+
+
+def _tables(service) -> set[str]:
+    return {
+        name
+        for (name,) in service.con.execute(
+            "SELECT table_name FROM duckdb_tables() WHERE database_name = $db", {"db": FILTER_CACHE_DATABASE}
+        ).fetchall()
+    }
+
+
+def _drawers(service, segment, date_from, date_to) -> list:
+    return [
+        service.get_funnel_stage_detail("view", segment, 10, date_from, date_to),
+        service.get_active_hour_detail(14, segment, 10, date_from, date_to),
+        service.get_weekday_detail(3, segment, 10, date_from, date_to),
+        service.get_activity_widgets(segment, date_from, date_to),
+    ]
+
+
+def _use(service, key) -> None:
+    service.get_weekday_users(*key)
+
+
+def _row_counts(service, monkeypatch) -> dict:
+    monkeypatch.setattr(settings, "filter_cache_max_rows", 10_000_000)
+    for key in KEYS:
+        _use(service, key)
+    rows = {key: service._filter_cache[key].rows for key in KEYS}
+    service._clear_filter_cache()
+    return rows
+
+
+@pytest.mark.parametrize("key", KEYS)
+def test_cached_results_match_uncached(cached, monkeypatch, key):
+    monkeypatch.setattr(settings, "filter_cache_max_rows", 0)
+    uncached = _drawers(cached, *key)
+    assert not cached._filter_cache
+
+    monkeypatch.undo()
+    assert _drawers(cached, *key) == uncached  # 第一次：物化
+    assert key in cached._filter_cache
+    assert _drawers(cached, *key) == uncached  # 之后：读取缓存表
+    assert cached._filter_cache[key].leases == 0
+
+
+def test_least_recently_used_relation_is_evicted(cached, monkeypatch):
+    rows = _row_counts(cached, monkeypatch)
+    # 最大的表被淘汰后，其余两张表恰好放得下
+    evicted = max(KEYS, key=rows.get)
+    touched, newest = [key for key in KEYS if key != evicted]
+    monkeypatch.setattr(settings, "filter_cache_max_rows", rows[evicted] + rows[touched])
+
+    _use(cached, evicted)
+    _use(cached, touched)
+    evicted_table = cached._filter_cache[evicted].table
+    _use(cached, evicted)  # 再次使用：移到最近使用端
+    _use(cached, touched)
+    assert list(cached._filter_cache) == [evicted, touched]
+
+    _use(cached, newest)
+    assert list(cached._filter_cache) == [touched, newest]
+    assert cached._filter_cache_rows == rows[touched] + rows[newest] <= settings.filter_cache_max_rows
+    assert evicted_table not in _tables(cached)
+    assert _tables(cached) == {relation.table for relation in cached._filter_cache.values()}
+
+
+def test_leased_relation_survives_eviction_until_released(cached, monkeypatch):
+    rows = _row_counts(cached, monkeypatch)
+    first, second = KEYS[:2]
+    monkeypatch.setattr(settings, "filter_cache_max_rows", rows[first] + rows[second] - 1)
+
+    cached._filtered_source(*first)  # 借出，直到显式归还
+    relation = cached._filter_cache[first]
+    try:
+        _use(cached, second)
+        assert first not in cached._filter_cache and relation.evicted
+        assert relation.table in _tables(cached)  # 仍在读取，不能删除
+        assert cached.con.execute(f"SELECT COUNT(*) FROM {FILTER_CACHE_DATABASE}.{relation.table}").fetchone()[0] == relation.rows
+    finally:
+        cached._local.filter_leases.remove(relation)
+        cached._release_filtered_relation(relation)
+    assert relation.table not in _tables(cached)
+    assert list(cached._filter_cache) == [second]
+
+
+def test_relation_materialized_during_ingest_is_not_cached(events_source, build_service, tmp_path, monkeypatch):
+    service = build_service(events_source)
+    batch = tmp_path / "batch.parquet"
+    con = duckdb.connect()
+    con.execute(
+        f"COPY (SELECT * REPLACE (visitorid + 10000000 AS visitorid) FROM read_parquet($source) LIMIT 200) TO '{batch}'",
+        {"source": str(events_source)},
+    )
+    con.close()
+    key = KEYS[0]
+    filter_params = service._filter_params
+
+    def ingest_then_filter(*args):
+        # 在检查行数之后、物化之前由另一线程导入新事件
+        thread = threading.Thread(target=service.ingest_events, args=(batch,))
+        thread.start()
+        thread.join()
+        return filter_params(*args)
+
+    monkeypatch.setattr(service, "_filter_params", ingest_then_filter)
+    relation = service._cache_filtered_relation(key)
+
+    assert relation is not None and relation.evicted and relation.leases == 1
+    assert key not in service._filter_cache
+    service._release_filtered_relation(relation)
+    assert relation.table not in _tables(service)
@@ -0,0 +1,90 @@
+"""Incremental ingestion must leave the database exactly as a full rebuild would."""
+from __future__ import annotations
+
+from pathlib import Path
+
+import duckdb
+
+from app.services.data_service import DataService
+
+# 拆分方式：整批新访客、较晚日期的全部事件、以及已有访客散落在历史日期上的事件（会改变其分群）
+DELTA_PREDICATE = """
+    visitorid % 10 = 3
+    OR timestamp >= TIMESTAMP '2015-08-20'
+    OR hash(timestamp, visitorid, itemid, event) % 20 = 0
+"""
+
+
+def _split(source: Path, directory: Path) -> tuple[Path, Path]:
+    base = directory / "base.parquet"
+    delta = directory / "delta 'batch'.parquet"  # 路径以绑定参数传入，引号不影响导入
+    con = duckdb.connect()
+    con.execute(f"COPY (SELECT * FROM read_parquet($source) WHERE NOT ({DELTA_PREDICATE})) TO '{base}'", {"source": str(source)})
+    con.execute(
+        f"COPY (SELECT * FROM read_parquet($source) WHERE {DELTA_PREDICATE}) TO '{str(delta).replace(chr(39), chr(39) * 2)}'",
+        {"source": str(source)},
+    )
+    con.close()
+    return base, delta
+
+
+def _tables(service: DataService) -> list[str]:
+    return [
+        name
+        for (name,) in service.con.execute(
+            """
+            SELECT table_name
+            FROM duckdb_tables()
+            WHERE database_name = current_database() AND NOT temporary AND table_name <> 'derived_state'
+            ORDER BY 1
+            """
+        ).fetchall()
+    ]
+
+
+def _rows(service: DataService, table: str) -> list[tuple]:
+    return service.con.execute(f"SELECT * FROM {table} ORDER BY ALL").fetchall()
+
+
+def test_ingest_matches_full_rebuild(events_source, build_service, tmp_path):
+    base, delta = _split(events_source, tmp_path)
+    incremental = build_service(base, "incremental.duckdb")
+    summary = incremental.ingest_events(delta)
+    full = build_service(events_source, "full.duckdb")
+
+    assert _tables(incremental) == _tables(full)
+    for table in _tables(full):
+        assert _rows(incremental, table) == _rows(full, table), table
+    assert incremental.get_top_entities("All", "view", "item", 10) == full.get_top_entities("All", "view", "item", 10)
+    assert incremental.get_monthly_retention("Hesitant") == full.get_monthly_retention("Hesitant")
+
+    con = duckdb.connect()
+    delta_rows, delta_visitors, new_visitors = con.execute(
+        """
+        SELECT
+            COUNT(*),
+            COUNT(DISTINCT visitorid),
+            COUNT(DISTINCT visitorid) FILTER (WHERE visitorid NOT IN (SELECT visitorid FROM read_parquet($base)))
+        FROM read_parquet($delta)
+        """,
+        {"base": str(base), "delta": str(delta)},
+    ).fetchone()
+    con.close()
+    assert summary["rows"] == delta_rows
+    assert summary["visitors"] == delta_visitors
+    assert summary["new_visitors"] == new_visitors > 0
+    assert 0 < summary["reclassified"] <= delta_visitors - new_visitors
+
+
+def test_ingest_empty_batch_changes_nothing(events_source, build_service, tmp_path):
+    service = build_service(events_source)
+    before = {table: _rows(service, table) for table in _tables(service)}
+    empty = tmp_path / "empty.parquet"
+    con = duckdb.connect()
+    con.execute(f"COPY (SELECT * FROM read_parquet($source) LIMIT 0) TO '{empty}'", {"source": str(events_source)})
+    con.close()
+
+    summary = service.ingest_events(empty)
+
+    assert summary["rows"] == 0 and summary["new_visitors"] == 0 and summary["reclassified"] == 0
+    assert {table: _rows(service, table) for table in _tables(service)} == before
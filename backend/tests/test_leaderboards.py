@@ -0,0 +1,66 @@
+"""Top-N leaderboards must equal an exact aggregation over the events table."""
+from __future__ import annotations
+
+import pytest
+
+RANGES = [
+    (None, None),
+    ("2015-06-01", "2015-07-15"),
+    ("2015-06-14", "2015-06-20"),
+    ("2015-08-03", "2015-08-03"),
+]
+
+
+def _exact_counts(service, segment, metric, entity, date_from, date_to) -> dict[int, int]:
+    field = "itemid" if entity == "item" else "categoryid"
+    rows = service.con.execute(
+        f"""
+        SELECT {field}, COUNT(*)
+        FROM events
+        WHERE {service._segment_filter()}
+          AND timestamp >= $ts_from
+          AND timestamp < $ts_to
+          AND event = $metric
+        GROUP BY 1
+        """,
+        {**service._filter_params(segment, date_from, date_to), "metric": metric},
+    ).fetchall()
+    return dict(rows)
+
+
+def _assert_exact_top(rows, exact: dict[int, int], limit: int) -> None:
+    """名次的计数与精确 Top N 相同，且每个实体的计数都是其真实计数（并列时实体可以不同）"""
+    assert [value for _, value in rows] == sorted(exact.values(), reverse=True)[:limit]
+    for entity_id, value in rows:
+        assert exact[entity_id] == value, entity_id
+
+
+@pytest.mark.parametrize("segment", ["All", "Hesitant", "Collector"])
+@pytest.mark.parametrize("metric", ["view", "addtocart", "transaction"])
+@pytest.mark.parametrize("entity", ["item", "category"])
+@pytest.mark.parametrize("date_from, date_to", RANGES)
+def test_top_entities_match_exact_aggregation(service, segment, metric, entity, date_from, date_to):
+    exact = _exact_counts(service, segment, metric, entity, date_from, date_to)
+    for limit in (1, 10, 30, 50):
+        records = service.get_top_entities(segment, metric, entity, limit, date_from, date_to)
+        _assert_exact_top([(r["entity_id"], r["value"]) for r in records], exact, limit)
+        assert all(r["metric"] == metric for r in records)
+
+
+@pytest.mark.parametrize("table, entity", [("itemid_leaders", "item"), ("categoryid_leaders", "category")])
+def test_leaderboard_query_answers_when_exact(service, table, entity):
+    """排行榜合并本身（不经回退）返回的结果也必须精确，且常见请求确实由它回答"""
+    answered = 0
+    for segment in ("All", "Hesitant"):
+        for metric in ("view", "addtocart"):
+            for date_from, date_to in RANGES:
+                exact = _exact_counts(service, segment, metric, entity, date_from, date_to)
+                for limit in (1, 10, 30):
+                    rows = service.con.run(
+                        service._leaderboard_query(table),
+                        {**service._rollup_params(segment, date_from, date_to), "metric": metric, "row_limit": limit},
+                    ).fetchall()
+                    if rows:
+                        answered += 1
+                        _assert_exact_top(rows, exact, limit)
+    assert answered > 0
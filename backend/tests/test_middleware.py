@@ -0,0 +1,91 @@
+"""Conditional GET: ETag / 304 on successful JSON responses, never on errors or NDJSON streams."""
+from __future__ import annotations
+
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.api.routes import metrics
+from app.main import app
+from app.services import cache
+
+
+@pytest.fixture
+def client(service):
+    # 不进入 lifespan：无需后台任务，也不在测试结束时关闭查询线程池
+    return TestClient(app, raise_server_exceptions=False)
+
+
+@pytest.fixture
+def failing_funnel(monkeypatch):
+    """让漏斗组件的查询抛出指定异常（清空进程内缓存，确保实际执行查询）"""
+
+    def fail_with(error: Exception) -> None:
+        def get_funnel(*args):
+            raise error
+
+        monkeypatch.setattr(metrics.service, "get_funnel", get_funnel)
+
+    cache._local.clear()
+    yield fail_with
+    cache._local.clear()
+
+
+def _vary(response) -> list[str]:
+    return [token.strip().lower() for token in response.headers.get("vary", "").split(",")]
+
+
+def test_success_is_tagged_and_revalidates_to_304(client):
+    response = client.get("/api/segments", headers={"Accept-Encoding": "identity"})
+    etag = response.headers["etag"]
+
+    assert response.status_code == 200 and etag.startswith('W/"')
+    assert response.headers["cache-control"] == "private, no-cache"
+    assert "accept-encoding" in _vary(response)
+
+    revalidated = client.get("/api/segments", headers={"If-None-Match": etag})
+    assert revalidated.status_code == 304
+    assert revalidated.content == b""
+    assert revalidated.headers["etag"] == etag
+
+    # If-None-Match 可以列出多个 ETag，按弱比较匹配
+    assert client.get("/api/segments", headers={"If-None-Match": f'"other", {etag[2:]}'}).status_code == 304
+    assert client.get("/api/segments", headers={"If-None-Match": 'W/"other"'}).status_code == 200
+    assert client.get("/api/funnel", headers={"If-None-Match": etag}).status_code == 200  # ETag 随请求路径与参数变化
+
+
+def test_stream_is_not_tagged(client):
+    response = client.get("/api/dashboard", params={"stream": "true", "widgets": ["segments", "funnel"]})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert "etag" not in response.headers
+    assert {json.loads(line)["widget"] for line in response.text.splitlines()} == {"segments", "funnel"}
+
+
+def test_stream_with_widget_error_is_not_tagged(client, failing_funnel):
+    failing_funnel(RuntimeError("boom"))
+    params = {"stream": "true", "widgets": ["segments", "funnel"]}
+    response = client.get("/api/dashboard", params=params)
+
+    assert response.status_code == 200 and "etag" not in response.headers
+    lines = {json.loads(line)["widget"]: json.loads(line) for line in response.text.splitlines()}
+    assert lines["funnel"] == {"widget": "funnel", "error": "internal error"}
+    assert "data" in lines["segments"]
+
+
+def test_error_responses_are_not_tagged(client, failing_funnel):
+    failing_funnel(ValueError("bad date"))
+
+    for response in (
+        client.get("/api/funnel"),
+        client.get("/api/dashboard", params={"widgets": ["funnel"]}),
+    ):
+        assert response.status_code == 400
+        assert response.json() == {"detail": "bad date"}
+        assert "etag" not in response.headers
+
+    failing_funnel(RuntimeError("boom"))
+    response = client.get("/api/funnel")
+    assert response.status_code == 500 and "etag" not in response.headers
@@ -0,0 +1,140 @@
+"""Publishing swaps the symlink atomically; read-only workers switch between calls
+and close the replaced instance only after its last cursor is gone."""
+from __future__ import annotations
+
+import gc
+import threading
+from pathlib import Path
+
+import duckdb
+import pytest
+
+from app.services import snapshot
+from app.services.data_service import DataService
+
+
+@pytest.fixture
+def publish(events_source, tmp_path, monkeypatch):
+    """在临时目录中发布快照；返回 (发布函数, 发布路径)"""
+    link = tmp_path / "events.duckdb"
+    monkeypatch.setattr(snapshot.settings, "duckdb_path", link)
+    monkeypatch.setattr(snapshot.settings, "snapshot_dir", tmp_path / "snapshots")
+    monkeypatch.setattr(snapshot.settings, "snapshot_keep", 2)
+    batch = tmp_path / "batch.parquet"
+    con = duckdb.connect()
+    con.execute(
+        f"COPY (SELECT * REPLACE (visitorid + 10000000 AS visitorid) FROM read_parquet($source) LIMIT 500) TO '{batch}'",
+        {"source": str(events_source)},
+    )
+    con.close()
+
+    def run(with_batch: bool = True) -> dict:
+        return snapshot.publish_snapshot([batch] if with_batch else None)
+
+    return run, link
+
+
+@pytest.fixture
+def reader(publish):
+    """挂载发布路径的只读 DataService"""
+    run, link = publish
+    run(with_batch=False)
+    service = DataService(link, read_only=True)
+    yield service
+    service.close()
+
+
+def _event_count(service: DataService) -> int:
+    return service.con.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+
+def _is_open(db: duckdb.DuckDBPyConnection) -> bool:
+    try:
+        db.execute("SELECT 1")
+    except duckdb.ConnectionException:
+        return False
+    return True
+
+
+def test_publish_repoints_link_and_reader_switches(publish, reader):
+    run, link = publish
+    first_target, before = link.resolve(), _event_count(reader)
+    assert not reader.reload_if_published()
+
+    manifest = run()
+
+    assert link.is_symlink() and link.resolve() == Path(manifest["path"]) != first_target
+    assert manifest["batches"][0]["rows"] == 500
+    assert manifest["tables"]["events"] == before + 500
+    assert _event_count(reader) == before  # 切换只在 reload_if_published 时发生
+    assert reader.reload_if_published()
+    assert reader.snapshot_id == manifest["snapshot_id"]
+    assert _event_count(reader) == before + 500
+
+    # 只保留最近 snapshot_keep 个快照
+    third = run()
+    assert third["pruned"] == [first_target.name]
+    assert not first_target.exists()
+
+
+def test_replaced_instance_closes_after_last_cursor(publish, reader):
+    run, _ = publish
+    before = _event_count(reader)
+    first = reader._db
+    opened, switched, done = threading.Event(), threading.Event(), threading.Event()
+    counts: list[int] = []
+
+    def worker() -> None:
+        counts.append(_event_count(reader))
+        opened.set()
+        switched.wait()
+        counts.append(_event_count(reader))  # 下一次调用改用新快照上的游标
+        done.set()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    opened.wait()
+    run()
+    assert reader.reload_if_published()
+
+    assert _event_count(reader) == before + 500
+    assert _is_open(first)  # 另一线程仍持有旧快照上的游标
+    switched.set()
+    done.wait()
+    thread.join()
+    assert counts == [before, before + 500]
+    assert not _is_open(first)
+    assert not reader._retired
+
+
+def test_replaced_instance_closes_when_cursor_thread_exits(publish, reader):
+    run, _ = publish
+    first = reader._db
+    thread = threading.Thread(target=_event_count, args=(reader,))
+    thread.start()
+    thread.join()  # 线程退出，但它的游标要等回收后才关闭
+    gc.collect()
+    run()
+    assert reader.reload_if_published()
+    assert not _is_open(first)
+
+    second = reader._db
+    opened, exit_now = threading.Event(), threading.Event()
+
+    def worker() -> None:
+        _event_count(reader)
+        opened.set()
+        exit_now.wait()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    opened.wait()
+    run()
+    assert reader.reload_if_published()
+    _event_count(reader)  # 本线程在旧实例上的游标随之关闭，另一线程仍持有
+    assert _is_open(second)
+    exit_now.set()
+    thread.join()
+    gc.collect()
+    assert not _is_open(second)
+    assert not reader._retired and reader._open_cursors.keys() <= {reader._generation}
@@ -4,17 +4,8 @@ import { useQuery, useQueryClient } from "@tanstack/react-query";
 import { motion } from "framer-motion";
 import CountUp from "react-countup";
 import type { Dayjs } from "dayjs";
-import {
-  fetchActiveHours,
-  fetchEventCounts,
-  fetchFunnel,
-  fetchMonthlyRetention,
-  fetchSegments,
-  fetchTopCategories,
-  fetchTopItems,
-  fetchWeekdayUsers,
-} from "./api/endpoints";
-import type { EventMetric, SegmentName, TopEntity } from "./api/types";
+import { fetchDashboardWidget, fetchSegments } from "./api/endpoints";
+import type { DashboardFilters, EventMetric, SegmentName, TopEntity } from "./api/types";
 import { FilterBar } from "./components/FilterBar";
 import { ChartCard } from "./components/ChartCard";
 import { BarChart } from "./components/charts/BarChart";
@@ -177,6 +168,7 @@ function App() {
 
   const dateFrom = dateRange?.[0]?.format("YYYY-MM-DD") || null;
   const dateTo = dateRange?.[1]?.format("YYYY-MM-DD") || null;
+  const dashboardFilters: DashboardFilters = { segment, metric, limit: topN, date_from: dateFrom, date_to: dateTo };
 
   const {
     data: topItems,
@@ -184,7 +176,7 @@ function App() {
     dataUpdatedAt: topItemsUpdatedAt,
   } = useQuery({
     queryKey: ["top-items", segment, metric, topN, dateFrom, dateTo],
-    queryFn: () => fetchTopItems({ segment, metric, limit: topN, date_from: dateFrom, date_to: dateTo }),
+    queryFn: () => fetchDashboardWidget("top-items", dashboardFilters),
     refetchOnWindowFocus: false,
     refetchOnReconnect: false,
   });
@@ -195,28 +187,28 @@ function App() {
     dataUpdatedAt: topCategoriesUpdatedAt,
   } = useQuery({
     queryKey: ["top-categories", segment, metric, topN, dateFrom, dateTo],
-    queryFn: () => fetchTopCategories({ segment, metric, limit: topN, date_from: dateFrom, date_to: dateTo }),
+    queryFn: () => fetchDashboardWidget("top-categories", dashboardFilters),
     refetchOnWindowFocus: false,
     refetchOnReconnect: false,
   });
 
   const { data: funnelData, dataUpdatedAt: funnelUpdatedAt } = useQuery({
     queryKey: ["funnel", segment, dateFrom, dateTo],
-    queryFn: () => fetchFunnel(segment, dateFrom, dateTo),
+    queryFn: () => fetchDashboardWidget("funnel", dashboardFilters),
     refetchOnWindowFocus: false,
     refetchOnReconnect: false,
   });
 
   const { data: eventCounts, dataUpdatedAt: eventCountsUpdatedAt } = useQuery({
     queryKey: ["event-counts", segment, dateFrom, dateTo],
-    queryFn: () => fetchEventCounts(segment, dateFrom, dateTo),
+    queryFn: () => fetchDashboardWidget("event-counts", dashboardFilters),
     refetchOnWindowFocus: false,
     refetchOnReconnect: false,
   });
 
   const { data: activeHours, dataUpdatedAt: activeHoursUpdatedAt } = useQuery({
     queryKey: ["active-hours", segment, dateFrom, dateTo],
-    queryFn: () => fetchActiveHours(segment, dateFrom, dateTo),
+    queryFn: () => fetchDashboardWidget("active-hours", dashboardFilters),
     refetchOnWindowFocus: false,
     refetchOnReconnect: false,
   });
@@ -227,7 +219,7 @@ function App() {
     isLoading: loadingRetention,
   } = useQuery({
     queryKey: ["monthly-retention", segment, dateFrom, dateTo],
-    queryFn: () => fetchMonthlyRetention(segment, dateFrom, dateTo),
+    queryFn: () => fetchDashboardWidget("monthly-retention", dashboardFilters),
     refetchOnWindowFocus: false,
     refetchOnReconnect: false,
   });
@@ -238,7 +230,7 @@ function App() {
     isLoading: loadingWeekdayUsers,
   } = useQuery({
     queryKey: ["weekday-users", segment, dateFrom, dateTo],
-    queryFn: () => fetchWeekdayUsers(segment, dateFrom, dateTo),
+    queryFn: () => fetchDashboardWidget("weekday-users", dashboardFilters),
     refetchOnWindowFocus: false,
     refetchOnReconnect: false,
   });
@@ -1,19 +1,16 @@
 import api from "./client";
 import type {
   ActiveHourDetailPayload,
-  ActiveHourPoint,
   CohortDetailPayload,
+  DashboardChunk,
+  DashboardFilters,
+  DashboardWidget,
+  DashboardWidgets,
   DrilldownPayload,
-  EventCounts,
-  EventMetric,
-  FunnelStage,
   FunnelStageDetailPayload,
-  MonthlyRetentionPoint,
   SegmentName,
   SegmentSummary,
-  TopEntity,
   WeekdayDetailPayload,
-  WeekdayUsersResponse,
 } from "./types";
 
 export const fetchSegments = async () => {
@@ -21,67 +18,6 @@ export const fetchSegments = async () => {
   return data;
 };
 
-export const fetchTopItems = async (
-  params: {
-    segment: SegmentName;
-    metric: EventMetric;
-    limit: number;
-    date_from?: string | null;
-    date_to?: string | null;
-  } = {
-    segment: "All",
-    metric: "transaction",
-    limit: 10,
-  }
-) => {
-  const { data } = await api.get<TopEntity[]>("/top-items", { params });
-  return data;
-};
-
-export const fetchTopCategories = async (params: {
-  segment: SegmentName;
-  metric: EventMetric;
-  limit: number;
-  date_from?: string | null;
-  date_to?: string | null;
-}) => {
-  const { data } = await api.get<TopEntity[]>("/top-categories", { params });
-  return data;
-};
-
-export const fetchFunnel = async (
-  segment: SegmentName,
-  date_from?: string | null,
-  date_to?: string | null
-) => {
-  const { data } = await api.get<FunnelStage[]>("/funnel", {
-    params: { segment, date_from, date_to },
-  });
-  return data;
-};
-
-export const fetchEventCounts = async (
-  segment: SegmentName,
-  date_from?: string | null,
-  date_to?: string | null
-) => {
-  const { data } = await api.get<EventCounts>("/event-counts", {
-    params: { segment, date_from, date_to },
-  });
-  return data;
-};
-
-export const fetchActiveHours = async (
-  segment: SegmentName,
-  date_from?: string | null,
-  date_to?: string | null
-) => {
-  const { data } = await api.get<ActiveHourPoint[]>("/active-hours", {
-    params: { segment, date_from, date_to },
-  });
-  return data;
-};
-
 export const fetchDrilldown = async (
   entityType: "item" | "category",
   entityId: number,
@@ -121,28 +57,6 @@ export const fetchActiveHourDetail = async (
   return data;
 };
 
-export const fetchMonthlyRetention = async (
-  segment: SegmentName,
-  date_from?: string | null,
-  date_to?: string | null
-) => {
-  const { data } = await api.get<MonthlyRetentionPoint[]>("/monthly-retention", {
-    params: { segment, date_from, date_to },
-  });
-  return data;
-};
-
-export const fetchWeekdayUsers = async (
-  segment: SegmentName,
-  date_from?: string | null,
-  date_to?: string | null
-) => {
-  const { data } = await api.get<WeekdayUsersResponse>("/weekday-users", {
-    params: { segment, date_from, date_to },
-  });
-  return data;
-};
-
 export const fetchCohortDetail = async (
   cohortMonth: string,
   segment: SegmentName,
@@ -168,3 +82,67 @@ export const fetchWeekdayDetail = async (
   return data;
 };
 
+type PendingWidget = {
+  resolve: (data: unknown) => void;
+  reject: (error: unknown) => void;
+};
+
+const dashboardBatches = new Map<string, Map<DashboardWidget, PendingWidget[]>>();
+
+const streamDashboard = async (filters: DashboardFilters, pending: Map<DashboardWidget, PendingWidget[]>) => {
+  try {
+    // 与其他接口共用 axios 实例（baseURL、拦截器、超时与错误处理）；fetch 适配器以流的形式返回响应体
+    const { data: body } = await api.get<ReadableStream<Uint8Array>>("/dashboard", {
+      params: { ...filters, stream: true, widgets: [...pending.keys()] },
+      paramsSerializer: { indexes: null },
+      adapter: "fetch",
+      responseType: "stream",
+    });
+    const reader = body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = "";
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += value;
+      const lines = buffer.split("\n");
+      buffer = lines.pop() ?? "";
+      for (const line of lines) {
+        if (!line) continue;
+        const chunk = JSON.parse(line) as DashboardChunk;
+        const waiters = pending.get(chunk.widget) ?? [];
+        pending.delete(chunk.widget);
+        waiters.forEach((waiter) =>
+          "error" in chunk ? waiter.reject(new Error(chunk.error)) : waiter.resolve(chunk.data)
+        );
+      }
+    }
+  } catch (error) {
+    pending.forEach((waiters) => waiters.forEach((waiter) => waiter.reject(error)));
+    pending.clear();
+  }
+  pending.forEach((waiters, widget) =>
+    waiters.forEach((waiter) => waiter.reject(new Error(`Dashboard response is missing ${widget}`)))
+  );
+};
+
+// 同一轮渲染中各图表发起的请求合并为一次 /dashboard 流式请求，每个组件完成后立即返回
+export const fetchDashboardWidget = <W extends DashboardWidget>(
+  widget: W,
+  filters: DashboardFilters
+): Promise<DashboardWidgets[W]> =>
+  new Promise((resolve, reject) => {
+    const batchKey = JSON.stringify([filters.segment, filters.metric, filters.limit, filters.date_from, filters.date_to]);
+    let pending = dashboardBatches.get(batchKey);
+    if (!pending) {
+      const batch = new Map<DashboardWidget, PendingWidget[]>();
+      dashboardBatches.set(batchKey, batch);
+      setTimeout(() => {
+        dashboardBatches.delete(batchKey);
+        void streamDashboard(filters, batch);
+      }, 0);
+      pending = batch;
+    }
+    const waiters = pending.get(widget) ?? [];
+    waiters.push({ resolve: resolve as (data: unknown) => void, reject });
+    pending.set(widget, waiters);
+  });
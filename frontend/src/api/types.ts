@@ -190,3 +190,29 @@ export interface CohortDetailPayload {
   user_segment_distribution: Record<string, number>; // 用户细分群体分布
 }
 
+
+export interface DashboardWidgets {
+  segments: SegmentSummary[];
+  "top-items": TopEntity[];
+  "top-categories": TopEntity[];
+  funnel: FunnelStage[];
+  "event-counts": EventCounts;
+  "active-hours": ActiveHourPoint[];
+  "monthly-retention": MonthlyRetentionPoint[];
+  "weekday-users": WeekdayUsersResponse;
+}
+
+export type DashboardWidget = keyof DashboardWidgets;
+
+export interface DashboardFilters {
+  segment: SegmentName;
+  metric: EventMetric;
+  limit: number;
+  date_from?: string | null;
+  date_to?: string | null;
+}
+
+// /dashboard?stream=true 返回的每一行
+export type DashboardChunk =
+  | { widget: DashboardWidget; data: DashboardWidgets[DashboardWidget] }
+  | { widget: DashboardWidget; error: string };